@@ -0,0 +1,343 @@
+"""
+Batch encoding of positions into NumPy arrays, with vectorized evaluation, check detection and mobility over a whole batch. Meant for scoring large sets of positions offline, with one Python call per batch instead of one per position.
+"""
+
+import argparse, random, sys, time
+
+import numpy as np
+
+import engine, evaluation
+
+
+# plane order is engine.piece_codes without the empty square: wp wN wB wR wQ wK bp bN bB bR bQ bK
+plane_pieces = engine.piece_codes[1:]
+fen_letters = 'PNBRQKpnbrqk'
+board_letters = dict(zip(plane_pieces, fen_letters))
+board_letters['--'] = '.'
+
+# FEN board field to one character per square, digits become runs of '.' and the row separators go
+fen_expand = str.maketrans(dict([(str(n), '.' * n) for n in range(1, 9)] + [('/', None)]))
+
+# character code -> plane, 12 for an empty square and 255 for anything that isn't a piece
+letter_planes = np.full(256, 255, np.uint8)
+letter_planes[ord('.')] = 12
+
+for plane, letter in enumerate(fen_letters):
+    letter_planes[ord(letter)] = plane
+
+# evaluation tables as arrays in plane order, see evaluation.py
+mg_weights = np.array([evaluation.mg_table[piece] for piece in plane_pieces], np.int32)
+eg_weights = np.array([evaluation.eg_table[piece] for piece in plane_pieces], np.int32)
+phase_weights = np.array([evaluation.phase_table[piece] for piece in plane_pieces], np.int32)
+material_weights = np.array([evaluation.mg_values[piece[1]] * (1 if piece[0] == 'w' else -1) for piece in plane_pieces], np.int32)
+
+knight_offsets = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+king_offsets = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+rook_offsets = engine.directions[:4]
+bishop_offsets = engine.directions[4:]
+
+chunk_size = 8192 # positions per step in the vectorized functions, bounds the size of the temporary arrays
+
+
+# one plane number per square for every position, row 0 is the 8th rank like GameState.board
+# positions can be GameStates or FEN strings, returns (codes (N, 64) uint8, white_to_move (N,) bool)
+
+def square_codes(positions):
+
+    boards = []
+    white_to_move = np.empty(len(positions), bool)
+
+    for i, position in enumerate(positions):
+
+        if isinstance(position, str):
+
+            fields = position.split()
+
+            if len(fields) < 2:
+                raise ValueError("FEN needs a board and a side to move: " + position)
+
+            board = fields[0].translate(fen_expand)
+
+            if len(board) != 64:
+                raise ValueError("FEN board needs 64 squares: " + position)
+
+            white_to_move[i] = fields[1] == 'w'
+
+        else:
+            board = ''.join([board_letters[piece] for row in position.board for piece in row])
+            white_to_move[i] = position.white_to_move
+
+        boards.append(board)
+
+    codes = letter_planes[np.frombuffer(''.join(boards).encode('ascii', 'replace'), np.uint8)].reshape(len(positions), 64)
+
+    if (codes == 255).any():
+        raise ValueError("bad FEN piece in batch")
+
+    return codes, white_to_move
+
+
+# returns (planes, white_to_move): planes is (N, 12, 8, 8) uint8 with a 1 where the plane's piece stands,
+# or with bitplanes (N, 12, 8) uint8 with one byte per rank, the a file in the high bit
+
+def encode_positions(positions, bitplanes = False):
+
+    codes, white_to_move = square_codes(positions)
+    planes = (codes[:, None, :] == np.arange(12, dtype = np.uint8)[None, :, None]).view(np.uint8)
+
+    if bitplanes:
+        return np.packbits(planes, axis = 2), white_to_move
+
+    return planes.reshape(len(codes), 12, 8, 8), white_to_move
+
+
+def unpack_bitplanes(packed):
+    return np.unpackbits(packed, axis = 2).reshape(len(packed), 12, 8, 8)
+
+
+# material balance, white minus black, with the middlegame piece values
+
+def material_batch(planes):
+
+    scores = np.empty(len(planes), np.int32)
+
+    for start in range(0, len(planes), chunk_size):
+        counts = planes[start:start + chunk_size].sum(axis = (2, 3), dtype = np.int32)
+        scores[start:start + chunk_size] = counts @ material_weights
+
+    return scores
+
+
+# the same score as evaluation.evaluate for every position, from the side to move's point of view
+
+def evaluate_batch(planes, white_to_move):
+
+    scores = np.empty(len(planes), np.int32)
+    total_phase = evaluation.total_phase
+
+    for start in range(0, len(planes), chunk_size):
+
+        chunk = planes[start:start + chunk_size].reshape(-1, 768).astype(np.int32)
+
+        mg = chunk @ mg_weights.reshape(768)
+        eg = chunk @ eg_weights.reshape(768)
+        phase = np.minimum(chunk.reshape(-1, 12, 64).sum(axis = 2) @ phase_weights, total_phase)
+
+        score = (mg * phase + eg * (total_phase - phase)) // total_phase
+        scores[start:start + chunk_size] = np.where(white_to_move[start:start + chunk_size], score, -score)
+
+    return scores
+
+
+# move every square of a (N, 8, 8) batch of boards by (dr, dc), squares pushed off the edge are dropped
+
+def shift(boards, dr, dc):
+
+    shifted = np.zeros_like(boards)
+    shifted[:, max(dr, 0):8 + min(dr, 0), max(dc, 0):8 + min(dc, 0)] = boards[:, max(-dr, 0):8 + min(-dr, 0), max(-dc, 0):8 + min(-dc, 0)]
+
+    return shifted
+
+
+# whether the side to move is in check, looking outward from its king like GameState.square_under_attack
+
+def in_check_batch(planes, white_to_move):
+
+    checks = np.empty(len(planes), bool)
+
+    for start in range(0, len(planes), chunk_size):
+
+        chunk = planes[start:start + chunk_size].astype(bool)
+        side = white_to_move[start:start + chunk_size][:, None, None]
+
+        king = np.where(side, chunk[:, 5], chunk[:, 11])
+        enemy = np.where(side[:, None], chunk[:, 6:], chunk[:, :6]) # p N B R Q K of the side not moving
+        empty = ~chunk.any(axis = 1)
+
+        # enemy pawns sit one row towards the enemy side of the king
+        white_pawn_squares = shift(king, -1, -1) | shift(king, -1, 1)
+        black_pawn_squares = shift(king, 1, -1) | shift(king, 1, 1)
+        attacked = np.where(side, white_pawn_squares, black_pawn_squares) & enemy[:, 0]
+
+        for dr, dc in knight_offsets:
+            attacked |= shift(king, dr, dc) & enemy[:, 1]
+
+        for dr, dc in king_offsets:
+            attacked |= shift(king, dr, dc) & enemy[:, 5]
+
+        for offsets, sliders in ((rook_offsets, enemy[:, 3] | enemy[:, 4]), (bishop_offsets, enemy[:, 2] | enemy[:, 4])):
+
+            for dr, dc in offsets:
+
+                ray = king
+
+                for step in range(7):
+
+                    ray = shift(ray, dr, dc)
+                    attacked |= ray & sliders
+                    ray = ray & empty
+
+                    if not ray.any():
+                        break
+
+        checks[start:start + chunk_size] = attacked.any(axis = (1, 2))
+
+    return checks
+
+
+# pseudo legal move counts for each side, (N, 2) with white then black
+# checks and pins are ignored, as are castling and en passant, and a promotion counts once
+
+def mobility_batch(planes):
+
+    mobility = np.zeros((len(planes), 2), np.int32)
+
+    for start in range(0, len(planes), chunk_size):
+
+        chunk = planes[start:start + chunk_size].astype(bool)
+        empty = ~chunk.any(axis = 1)
+
+        for colour in range(2):
+
+            own_planes = chunk[:, 6 * colour:6 * colour + 6]
+            own = own_planes.any(axis = 1)
+            enemy = ~(own | empty)
+            targets = ~own
+            count = np.zeros(len(chunk), np.int32)
+
+            # pawns: single and double pushes onto empty squares, captures onto enemy pieces
+            forward = -1 if colour == 0 else 1
+            pawns = own_planes[:, 0]
+            single = shift(pawns, forward, 0) & empty
+            first_step = np.zeros_like(single) # single pushes off the starting row can go one more
+            first_step[:, 5 - 3 * colour] = single[:, 5 - 3 * colour]
+            double = shift(first_step, forward, 0) & empty
+            count += single.sum(axis = (1, 2)) + double.sum(axis = (1, 2))
+            count += (shift(pawns, forward, -1) & enemy).sum(axis = (1, 2)) + (shift(pawns, forward, 1) & enemy).sum(axis = (1, 2))
+
+            for dr, dc in knight_offsets:
+                count += (shift(own_planes[:, 1], dr, dc) & targets).sum(axis = (1, 2))
+
+            for dr, dc in king_offsets:
+                count += (shift(own_planes[:, 5], dr, dc) & targets).sum(axis = (1, 2))
+
+            # sliders step out one square at a time, a ray stops on the first piece it reaches
+            for offsets, sliders in ((rook_offsets, own_planes[:, 3] | own_planes[:, 4]), (bishop_offsets, own_planes[:, 2] | own_planes[:, 4])):
+
+                for dr, dc in offsets:
+
+                    ray = sliders
+
+                    for step in range(7):
+
+                        ray = shift(ray, dr, dc) & targets
+                        count += ray.sum(axis = (1, 2))
+                        ray = ray & empty
+
+                        if not ray.any():
+                            break
+
+            mobility[start:start + chunk_size, colour] = count
+
+    return mobility
+
+
+# FENs of positions from random games, for benchmarks and checks
+
+def sample_fens(count, seed = 1, max_plies = 120):
+
+    rng = random.Random(seed)
+    fens = []
+    gs = engine.GameState()
+
+    while len(fens) < count:
+
+        moves = gs.get_valid_moves()
+
+        if not moves or len(gs.move_log) >= max_plies:
+            gs = engine.GameState()
+            continue
+
+        gs.make_move(rng.choice(moves))
+        fens.append(gs.get_fen())
+
+    return fens
+
+
+# compare evaluate_batch and in_check_batch against the engine on every position, raises RuntimeError on a mismatch
+
+def check_against_engine(fens):
+
+    planes, white_to_move = encode_positions(fens)
+    scores = evaluate_batch(planes, white_to_move)
+    checks = in_check_batch(planes, white_to_move)
+
+    if not (unpack_bitplanes(encode_positions(fens, bitplanes = True)[0]) == planes).all():
+        raise RuntimeError("bitplanes don't unpack to the encoded planes")
+
+    for i in range(len(fens)):
+
+        gs = engine.GameState()
+        gs.load_fen(fens[i])
+
+        if scores[i] != evaluation.evaluate(gs) or checks[i] != gs.in_check():
+            raise RuntimeError("batch results differ from the engine for " + fens[i])
+
+
+# positions per second for each stage at every batch size, batches bigger than chunk are encoded a chunk at a time
+
+def benchmark(sizes, chunk = 100000, out = sys.stdout):
+
+    fens = sample_fens(1000)
+    rows = []
+
+    for size in sizes:
+
+        timings = {'encode': 0.0, 'evaluate': 0.0, 'in_check': 0.0, 'mobility': 0.0}
+
+        for start in range(0, size, chunk):
+
+            positions = [fens[i % len(fens)] for i in range(start, min(size, start + chunk))]
+
+            begin = time.perf_counter()
+            planes, white_to_move = encode_positions(positions)
+            timings['encode'] += time.perf_counter() - begin
+
+            begin = time.perf_counter()
+            evaluate_batch(planes, white_to_move)
+            timings['evaluate'] += time.perf_counter() - begin
+
+            begin = time.perf_counter()
+            in_check_batch(planes, white_to_move)
+            timings['in_check'] += time.perf_counter() - begin
+
+            begin = time.perf_counter()
+            mobility_batch(planes)
+            timings['mobility'] += time.perf_counter() - begin
+
+        rates = {stage: size / elapsed if elapsed else 0.0 for stage, elapsed in timings.items()}
+        rows.append((size, rates))
+        out.write("%8d positions: encode %10.0f/s  evaluate %10.0f/s  in_check %10.0f/s  mobility %10.0f/s\n"
+            % (size, rates['encode'], rates['evaluate'], rates['in_check'], rates['mobility']))
+
+    return rows
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Measure batch encoding and vectorized scoring throughput.")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [1000, 100000, 1000000])
+    parser.add_argument("--check", action = "store_true", help = "compare the batch results with the engine first")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        check_against_engine(sample_fens(1000))
+        print("batch results match the engine")
+
+    benchmark(args.sizes)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,483 @@
+"""
+Bitboard backed game state. Keeps twelve 64 bit piece sets plus occupancy sets next to the board view and uses them for attack detection and legal move generation.
+"""
+
+from engine import GameState, Move, white_kingside, white_queenside, black_kingside, black_queenside
+
+
+# squares are numbered 0 - 63 as row * 8 + col, so square 0 is a8 and square 63 is h1
+
+piece_index = {'wp': 0, 'wN': 1, 'wB': 2, 'wR': 3, 'wQ': 4, 'wK': 5,
+    'bp': 6, 'bN': 7, 'bB': 8, 'bR': 9, 'bQ': 10, 'bK': 11}
+
+square_coords = tuple((sq // 8, sq % 8) for sq in range(64))
+
+full_board = (1 << 64) - 1
+
+
+def build_step_table(offsets):
+
+    table = []
+
+    for sq in range(64):
+
+        r, c = square_coords[sq]
+        bits = 0
+
+        for dr, dc in offsets:
+
+            if 0 <= r + dr < 8 and 0 <= c + dc < 8:
+                bits |= 1 << ((r + dr) * 8 + c + dc)
+
+        table.append(bits)
+
+    return tuple(table)
+
+
+def build_ray_table(dr, dc):
+
+    table = []
+
+    for sq in range(64):
+
+        r, c = square_coords[sq]
+        bits = 0
+
+        for i in range(1, 8):
+
+            if 0 <= r + dr * i < 8 and 0 <= c + dc * i < 8:
+                bits |= 1 << ((r + dr * i) * 8 + c + dc * i)
+
+            else:
+                break
+
+        table.append(bits)
+
+    return tuple(table)
+
+
+knight_attacks = build_step_table(((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)))
+king_attacks = build_step_table(((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)))
+
+# squares a pawn of the given colour attacks from each square
+pawn_attacks = {'w': build_step_table(((-1, -1), (-1, 1))), 'b': build_step_table(((1, -1), (1, 1)))}
+
+# rays growing towards higher square numbers use the lowest blocker, the others the highest one
+north = build_ray_table(-1, 0)
+south = build_ray_table(1, 0)
+west = build_ray_table(0, -1)
+east = build_ray_table(0, 1)
+north_west = build_ray_table(-1, -1)
+north_east = build_ray_table(-1, 1)
+south_west = build_ray_table(1, -1)
+south_east = build_ray_table(1, 1)
+
+rook_rays = ((north, False), (south, True), (west, False), (east, True))
+bishop_rays = ((north_west, False), (north_east, False), (south_west, True), (south_east, True))
+
+
+def rook_attacks(sq, occupied):
+
+    attacks = 0
+
+    for ray, positive in rook_rays:
+
+        bits = ray[sq]
+        blockers = bits & occupied
+
+        if blockers:
+            blocker = (blockers & -blockers).bit_length() - 1 if positive else blockers.bit_length() - 1
+            bits ^= ray[blocker]
+
+        attacks |= bits
+
+    return attacks
+
+
+def bishop_attacks(sq, occupied):
+
+    attacks = 0
+
+    for ray, positive in bishop_rays:
+
+        bits = ray[sq]
+        blockers = bits & occupied
+
+        if blockers:
+            blocker = (blockers & -blockers).bit_length() - 1 if positive else blockers.bit_length() - 1
+            bits ^= ray[blocker]
+
+        attacks |= bits
+
+    return attacks
+
+
+def build_between_table():
+
+    table = [[0] * 64 for sq in range(64)]
+
+    for ray, positive in rook_rays + bishop_rays:
+
+        for sq in range(64):
+
+            bits = ray[sq]
+
+            while bits:
+                bit = bits & -bits
+                target = bit.bit_length() - 1
+                bits ^= bit
+                table[sq][target] = ray[sq] ^ ray[target] ^ (1 << target) # squares strictly between
+
+    return table
+
+
+between = build_between_table()
+
+
+class BitboardGameState(GameState):
+
+    def __init__(self, fen = None):
+
+        super().__init__(fen)
+        self.load_bitboards()
+
+
+    # rebuild every set from the board view
+
+    def load_bitboards(self):
+
+        self.bitboards = [0] * 12
+        self.colour_occupancy = {'w': 0, 'b': 0}
+
+        for r in range(8):
+
+            for c in range(8):
+
+                piece = self.board[r][c]
+
+                if piece != '--':
+                    self.bitboards[piece_index[piece]] |= 1 << (r * 8 + c)
+                    self.colour_occupancy[piece[0]] |= 1 << (r * 8 + c)
+
+        self.occupied = self.colour_occupancy['w'] | self.colour_occupancy['b']
+
+
+    def load_fen(self, fen):
+        super().load_fen(fen)
+        self.load_bitboards()
+
+
+    def make_move(self, move):
+        super().make_move(move)
+        self.toggle_move_bits(move)
+
+
+    def undo_move(self):
+
+        if len(self.move_log) != 0:
+            move = self.move_log[-1]
+            super().undo_move()
+            self.toggle_move_bits(move) # xor is its own inverse
+
+
+    # flip the bits a move changes, used for both making and undoing it
+
+    def toggle_move_bits(self, move):
+
+        bitboards = self.bitboards
+        occupancy = self.colour_occupancy
+
+        colour = move.piece_moved[0]
+        start_bit = 1 << (move.start_row * 8 + move.start_col)
+        end_bit = 1 << (move.end_row * 8 + move.end_col)
+
+        bitboards[piece_index[move.piece_moved]] ^= start_bit
+
+        if move.is_pawn_promotion:
+            bitboards[piece_index[colour + move.promotion_choice]] ^= end_bit
+
+        else:
+            bitboards[piece_index[move.piece_moved]] ^= end_bit
+
+        occupancy[colour] ^= start_bit | end_bit
+
+        if move.piece_captured != '--':
+
+            captured_bit = 1 << (move.start_row * 8 + move.end_col) if move.is_en_passant_move else end_bit
+            bitboards[piece_index[move.piece_captured]] ^= captured_bit
+            occupancy[move.piece_captured[0]] ^= captured_bit
+
+        if move.is_castle_move:
+
+            if move.end_col - move.start_col == 2: # kingside, rook h -> f
+                rook_bits = (1 << (move.end_row * 8 + 7)) | (1 << (move.end_row * 8 + 5))
+
+            else: # queenside, rook a -> d
+                rook_bits = (1 << (move.end_row * 8)) | (1 << (move.end_row * 8 + 3))
+
+            bitboards[piece_index[colour + 'R']] ^= rook_bits
+            occupancy[colour] ^= rook_bits
+
+        self.occupied = occupancy['w'] | occupancy['b']
+
+
+    # bitboard of the pieces of colour attacking square sq, with the given occupancy
+
+    def attackers_bitboard(self, sq, colour, occupied):
+
+        bitboards = self.bitboards
+        offset = 0 if colour == 'w' else 6
+        other = 'b' if colour == 'w' else 'w'
+
+        attackers = (knight_attacks[sq] & bitboards[offset + 1]) | (king_attacks[sq] & bitboards[offset + 5]) \
+            | (pawn_attacks[other][sq] & bitboards[offset])
+
+        rooks = bitboards[offset + 3] | bitboards[offset + 4]
+        bishops = bitboards[offset + 2] | bitboards[offset + 4]
+
+        if rooks:
+            attackers |= rook_attacks(sq, occupied) & rooks
+
+        if bishops:
+            attackers |= bishop_attacks(sq, occupied) & bishops
+
+        return attackers
+
+
+    def square_under_attack(self, r, c):
+        enemy_color = 'b' if self.white_to_move else 'w'
+        return self.attackers_bitboard(r * 8 + c, enemy_color, self.occupied) != 0
+
+
+    def attackers_of(self, square, color):
+        bits = self.attackers_bitboard(square[0] * 8 + square[1], color, self.occupied)
+        return [square_coords[sq] for sq in iterate_bits(bits)]
+
+
+    def in_check(self):
+
+        enemy_color = 'b' if self.white_to_move else 'w'
+        king = self.bitboards[5 if self.white_to_move else 11]
+
+        return self.attackers_bitboard(king.bit_length() - 1, enemy_color, self.occupied) != 0
+
+
+    # legal move generation: checkers and pinned pieces are worked out once, so no move has to be played to test it
+
+    def generate_valid_moves(self):
+
+        moves, checkers = self.generate_bitboard_moves(full_board, full_board)
+
+        if len(moves) == 0: # either checkmate or stalemate
+            self.checkmate = checkers != 0
+            self.stalemate = checkers == 0
+
+        else:
+            self.checkmate = False
+            self.stalemate = False
+
+        return moves
+
+
+    # the staged search lists, made from the bitboards like the full list but only for the pieces and targets asked for
+    # like the mailbox versions they leave the checkmate/stalemate flags and the move cache alone
+
+    def get_valid_captures(self):
+        return self.generate_bitboard_moves(full_board, self.colour_occupancy['b' if self.white_to_move else 'w'])[0]
+
+
+    def get_valid_piece_moves(self, r, c):
+        return self.generate_bitboard_moves(1 << (r * 8 + c), full_board)[0]
+
+
+    # (legal moves, checkers) for the pieces on the squares in from_squares. Moves that don't promote only go to squares in
+    # to_squares, so the enemy pieces give just the captures and promotions and a full board every move
+
+    def generate_bitboard_moves(self, from_squares, to_squares):
+
+        moves = []
+        board = self.board
+        bitboards = self.bitboards
+
+        if self.white_to_move:
+            ally_color, enemy_color, offset, enemy_offset = 'w', 'b', 0, 6
+
+        else:
+            ally_color, enemy_color, offset, enemy_offset = 'b', 'w', 6, 0
+
+        allies = self.colour_occupancy[ally_color]
+        enemies = self.colour_occupancy[enemy_color]
+        occupied = self.occupied
+
+        king_bit = bitboards[offset + 5]
+        king_sq = king_bit.bit_length() - 1
+        king_square = square_coords[king_sq]
+
+        checkers = self.attackers_bitboard(king_sq, enemy_color, occupied)
+
+        # pinned pieces and the squares each one may still move along
+        enemy_rooks = bitboards[enemy_offset + 3] | bitboards[enemy_offset + 4]
+        enemy_bishops = bitboards[enemy_offset + 2] | bitboards[enemy_offset + 4]
+        pinned = 0
+        pin_masks = {}
+
+        for rays, sliders in ((rook_rays, enemy_rooks), (bishop_rays, enemy_bishops)):
+
+            for ray, positive in rays:
+
+                bits = ray[king_sq]
+
+                if not bits & sliders:
+                    continue
+
+                blockers = bits & occupied
+
+                if positive:
+                    first = blockers & -blockers
+                    rest = blockers ^ first
+                    second = rest & -rest
+
+                else:
+                    first = 1 << (blockers.bit_length() - 1)
+                    rest = blockers ^ first
+                    second = 1 << (rest.bit_length() - 1) if rest else 0
+
+                if first & allies and second & sliders:
+                    pinned |= first
+                    pin_masks[first.bit_length() - 1] = bits ^ ray[second.bit_length() - 1]
+
+        # king moves
+        if king_bit & from_squares:
+
+            for end_sq in iterate_bits(king_attacks[king_sq] & ~allies & to_squares):
+
+                if not self.attackers_bitboard(end_sq, enemy_color, occupied ^ king_bit):
+                    moves.append(Move(king_square, square_coords[end_sq], board))
+
+        if checkers & (checkers - 1): # double check, only the king can move
+            return moves, checkers
+
+        if checkers:
+            checker_sq = checkers.bit_length() - 1
+            targets = checkers | between[king_sq][checker_sq]
+
+        else:
+            targets = full_board
+
+            if king_bit & from_squares and to_squares == full_board:
+                self.get_bitboard_castle_moves(king_sq, ally_color, enemy_color, occupied, moves)
+
+        # knights, pinned knights can never move
+        for start_sq in iterate_bits(bitboards[offset + 1] & ~pinned & from_squares):
+
+            for end_sq in iterate_bits(knight_attacks[start_sq] & ~allies & targets & to_squares):
+                moves.append(Move(square_coords[start_sq], square_coords[end_sq], board))
+
+        # sliders
+        for index, attacks in ((2, bishop_attacks), (3, rook_attacks), (4, bishop_attacks), (4, rook_attacks)):
+
+            for start_sq in iterate_bits(bitboards[offset + index] & from_squares):
+
+                destinations = attacks(start_sq, occupied) & ~allies & targets & to_squares
+
+                if pinned >> start_sq & 1:
+                    destinations &= pin_masks[start_sq]
+
+                for end_sq in iterate_bits(destinations):
+                    moves.append(Move(square_coords[start_sq], square_coords[end_sq], board))
+
+        self.get_bitboard_pawn_moves(offset, ally_color, king_sq, enemies, occupied, targets, pinned, pin_masks, from_squares,
+            to_squares, moves)
+
+        return moves, checkers
+
+
+    # pushes that don't promote only go to squares in to_squares, captures and promotions always count
+
+    def get_bitboard_pawn_moves(self, offset, ally_color, king_sq, enemies, occupied, targets, pinned, pin_masks, from_squares, to_squares, moves):
+
+        board = self.board
+        step, start_row = (-8, 6) if ally_color == 'w' else (8, 1)
+        pushes = to_squares | (0xFF if ally_color == 'w' else 0xFF << 56) # the last rank, pushing there promotes
+
+        if self.en_passant_possible:
+            en_passant_sq = self.en_passant_possible[0] * 8 + self.en_passant_possible[1]
+            en_passant_bit = 1 << en_passant_sq
+
+        else:
+            en_passant_sq = -1
+            en_passant_bit = 0
+
+        for start_sq in iterate_bits(self.bitboards[offset] & from_squares):
+
+            allowed = targets
+
+            if pinned >> start_sq & 1:
+                allowed &= pin_masks[start_sq]
+
+            start = square_coords[start_sq]
+            one_step = start_sq + step
+
+            if not occupied >> one_step & 1: # 1 square move
+
+                if (allowed & pushes) >> one_step & 1:
+                    self.add_pawn_move(start, square_coords[one_step], moves)
+
+                two_steps = one_step + step
+
+                if start[0] == start_row and not occupied >> two_steps & 1 and (allowed & to_squares) >> two_steps & 1: # 2 square move
+                    moves.append(Move(start, square_coords[two_steps], board))
+
+            for end_sq in iterate_bits(pawn_attacks[ally_color][start_sq] & enemies & allowed):
+                self.add_pawn_move(start, square_coords[end_sq], moves)
+
+            if pawn_attacks[ally_color][start_sq] & en_passant_bit:
+
+                captured_sq = en_passant_sq - step
+
+                # the move has to resolve any check, by capturing the checker or blocking
+                if not (en_passant_bit | (1 << captured_sq)) & targets:
+                    continue
+
+                # both pawns leave the rank at once, so test the king against sliders directly
+                after = occupied ^ (1 << start_sq) ^ (1 << captured_sq) ^ en_passant_bit
+                enemy_offset = 6 - offset
+                rooks = self.bitboards[enemy_offset + 3] | self.bitboards[enemy_offset + 4]
+                bishops = self.bitboards[enemy_offset + 2] | self.bitboards[enemy_offset + 4]
+
+                if rook_attacks(king_sq, after) & rooks or bishop_attacks(king_sq, after) & bishops:
+                    continue
+
+                moves.append(Move(start, square_coords[en_passant_sq], board, is_en_passant_move = True))
+
+
+    def get_bitboard_castle_moves(self, king_sq, ally_color, enemy_color, occupied, moves):
+
+        row = 7 if ally_color == 'w' else 0
+        rooks = self.bitboards[piece_index[ally_color + 'R']]
+
+        if king_sq != row * 8 + 4:
+            return
+
+        kingside = self.castle_rights & (white_kingside if ally_color == 'w' else black_kingside)
+        queenside = self.castle_rights & (white_queenside if ally_color == 'w' else black_queenside)
+
+        if kingside and rooks >> (row * 8 + 7) & 1 and not occupied & (0b11 << (row * 8 + 5)):
+
+            if not self.attackers_bitboard(row * 8 + 5, enemy_color, occupied) and not self.attackers_bitboard(row * 8 + 6, enemy_color, occupied):
+                moves.append(Move(square_coords[king_sq], (row, 6), self.board, is_castle_move = True))
+
+        if queenside and rooks >> (row * 8) & 1 and not occupied & (0b111 << (row * 8 + 1)):
+
+            if not self.attackers_bitboard(row * 8 + 3, enemy_color, occupied) and not self.attackers_bitboard(row * 8 + 2, enemy_color, occupied):
+                moves.append(Move(square_coords[king_sq], (row, 2), self.board, is_castle_move = True))
+
+
+# yields the square number of every set bit, lowest first
+
+def iterate_bits(bits):
+
+    while bits:
+        bit = bits & -bits
+        yield bit.bit_length() - 1
+        bits ^= bit
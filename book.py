@@ -0,0 +1,188 @@
+"""
+Opening book: a sorted file of 16 byte entries, looked up by binary search over a read only memory map. Entries use the Polyglot layout (key, move, weight, learn) with GameState's own Zobrist key and Move.packed, so the book isn't read into Python objects and processes opening the same file share its pages.
+"""
+
+import argparse, mmap, os, random, struct, sys
+
+import engine, pgn
+
+
+entry_struct = struct.Struct('>QHHI') # key, move, weight, learn (unused, 0), big endian like Polyglot
+entry_size = entry_struct.size
+
+
+class Opening_Book():
+
+    def __init__(self, path):
+
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+
+        if size % entry_size:
+            self.file.close()
+            raise ValueError("%s isn't a book, its size isn't a multiple of %d bytes" % (path, entry_size))
+
+        self.count = size // entry_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ) if size else b''
+
+
+    def close(self):
+
+        if self.count:
+            self.data.close()
+
+        self.file.close()
+
+
+    # [(packed move, weight)] stored for the key, binary search for the first entry with it then read on
+
+    def entries(self, key):
+
+        low, high = 0, self.count
+
+        while low < high:
+
+            middle = (low + high) // 2
+
+            if entry_struct.unpack_from(self.data, middle * entry_size)[0] < key:
+                low = middle + 1
+
+            else:
+                high = middle
+
+        found = []
+
+        while low < self.count:
+
+            entry_key, move, weight, learn = entry_struct.unpack_from(self.data, low * entry_size)
+
+            if entry_key != key:
+                break
+
+            found.append((move, weight))
+            low += 1
+
+        return found
+
+
+    # [(Move, weight)] for the book moves legal in gs, moves from a colliding key are dropped
+
+    def probe(self, gs):
+
+        entries = self.entries(gs.zobrist_key)
+
+        if not entries: # out of book costs only the search, no move generation
+            return []
+
+        legal = {move.packed: move for move in gs.get_valid_moves()}
+
+        return [(legal[packed], weight) for packed, weight in entries if packed in legal]
+
+
+    # a book move for gs, picked at random in proportion to the weights, or the heaviest with best. None when out of book
+
+    def choose(self, gs, best = False, rng = random):
+
+        moves = [(move, weight) for move, weight in self.probe(gs) if weight > 0]
+
+        if not moves:
+            return None
+
+        if best:
+            return max(moves, key = lambda entry: entry[1])[0]
+
+        pick = rng.randrange(sum(weight for move, weight in moves))
+
+        for move, weight in moves:
+
+            pick -= weight
+
+            if pick < 0:
+                return move
+
+
+# books opened by path, each process maps a file once and keeps it for later searches
+
+open_books = {}
+
+def open_book(path):
+
+    if path not in open_books:
+        open_books[path] = Opening_Book(path)
+
+    return open_books[path]
+
+
+# writes a book from the first plies of every game in a PGN source (see pgn.read_games)
+# a move scores 2 for each game its side won and 1 for each draw, moves under min_weight are left out
+# returns the number of entries written
+
+def build_book(source, path, plies = 20, min_weight = 1):
+
+    weights = {}
+
+    for game in pgn.read_games(source):
+
+        try:
+            gs = engine.GameState(game.start_fen())
+
+        except ValueError:
+            continue
+
+        for san in game.moves[:plies]:
+
+            try:
+                move = gs.parse_san(san)
+
+            except ValueError:
+                break
+
+            if game.result == '1/2-1/2':
+                score = 1
+
+            elif game.result == ('1-0' if gs.white_to_move else '0-1'):
+                score = 2
+
+            else:
+                score = 0
+
+            entry = (gs.zobrist_key, move.packed)
+            weights[entry] = weights.get(entry, 0) + score
+            gs.make_move(move)
+
+    entries = sorted((key, -weight, move) for (key, move), weight in weights.items() if weight >= min_weight)
+
+    with open(path, 'wb') as file:
+
+        for key, weight, move in entries:
+            file.write(entry_struct.pack(key, move, min(-weight, 0xFFFF), 0))
+
+    return len(entries)
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Build an opening book from PGN, or list the book moves for a position.")
+    parser.add_argument("book")
+    parser.add_argument("--build", default = None, help = "PGN file to build the book from")
+    parser.add_argument("--plies", type = int, default = 20, help = "plies of each game to take")
+    parser.add_argument("--min-weight", type = int, default = 1)
+    parser.add_argument("--fen", default = None, help = "position to look up, defaults to the start position")
+    args = parser.parse_args(argv)
+
+    if args.build:
+        print("%d entries written to %s" % (build_book(args.build, args.book, args.plies, args.min_weight), args.book))
+        return 0
+
+    book = open_book(args.book)
+    gs = engine.GameState(args.fen)
+
+    for move, weight in sorted(book.probe(gs), key = lambda entry: -entry[1]):
+        print("%-8s %-6s %d" % (gs.get_san(move), move.get_uci_notation(), weight))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
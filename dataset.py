@@ -0,0 +1,363 @@
+"""
+Training data files of packed positions. A position packs into 32 bytes, four bits a square, with the side to move, castling rights and en passant folded into three special square codes. Files are append only: a header, then fixed size records, with the record each game starts at kept in an index file beside it. Reading maps the file and gives NumPy views of the records, so nothing is loaded into memory until it's used.
+"""
+
+import argparse, functools, mmap, os, struct, sys
+
+import numpy as np
+
+import engine, pgn
+from evaluation import evaluate
+from search import Search_Limits, Searcher
+from transposition import Transposition_Table
+
+
+# square codes 1-12 are engine.piece_codes, 0 an empty square. The special codes are pieces whose colour follows from
+# where they stand:
+en_passant_pawn = 13 # a pawn that has just moved two squares, white on the 4th rank and black on the 5th
+castling_rook = 14 # a rook on its corner that can still castle, white on the 1st rank and black on the 8th
+black_king_to_move = 15 # the black king when black is to move, there's no white to move marker
+
+position_size = 32
+
+# corner square -> castling right its rook carries
+castling_corners = {63: engine.white_kingside, 56: engine.white_queenside, 7: engine.black_kingside, 0: engine.black_queenside}
+
+header_struct = struct.Struct('<8sHHIQQ32x') # magic, version, record size, reserved, records, games
+header_size = header_struct.size
+magic = b'CHESSPOS'
+version = 1
+
+# a record is a packed position, the score for the side to move in centipawns, the game result and the halfmove clock
+record_dtype = np.dtype([('position', np.uint8, position_size), ('score', '<i2'), ('result', np.int8), ('halfmove', np.uint8)])
+record_size = record_dtype.itemsize
+record_struct = struct.Struct('<32shbB')
+
+results = {'1-0': 1, '1/2-1/2': 0, '0-1': -1} # from white's point of view, anything else is stored as unknown_result
+unknown_result = -128
+
+# square code -> batch plane number at each square (see batch.py), 12 for an empty square and 255 where the code can't stand
+plane_table = np.full((16, 64), 255, np.uint8)
+plane_table[0] = 12
+plane_table[1:13] = np.arange(12, dtype = np.uint8)[:, None]
+plane_table[en_passant_pawn, 32:40] = 0 # white pawn on the 4th rank
+plane_table[en_passant_pawn, 24:32] = 6 # black pawn on the 5th
+plane_table[castling_rook, [56, 63]] = 3
+plane_table[castling_rook, [0, 7]] = 9
+plane_table[black_king_to_move] = 11
+
+
+# 32 bytes for the board, side to move, castling rights and en passant square of gs
+
+def pack_position(gs):
+
+    codes = [engine.piece_code[piece] for row in gs.board for piece in row]
+
+    for sq, right in castling_corners.items():
+
+        if gs.castle_rights & right:
+            codes[sq] = castling_rook
+
+    if gs.en_passant_possible:
+        row, col = gs.en_passant_possible
+        codes[(row - 1 if row == 5 else row + 1) * 8 + col] = en_passant_pawn # the pawn stands beyond the square it skipped
+
+    if not gs.white_to_move:
+        codes[codes.index(engine.piece_code['bK'])] = black_king_to_move
+
+    return bytes([codes[i] | codes[i + 1] << 4 for i in range(0, 64, 2)])
+
+
+# the FEN for a packed position, the move counters aren't packed and come from the arguments
+
+def unpack_fen(data, halfmove_clock = 0, fullmove_number = 1):
+
+    pieces = []
+    castling = ''
+    en_passant = '-'
+    white_to_move = True
+    corner_letters = {63: 'K', 56: 'Q', 7: 'k', 0: 'q'}
+
+    for i in range(position_size):
+
+        for sq, code in ((2 * i, data[i] & 15), (2 * i + 1, data[i] >> 4)):
+
+            if code == en_passant_pawn:
+                code = engine.piece_code['wp' if sq >= 32 else 'bp']
+                en_passant = 'abcdefgh'[sq % 8] + ('3' if sq >= 32 else '6')
+
+            elif code == castling_rook:
+                code = engine.piece_code['wR' if sq >= 56 else 'bR']
+                castling += corner_letters[sq]
+
+            elif code == black_king_to_move:
+                code = engine.piece_code['bK']
+                white_to_move = False
+
+            pieces.append(engine.piece_codes[code])
+
+    rows = []
+
+    for r in range(8):
+
+        row = ''
+        empty = 0
+
+        for piece in pieces[r * 8:r * 8 + 8]:
+
+            if piece == '--':
+                empty += 1
+                continue
+
+            if empty:
+                row += str(empty)
+                empty = 0
+
+            row += piece[1].upper() if piece[0] == 'w' else piece[1].lower()
+
+        rows.append(row + (str(empty) if empty else ''))
+
+    castling = ''.join(sorted(castling, key = 'KQkq'.index)) or '-'
+
+    return "%s %s %s %s %d %d" % ('/'.join(rows), 'w' if white_to_move else 'b', castling, en_passant, halfmove_clock, fullmove_number)
+
+
+def unpack_position(data, halfmove_clock = 0, fullmove_number = 1):
+    return engine.GameState(unpack_fen(data, halfmove_clock, fullmove_number))
+
+
+# appends records to a position file, creating it with its header first. Reopening an existing file carries on at its end
+# the header counts are brought up to date by close, readers go by the file size so a file that wasn't closed still reads
+
+class Position_Writer():
+
+    def __init__(self, path):
+
+        self.path = path
+        exists = os.path.exists(path) and os.path.getsize(path) >= header_size
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        self.index = open(path + '.idx', 'ab')
+
+        if exists:
+            self.records, games = read_header(self.file, os.path.getsize(path))
+            self.games = os.path.getsize(path + '.idx') // 8
+            self.file.seek(header_size + self.records * record_size)
+            self.file.truncate() # drops a record cut short by a crash
+
+        else:
+            self.records = 0
+            self.games = 0
+            self.file.write(header_struct.pack(magic, version, record_size, 0, 0, 0))
+
+
+    # the following records belong to a new game
+
+    def start_game(self):
+
+        self.index.write(struct.pack('<Q', self.records))
+        self.games += 1
+
+
+    # score is for the side to move, result '1-0', '0-1', '1/2-1/2' or anything else for unknown
+
+    def append(self, gs, score = 0, result = None):
+        self.write(pack_position(gs), score, results.get(result, unknown_result), gs.halfmove_clock)
+
+
+    def write(self, position, score, result, halfmove_clock):
+
+        self.file.write(record_struct.pack(position, max(-32768, min(32767, score)), result, min(halfmove_clock, 255)))
+        self.records += 1
+
+
+    # records already packed, as bytes from encode_game
+
+    def write_packed(self, data):
+
+        self.file.write(data)
+        self.records += len(data) // record_size
+
+
+    def close(self):
+
+        self.file.seek(0)
+        self.file.write(header_struct.pack(magic, version, record_size, 0, self.records, self.games))
+        self.file.close()
+        self.index.close()
+
+
+# (records, games) from the header of an open position file, the record count from the file size
+# raises ValueError on a file of another kind or version
+
+def read_header(file, size):
+
+    file.seek(0)
+    file_magic, file_version, file_record_size, reserved, records, games = header_struct.unpack(file.read(header_size))
+
+    if file_magic != magic or file_version != version or file_record_size != record_size:
+        raise ValueError("%s isn't a version %d position file" % (file.name, version))
+
+    return (size - header_size) // record_size, games
+
+
+class Position_File():
+
+    def __init__(self, path):
+
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.count, games = read_header(self.file, size)
+        self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        # zero copy views, indexing them only touches the pages it needs
+        self.records = np.frombuffer(self.data, record_dtype, self.count, header_size)
+        self.positions = self.records['position']
+        self.scores = self.records['score']
+        self.results = self.records['result']
+
+        index_path = path + '.idx'
+        self.game_starts = np.fromfile(index_path, '<u8') if os.path.exists(index_path) else np.zeros(0, np.uint64)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def game_state(self, i):
+        return unpack_position(self.positions[i].tobytes(), int(self.records['halfmove'][i]))
+
+
+    # record numbers of game g's positions
+
+    def game_records(self, g):
+
+        end = self.game_starts[g + 1] if g + 1 < len(self.game_starts) else self.count
+
+        return range(int(self.game_starts[g]), int(end))
+
+
+    # (codes (N, 64) uint8, white_to_move (N,) bool) for records start to stop, in the layout batch.square_codes gives,
+    # so the batch functions can score them. Done in one go with NumPy, no position is unpacked in Python
+
+    def square_codes(self, start = 0, stop = None):
+
+        packed = self.positions[start:stop]
+        codes = np.empty((len(packed), 64), np.uint8)
+        codes[:, 0::2] = packed & 15
+        codes[:, 1::2] = packed >> 4
+
+        white_to_move = ~(codes == black_king_to_move).any(axis = 1)
+
+        return plane_table[codes, np.arange(64)], white_to_move
+
+
+    # planes like batch.encode_positions gives them, (N, 12, 8, 8) uint8
+
+    def planes(self, start = 0, stop = None):
+
+        codes, white_to_move = self.square_codes(start, stop)
+        planes = (codes[:, None, :] == np.arange(12, dtype = np.uint8)[None, :, None]).view(np.uint8)
+
+        return planes.reshape(len(codes), 12, 8, 8), white_to_move
+
+
+    def close(self):
+
+        self.positions = self.scores = self.results = self.records = None # the views have to go before the map can close
+        self.data.close()
+        self.file.close()
+
+
+# runs in a worker process: the records for every position of a game from its (skip_plies + 1)th on, as bytes
+# each position is scored by a search to depth, or by the static evaluation with depth 0. A game with an illegal move stops there
+
+def encode_game(game, skip_plies = 0, depth = 0):
+
+    try:
+        gs = engine.GameState(game.start_fen())
+
+    except ValueError:
+        return b''
+
+    result = results.get(game.result, unknown_result)
+    table = Transposition_Table(4) if depth else None
+    records = []
+
+    for ply in range(len(game.moves) + 1):
+
+        if ply >= skip_plies:
+
+            score = Searcher(gs, Search_Limits(depth), table).search().score if depth else evaluate(gs)
+            records.append(record_struct.pack(pack_position(gs), max(-32768, min(32767, score)), result, min(gs.halfmove_clock, 255)))
+
+        if ply == len(game.moves):
+            break
+
+        try:
+            gs.make_move(gs.parse_san(game.moves[ply]))
+
+        except ValueError:
+            break
+
+    return b''.join(records)
+
+
+# streams the games in a PGN source into a position file, workers games at a time, returns (games, positions) written
+
+def export_games(source, path, skip_plies = 0, depth = 0, workers = 1, out = sys.stdout):
+
+    writer = Position_Writer(path)
+    games = positions = 0
+    encode = functools.partial(encode_game, skip_plies = skip_plies, depth = depth)
+
+    try:
+
+        for game, data in pgn.map_games(encode, pgn.read_games(source), workers):
+
+            if not data:
+                continue
+
+            writer.start_game()
+            writer.write_packed(data)
+            games += 1
+            positions += len(data) // record_size
+
+            if games % 10000 == 0:
+                out.write("%d games, %d positions\n" % (games, positions))
+
+    finally:
+        writer.close()
+
+    return games, positions
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Export positions from PGN to a packed training data file, or show what a file holds.")
+    parser.add_argument("path")
+    parser.add_argument("--export", default = None, help = "PGN file to append the positions of")
+    parser.add_argument("--skip-plies", type = int, default = 0, help = "opening plies of each game to leave out")
+    parser.add_argument("--depth", type = int, default = 0, help = "search depth for the scores, 0 for the static evaluation")
+    parser.add_argument("--workers", type = int, default = 1)
+    parser.add_argument("--show", type = int, default = 5, help = "positions to print")
+    args = parser.parse_args(argv)
+
+    if args.export:
+        games, positions = export_games(args.export, args.path, args.skip_plies, args.depth, args.workers)
+        print("%d games, %d positions appended to %s" % (games, positions, args.path))
+        return 0
+
+    data = Position_File(args.path)
+    print("%d positions from %d games, %d bytes each" % (len(data), len(data.game_starts), record_size))
+
+    for i in range(min(args.show, len(data))):
+        print("%-80s %6d %4d" % (data.game_state(i).get_fen(), data.scores[i], data.results[i]))
+
+    data.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
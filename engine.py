@@ -2,9 +2,95 @@
 Class responsible for storing all the information about the current state, determining the legal moves and keeping a moves log.
 """
 
+import random, re, time
+from collections import OrderedDict
+
+from evaluation import mg_table, eg_table, phase_table, compute_scores
+
+
+# up, left, down, right, then the four diagonals
+directions = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1))
+
+
+# Move tables, built once on import
+# knight_table[r][c] and king_table[r][c] hold the on board destinations from r, c
+# ray_table[r][c][j] holds the squares in directions[j], nearest first
+
+def build_move_tables():
+
+    knight_offsets = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+
+    knight_table = [[None] * 8 for r in range(8)]
+    king_table = [[None] * 8 for r in range(8)]
+    ray_table = [[None] * 8 for r in range(8)]
+
+    for r in range(8):
+
+        for c in range(8):
+
+            knight_table[r][c] = tuple((r + d[0], c + d[1]) for d in knight_offsets if 0 <= r + d[0] < 8 and 0 <= c + d[1] < 8)
+            king_table[r][c] = tuple((r + d[0], c + d[1]) for d in directions if 0 <= r + d[0] < 8 and 0 <= c + d[1] < 8)
+
+            rays = []
+
+            for d in directions:
+
+                ray = []
+                end_row, end_col = r + d[0], c + d[1]
+
+                while 0 <= end_row < 8 and 0 <= end_col < 8:
+                    ray.append((end_row, end_col))
+                    end_row += d[0]
+                    end_col += d[1]
+
+                rays.append(tuple(ray))
+
+            ray_table[r][c] = tuple(rays)
+
+    return knight_table, king_table, ray_table
+
+
+table_build_start = time.perf_counter()
+knight_table, king_table, ray_table = build_move_tables()
+table_build_time = time.perf_counter() - table_build_start # seconds, kept small since short lived workers import the engine
+
+
+# castling right bits, GameState.castle_rights holds the ones still available
+
+white_kingside, white_queenside, black_kingside, black_queenside = 1, 2, 4, 8
+
+# rights kept by a move starting or ending on a square: a king or rook leaving, or a rook being captured, drops them
+castle_masks = [[15] * 8 for r in range(8)]
+castle_masks[7][4] = 15 & ~(white_kingside | white_queenside)
+castle_masks[7][7] = 15 & ~white_kingside
+castle_masks[7][0] = 15 & ~white_queenside
+castle_masks[0][4] = 15 & ~(black_kingside | black_queenside)
+castle_masks[0][7] = 15 & ~black_kingside
+castle_masks[0][0] = 15 & ~black_queenside
+
+# piece codes used in undo records, 0 is an empty square
+piece_codes = ('--', 'wp', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bp', 'bN', 'bB', 'bR', 'bQ', 'bK')
+piece_code = {piece: i for i, piece in enumerate(piece_codes)}
+score_offset = 1 << 19 # evaluation scores are stored in undo records as 20 bit unsigned fields
+
+# SAN: piece, from file, from rank, capture, target square, promotion piece
+san_pattern = re.compile(r'^([NBRQK])?([a-h])?([1-8])?(x)?([a-h][1-8])(?:=?([QRBN]))?$')
+
+
+# Zobrist keys, seeded so every process gets the same keys
+# zobrist_pieces[piece][r][c], zobrist_castling[castle rights], zobrist_en_passant[col]
+
+zobrist_random = random.Random(0x5EED)
+zobrist_pieces = {piece: [[zobrist_random.getrandbits(64) for c in range(8)] for r in range(8)]
+    for piece in ('wp', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bp', 'bN', 'bB', 'bR', 'bQ', 'bK')}
+zobrist_castling = [zobrist_random.getrandbits(64) for i in range(16)]
+zobrist_en_passant = [zobrist_random.getrandbits(64) for c in range(8)]
+zobrist_black_to_move = zobrist_random.getrandbits(64)
+
+
 class GameState():
 
-    def __init__(self):
+    def __init__(self, fen = None):
 
         # Board
         self.board = [
@@ -20,22 +106,78 @@ class GameState():
         self.move_functions = {'p': self.get_pawn_moves, 'R': self.get_rook_moves, 'N': self.get_knight_moves, 
             'B': self.get_bishop_moves, 'Q': self.get_queen_moves, 'K': self.get_king_moves}
 
+        # captures only, plus pawn pushes that promote, see get_valid_captures
+        self.capture_functions = {'p': self.get_pawn_captures_and_promotions, 'R': self.get_rook_captures, 'N': self.get_knight_captures,
+            'B': self.get_bishop_captures, 'Q': self.get_queen_captures, 'K': self.get_king_captures}
+
         self.white_to_move = True
         self.move_log = []
+        self.start_ply = 0 # plies played before the move log starts, for the full move number
         self.white_king_location = (7, 4)
         self.black_king_location = (0, 4)
         self.checkmate = False
         self.stalemate = False
+        self.draw_by_repetition = False # the position has come up three times, set by get_valid_moves like checkmate and stalemate
+        self.draw_by_fifty_moves = False # a hundred plies without a capture or pawn move
+        self.pins = {} # pinned pieces of the side to move, found by get_valid_moves
+        self.checks = []
         self.en_passant_possible = () # coordinates for the square where en passant capture is possible
-        self.current_castling_right = Castle_Rights(True, True, True, True)
-        self.castle_rights_log = [Castle_Rights(self.current_castling_right.wks, self.current_castling_right.bks,   self.current_castling_right.wqs, self.current_castling_right.bqs)]
+        self.castle_rights = white_kingside | white_queenside | black_kingside | black_queenside
+        self.halfmove_clock = 0 # plies since the last capture or pawn move
+        self.tablebases = None # a tablebase.Tablebases for probe_tablebase
+        self.move_cache = None # a Move_Cache for get_valid_moves, None generates every time
+
+        # position key, updated by make_move and restored by undo_move
+        self.zobrist_key = self.compute_zobrist_key()
+        self.debug_zobrist = False # check the key and evaluation scores against a full recomputation after every make/undo
+
+        # evaluation scores, updated by make_move and restored by undo_move, see evaluation.py
+        self.mg_score, self.eg_score, self.phase = compute_scores(self.board)
+
+        # one int per ply holding what undo_move can't work out from the move itself:
+        # castling bits 0-3, en passant col + 1 bits 4-7, captured piece code bits 8-11, halfmove clock bits 12-23, key bits 24-87,
+        # mg score bits 88-107, eg score bits 108-127, phase from bit 128
+        self.undo_stack = []
+
+        if fen is not None:
+            self.load_fen(fen)
 
 
     def make_move(self, move):
+
+        en_passant_col = self.en_passant_possible[1] + 1 if self.en_passant_possible else 0
+        en_passant_keyed = self.en_passant_capture() # looked at before the board changes
+
         self.board[move.start_row][move.start_col] = "--"
         self.board[move.end_row][move.end_col] = move.piece_moved
         self.move_log.append(move)
         self.white_to_move = not self.white_to_move # swap turns
+
+        self.undo_stack.append(self.castle_rights | en_passant_col << 4 | piece_code[move.piece_captured] << 8 |
+            min(self.halfmove_clock, 4095) << 12 | self.zobrist_key << 24 | (self.mg_score + score_offset) << 88 |
+            (self.eg_score + score_offset) << 108 | self.phase << 128)
+
+        if move.piece_moved[1] == 'p' or move.piece_captured != '--':
+            self.halfmove_clock = 0
+
+        else:
+            self.halfmove_clock += 1
+
+        # take out the old castling rights and en passant file, they are put back in once updated
+        key = self.zobrist_key ^ zobrist_black_to_move ^ zobrist_castling[self.castle_rights]
+
+        if en_passant_keyed:
+            key ^= zobrist_en_passant[en_passant_col - 1]
+
+        key ^= zobrist_pieces[move.piece_moved][move.start_row][move.start_col]
+
+        if move.piece_captured != '--':
+
+            if move.is_en_passant_move:
+                key ^= zobrist_pieces[move.piece_captured][move.start_row][move.end_col]
+
+            else:
+                key ^= zobrist_pieces[move.piece_captured][move.end_row][move.end_col]
         
         # update king location if moved
         if move.piece_moved == 'wK':
@@ -46,7 +188,7 @@ class GameState():
 
         # pawn promotion
         if move.is_pawn_promotion:
-            self.board[move.end_row][move.end_col] = move.piece_moved[0] + 'Q'
+            self.board[move.end_row][move.end_col] = move.piece_moved[0] + move.promotion_choice
 
         # en passant move
         if move.is_en_passant_move:
@@ -72,8 +214,46 @@ class GameState():
 
         # update castling rights - whenever it's a king or rook move
         self.update_castle_rights(move)
-        self.castle_rights_log.append(Castle_Rights(self.current_castling_right.wks, self.current_castling_right.bks, 
-        self.current_castling_right.wqs, self.current_castling_right.bqs))
+
+        # the moved piece as it landed, a promoted pawn lands as the new piece
+        landed = self.board[move.end_row][move.end_col]
+        key ^= zobrist_pieces[landed][move.end_row][move.end_col]
+
+        # evaluation scores, the captured piece is '--' for quiet moves and scores 0
+        capture_row = move.start_row if move.is_en_passant_move else move.end_row
+
+        mg = self.mg_score + mg_table[landed][move.end_row][move.end_col] - mg_table[move.piece_moved][move.start_row][move.start_col] - \
+            mg_table[move.piece_captured][capture_row][move.end_col]
+        eg = self.eg_score + eg_table[landed][move.end_row][move.end_col] - eg_table[move.piece_moved][move.start_row][move.start_col] - \
+            eg_table[move.piece_captured][capture_row][move.end_col]
+        self.phase += phase_table[landed] - phase_table[move.piece_moved] - phase_table[move.piece_captured]
+
+        if move.is_castle_move:
+
+            rook = move.piece_moved[0] + 'R'
+            row = move.end_row
+
+            if move.end_col - move.start_col == 2: # rook h -> f
+                key ^= zobrist_pieces[rook][row][7] ^ zobrist_pieces[rook][row][5]
+                mg += mg_table[rook][row][5] - mg_table[rook][row][7]
+                eg += eg_table[rook][row][5] - eg_table[rook][row][7]
+
+            else: # rook a -> d
+                key ^= zobrist_pieces[rook][row][0] ^ zobrist_pieces[rook][row][3]
+                mg += mg_table[rook][row][3] - mg_table[rook][row][0]
+                eg += eg_table[rook][row][3] - eg_table[rook][row][0]
+
+        self.mg_score = mg
+        self.eg_score = eg
+
+        if self.en_passant_capture():
+            key ^= zobrist_en_passant[self.en_passant_possible[1]]
+
+        self.zobrist_key = key ^ zobrist_castling[self.castle_rights]
+
+        if self.debug_zobrist:
+            self.check_zobrist_key()
+            self.check_scores()
 
 
 
@@ -83,9 +263,11 @@ class GameState():
         if len(self.move_log) != 0: # make sure move log not empty
 
             move = self.move_log.pop()
+            record = self.undo_stack.pop()
+            piece_captured = piece_codes[record >> 8 & 15]
 
             self.board[move.start_row][move.start_col] = move.piece_moved
-            self.board[move.end_row][move.end_col] = move.piece_captured
+            self.board[move.end_row][move.end_col] = piece_captured
             self.white_to_move = not self.white_to_move # swap turns back
 
             # update king location if needed
@@ -98,19 +280,23 @@ class GameState():
             # undo en passant move
             if move.is_en_passant_move:
                 self.board[move.end_row][move.end_col] = '--' # leave landing square blank
-                self.board[move.start_row][move.end_col] = move.piece_captured
-                self.en_passant_possible = (move.end_row, move.end_col)
+                self.board[move.start_row][move.end_col] = piece_captured
+
+            # castling rights, en passant square, halfmove clock and key from before the move
+            self.castle_rights = record & 15
+            en_passant_col = record >> 4 & 15
 
-            # undo a 2 squares pawn advance
-            if move.piece_moved[1] == 'p' and abs(move.start_row - move.end_row) == 2:
+            if en_passant_col: # the en passant square is behind a pawn of the side that isn't moving
+                self.en_passant_possible = (2 if self.white_to_move else 5, en_passant_col - 1)
+
+            else:
                 self.en_passant_possible = ()
 
-            # undo castling rights
-            self.castle_rights_log.pop()
-            self.current_castling_right.wks = self.castle_rights_log[-1].wks
-            self.current_castling_right.wqs = self.castle_rights_log[-1].wqs
-            self.current_castling_right.bks = self.castle_rights_log[-1].bks
-            self.current_castling_right.bqs = self.castle_rights_log[-1].bqs
+            self.halfmove_clock = record >> 12 & 4095
+            self.zobrist_key = record >> 24 & 0xFFFFFFFFFFFFFFFF
+            self.mg_score = (record >> 88 & 0xFFFFF) - score_offset
+            self.eg_score = (record >> 108 & 0xFFFFF) - score_offset
+            self.phase = record >> 128
  
             # undo castle move
             if move.is_castle_move:
@@ -123,379 +309,1257 @@ class GameState():
                     self.board[move.end_row][move.end_col-2] = self.board[move.end_row][move.end_col+1]
                     self.board[move.end_row][move.end_col+1] = '--'
 
+            if self.debug_zobrist:
+                self.check_zobrist_key()
+                self.check_scores()
 
 
-    def update_castle_rights(self, move):
+    # set up the position described by a FEN string, clearing the move log
+    # raises ValueError on a FEN that doesn't describe a position, the game state is only changed once the whole FEN has been read
 
-        if move.piece_moved == 'wK':
-            self.current_castling_right.wks = False
-            self.current_castling_right.wqs = False
-        
-        elif move.piece_moved == 'bK':
-            self.current_castling_right.bks = False
-            self.current_castling_right.bqs = False
+    def load_fen(self, fen):
 
-        elif move.piece_moved == 'wR':
+        fields = fen.split()
 
-            if move.start_row == 7:
+        if len(fields) < 4 or len(fields) > 6:
+            raise ValueError("FEN needs 4 to 6 fields: " + fen)
 
-                if move.start_col == 0: # queen's side
-                    self.current_castling_right.wqs = False
-                
-                elif move.start_col == 7: #  king's side
-                    self.current_castling_right.wks = False
+        rows = fields[0].split('/')
 
-        elif move.piece_moved == 'bR':
+        if len(rows) != 8:
+            raise ValueError("FEN board needs 8 rows: " + fen)
 
-            if move.start_row == 0:
+        board = []
+        kings = {}
 
-                if move.start_col == 0: # queen's side
-                    self.current_castling_right.bqs = False
-                
-                elif move.start_col == 7: #  king's side
-                    self.current_castling_right.bks = False
+        for r in range(8):
 
+            row = []
 
-    # Considering checks
-    
-    def get_valid_moves(self):
+            for char in rows[r]:
 
-        temp_en_passant_possible = self.en_passant_possible
-        temp_castle_rights = Castle_Rights(self.current_castling_right.wks, self.current_castling_right.bks, 
-        self.current_castling_right.wqs, self.current_castling_right.bqs) # copy current castling rights
+                if char in '12345678':
+                    row.extend(['--'] * int(char))
 
-        # generate all possible moves
-        moves = self.get_all_possible_moves()
+                elif char in 'PRNBQKprnbqk':
 
-        if self.white_to_move:
-            self.get_castle_moves(self.white_king_location[0], self.white_king_location[1], moves)
+                    piece = ('w' if char.isupper() else 'b') + (char.upper() if char.lower() != 'p' else 'p')
 
-        else:
-            self.get_castle_moves(self.black_king_location[0], self.black_king_location[1], moves)
+                    if piece[1] == 'p' and (r == 0 or r == 7):
+                        raise ValueError("pawn on the first or last rank: " + fen)
 
+                    if piece[1] == 'K':
+                        kings.setdefault(piece, []).append((r, len(row)))
 
-        # for each move, make the move
-        for i in range(len(moves)-1, -1, -1): # when removing an element from a list go backwards
-            
-            self.make_move(moves[i])
+                    row.append(piece)
 
-            # generate all oppostion moves
-            # for each of your opponents moves see if they attack your king
-            self.white_to_move = not self.white_to_move 
+                else:
+                    raise ValueError("bad FEN piece %s: %s" % (char, fen))
 
-            if self.in_check():
-                moves.remove(moves[i]) # if they attack your king not a valid move
-            
-            self.white_to_move = not self.white_to_move
-            self.undo_move()
+            if len(row) != 8:
+                raise ValueError("FEN row %d doesn't have 8 squares: %s" % (r + 1, fen))
 
-        if len(moves) == 0: # either checkmate or stalemate
+            board.append(row)
+
+        if len(kings.get('wK', [])) != 1 or len(kings.get('bK', [])) != 1:
+            raise ValueError("FEN needs one king of each colour: " + fen)
+
+        if fields[1] not in ('w', 'b'):
+            raise ValueError("FEN side to move must be w or b: " + fen)
+
+        white_to_move = fields[1] == 'w'
+
+        castling = fields[2]
+
+        if castling != '-' and (not castling or any(char not in 'KQkq' for char in castling)):
+            raise ValueError("bad FEN castling rights: " + fen)
+
+        castle_rights = ('K' in castling and white_kingside) | ('Q' in castling and white_queenside) | \
+            ('k' in castling and black_kingside) | ('q' in castling and black_queenside)
+
+        # rights whose king or rook isn't at home can never be used, and would let castling move a missing piece
+        for r, c in ((7, 4), (7, 7), (7, 0), (0, 4), (0, 7), (0, 0)):
+
+            if board[r][c] != ('w' if r == 7 else 'b') + ('K' if c == 4 else 'R'):
+                castle_rights &= castle_masks[r][c]
+
+        if fields[3] == '-':
+            en_passant_possible = ()
+
+        elif len(fields[3]) == 2 and fields[3][0] in Move.files_to_cols and fields[3][1] == ('6' if white_to_move else '3'):
+            en_passant_possible = (Move.ranks_to_rows[fields[3][1]], Move.files_to_cols[fields[3][0]])
 
-            if self.in_check():
-                self.checkmate = True
-            
-            else: 
-                self.stalemate = True
-        
         else:
-            self.checkmate = False
-            self.stalemate = False
+            raise ValueError("bad FEN en passant square: " + fen)
 
-        self.en_passant_possible = temp_en_passant_possible
-        self.current_castling_right = temp_castle_rights
+        # the pawn that just moved two squares has to stand beyond the square it skipped, with that square and its start empty
+        if en_passant_possible:
 
-        return moves
+            r, c = en_passant_possible
+            beyond, start, pawn = (r + 1, r - 1, 'bp') if white_to_move else (r - 1, r + 1, 'wp')
 
+            if board[r][c] != '--' or board[start][c] != '--' or board[beyond][c] != pawn:
+                raise ValueError("no pawn can have just moved past the FEN en passant square: " + fen)
 
-    # determine if current player is in check
+        # the side that just moved can't have left its king in check, or the side to move could capture it.
+        # GameState.attackers_of only reads the board, the bitboard subclass's version would read bitboards not loaded yet
+        old_board = self.board
+        self.board = board
 
-    def in_check(self):
+        try:
+            king_attacked = GameState.attackers_of(self, kings['bK' if white_to_move else 'wK'][0], 'w' if white_to_move else 'b')
 
-        if self.white_to_move:
-            return self.square_under_attack(self.white_king_location[0], self.white_king_location[1])
+        finally:
+            self.board = old_board
+
+        if king_attacked:
+            raise ValueError("the side not to move is in check: " + fen)
+
+        try:
+            halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+            full_move_number = int(fields[5]) if len(fields) > 5 else 1
+
+        except ValueError:
+            raise ValueError("FEN move counters must be numbers: " + fen)
+
+        if halfmove_clock < 0 or full_move_number < 1:
+            raise ValueError("FEN move counters out of range: " + fen)
+
+        self.board = board
+        self.white_king_location = kings['wK'][0]
+        self.black_king_location = kings['bK'][0]
+        self.white_to_move = white_to_move
+        self.castle_rights = castle_rights
+        self.en_passant_possible = en_passant_possible
+        self.halfmove_clock = halfmove_clock
+        self.start_ply = (full_move_number - 1) * 2 + (0 if white_to_move else 1)
+
+        self.move_log = []
+        self.undo_stack = []
+        self.zobrist_key = self.compute_zobrist_key()
+        self.mg_score, self.eg_score, self.phase = compute_scores(self.board)
+        self.checkmate = False
+        self.stalemate = False
+        self.draw_by_repetition = False
+        self.draw_by_fifty_moves = False
+
+
+    # the current position as a FEN string
+
+    def get_fen(self):
+
+        rows = []
+
+        for r in range(8):
+
+            row = ''
+            empty = 0
+
+            for piece in self.board[r]:
+
+                if piece == '--':
+                    empty += 1
+                    continue
+
+                if empty:
+                    row += str(empty)
+                    empty = 0
+
+                row += piece[1].upper() if piece[0] == 'w' else piece[1].lower()
+
+            rows.append(row + (str(empty) if empty else ''))
+
+        rights = self.castle_rights
+        castling = ('K' if rights & white_kingside else '') + ('Q' if rights & white_queenside else '') + \
+            ('k' if rights & black_kingside else '') + ('q' if rights & black_queenside else '')
+
+        if self.en_passant_possible:
+            en_passant = Move.cols_to_files[self.en_passant_possible[1]] + Move.rows_to_rank[self.en_passant_possible[0]]
 
         else:
-            return self.square_under_attack(self.black_king_location[0], self.black_king_location[1])
-            
+            en_passant = '-'
 
-    # determine if the enemy can attack the square r, c
+        return '/'.join(rows) + ' ' + ('w' if self.white_to_move else 'b') + ' ' + (castling or '-') + ' ' + en_passant + \
+            ' ' + str(self.halfmove_clock) + ' ' + str((self.start_ply + len(self.move_log)) // 2 + 1)
 
-    def square_under_attack(self, r, c):
 
-        self.white_to_move = not self.white_to_move # switch to opponent's turn
+    # (FEN, [uci moves]) reaching the current position through every ply since the last capture or pawn move, which is all
+    # the repetition and fifty move checks look at. Other processes get this rather than a bare FEN, which would lose them
 
-        opposition_moves = self.get_all_possible_moves()
+    def get_history(self):
 
-        self.white_to_move = not self.white_to_move # switch back
+        plies = min(self.halfmove_clock, len(self.move_log))
+        moves = self.move_log[len(self.move_log) - plies:]
 
-        for move in opposition_moves:
+        for i in range(plies):
+            self.undo_move()
 
-            if move.end_row == r and move.end_col == c: # square is under attack
-                return True
+        fen = self.get_fen()
 
-        return False
+        for move in moves:
+            self.make_move(move)
 
-        
-    # Without considering checks
+        return fen, [move.get_uci_notation() for move in moves]
 
-    def get_all_possible_moves(self):
-        
-        moves = []
 
-        for r in range(len(self.board)): # number of rows
+    # sets up the position get_history gave, raises ValueError on a bad FEN or a move that isn't legal
 
-            for c in range(len(self.board[r])): # number of columns in given row
+    def load_history(self, fen, moves):
 
-                turn = self.board[r][c][0]
+        self.load_fen(fen)
 
-                if (turn == 'w' and self.white_to_move) or (turn == 'b' and not self.white_to_move):
-                    
-                    piece = self.board[r][c][1]
+        for uci in moves:
 
-                    self.move_functions[piece](r, c, moves) # calls appropriate move function based on piece type
-        
-        return moves
-                    
-    
+            legal = {move.get_uci_notation(): move for move in self.get_valid_moves()}
 
-    def get_pawn_moves(self, r, c, moves):
-        
-        if self.white_to_move: # white pawns
+            if uci not in legal:
+                raise ValueError("illegal move %s in %s" % (uci, self.get_fen()))
 
-            if self.board[r-1][c] == '--': # 1 square move
-                
-                moves.append(Move((r, c), (r-1, c), self.board))
+            self.make_move(legal[uci])
 
-                if r == 6 and self.board[r-2][c] == '--': # 2 square move
-                    moves.append(Move((r, c), (r-2, c), self.board))
 
-            if c-1 >= 0: #captures to the left
+    # standard algebraic notation for a legal move in the current position, e.g. Nbd7, exd6, O-O, e8=Q+
+    # moves is the legal move list when the caller already has it, for telling apart pieces that can reach the same square
 
-                if self.board[r-1][c-1][0] == 'b': # black piece to capture
-                    moves.append(Move((r, c), (r-1, c-1), self.board))
+    def get_san(self, move, moves = None):
 
-                elif (r-1, c-1) == self.en_passant_possible:
-                    moves.append(Move((r, c), (r-1, c-1), self.board, is_en_passant_move = True))
+        if move.is_castle_move:
+            san = 'O-O' if move.end_col > move.start_col else 'O-O-O'
 
-            if c+1 <= 7: # captures to the right
+        else:
 
-                if self.board[r-1][c+1][0] == 'b': # black piece to capture
-                    moves.append(Move((r, c), (r-1, c+1), self.board))
+            target = move.get_rank_file(move.end_row, move.end_col)
+            capture = 'x' if move.piece_captured != '--' else ''
 
-                elif (r-1, c+1) == self.en_passant_possible:
-                    moves.append(Move((r, c), (r-1, c+1), self.board, is_en_passant_move = True))
-        
-        else: # black pawns
+            if move.piece_moved[1] == 'p':
 
-            if self.board[r+1][c] == '--': # 1 square move
-                
-                moves.append(Move((r, c),(r+1, c), self.board))
+                san = (Move.cols_to_files[move.start_col] if capture else '') + capture + target
 
-                if r == 1 and self.board[r+2][c] == '--': # 2 square move
-                    moves.append(Move((r, c),(r+2, c), self.board))
+                if move.is_pawn_promotion:
+                    san += '=' + move.promotion_choice
 
-            if c-1 >= 0: #captures to the left
+            else:
 
-                if self.board[r+1][c-1][0] == 'w': # white piece to capture
-                    moves.append(Move((r, c), (r+1,c-1), self.board))
-                
-                elif (r+1, c-1) == self.en_passant_possible:
-                    moves.append(Move((r, c), (r+1, c-1), self.board, is_en_passant_move = True))
+                if moves is None:
+                    moves = self.get_valid_moves()
 
-            if c+1 <= 7: # captures to the right
+                others = [other for other in moves if other.piece_moved == move.piece_moved and other.end_row == move.end_row and
+                    other.end_col == move.end_col and (other.start_row, other.start_col) != (move.start_row, move.start_col)]
+                disambiguation = ''
 
-                if self.board[r+1][c+1][0] == 'w': # white piece to capture
-                    moves.append(Move((r, c), (r+1,c+1), self.board))
+                if others:
 
-                elif (r+1, c+1) == self.en_passant_possible:
-                    moves.append(Move((r, c), (r+1, c+1), self.board, is_en_passant_move = True))
+                    if all(other.start_col != move.start_col for other in others): # the file is enough
+                        disambiguation = Move.cols_to_files[move.start_col]
 
+                    elif all(other.start_row != move.start_row for other in others): # else the rank
+                        disambiguation = Move.rows_to_rank[move.start_row]
 
-    def get_rook_moves(self, r, c, moves):
-        
-        directions = ((-1, 0), (0, -1), (1, 0), (0, 1)) # up, left, down, right
-        enemy_color = 'b' if self.white_to_move else 'w'
+                    else:
+                        disambiguation = move.get_rank_file(move.start_row, move.start_col)
 
-        for d in directions:
-             for i in range(1, 8):
+                san = move.piece_moved[1] + disambiguation + capture + target
 
-                end_row = r + d[0] * i
-                end_col = c + d[1] * i
+        # check and mate suffix, the flags are kept since looking for mate sets them for the position after the move
+        flags = self.checkmate, self.stalemate, self.draw_by_repetition, self.draw_by_fifty_moves
+        self.make_move(move)
 
-                if 0 <= end_row < 8 and 0 <= end_col < 8: # on board
+        if self.in_check():
+            san += '+' if self.get_valid_moves() else '#'
 
-                    end_piece = self.board[end_row][end_col]
+        self.undo_move()
+        self.checkmate, self.stalemate, self.draw_by_repetition, self.draw_by_fifty_moves = flags
 
-                    if end_piece == '--': # empty space valid
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
+        return san
 
-                    elif end_piece[0] == enemy_color: # enemy piece valid
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
-                        break
 
-                    else: # friendly piece invalid
-                        break
-                
-                else: # not on board
-                    break
+    # the legal move a SAN string describes, raises ValueError when it's malformed, illegal or ambiguous
+    # check marks, annotations and 0-0 style castling are accepted, a promotion without a piece is taken as a queen
 
+    def parse_san(self, san, moves = None):
 
-    def get_knight_moves(self, r, c, moves):
-        
-        knight_moves = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
-        ally_color = 'w' if self.white_to_move else 'b'
+        if moves is None:
+            moves = self.get_valid_moves()
 
-        for m in  knight_moves:
+        text = san.strip().rstrip('+#!?')
 
-            end_row = r + m[0]
-            end_col = c + m[1]
+        if text.endswith('e.p.'):
+            text = text[:-4].rstrip()
 
-            if 0 <= end_row < 8 and 0 <= end_col < 8: # on board
+        if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+            kingside = len(text) == 3
+            matches = [move for move in moves if move.is_castle_move and (move.end_col > move.start_col) == kingside]
 
-                end_piece = self.board[end_row][end_col]
+        else:
 
-                if end_piece[0] != ally_color: # not an ally piece (enemy piece or empty space)
-                    moves.append(Move((r, c), (end_row, end_col), self.board))
+            match = san_pattern.match(text)
 
+            if match is None:
+                raise ValueError("bad SAN move " + san)
 
-    
-    def get_bishop_moves(self, r, c, moves):
-        
-        directions = ((-1, -1), (-1, 1), (1, -1), (1, 1))
-        enemy_color = 'b' if self.white_to_move else 'w'
+            piece, from_file, from_rank, capture, target, promotion = match.groups()
+            piece = piece or 'p'
+            end_row, end_col = Move.ranks_to_rows[target[1]], Move.files_to_cols[target[0]]
 
-        for d in directions:
+            matches = [move for move in moves if move.piece_moved[1] == piece and move.end_row == end_row and move.end_col == end_col and
+                (from_file is None or move.start_col == Move.files_to_cols[from_file]) and
+                (from_rank is None or move.start_row == Move.ranks_to_rows[from_rank]) and
+                (move.promotion_choice == (promotion or 'Q') if move.is_pawn_promotion else promotion is None)]
 
-            for i in range(1, 8):
+        if len(matches) != 1:
+            raise ValueError("%s SAN move %s in %s" % ("ambiguous" if matches else "illegal", san, self.get_fen()))
 
-                end_row = r + d[0] * i
-                end_col = c + d[1] * i
+        return matches[0]
 
-                if 0 <= end_row < 8 and 0<= end_col < 8:
 
-                    end_piece = self.board[end_row][end_col]
+    # the castling rights as a Castle_Rights object, a copy of the castle_rights bits
 
-                    if end_piece == '--': # empty space valid
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
+    @property
+    def current_castling_right(self):
 
-                    elif end_piece[0] == enemy_color: # enemy piece valid
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
-                        break
+        rights = self.castle_rights
 
-                    else: # friendly piece invalid
-                        break
+        return Castle_Rights(rights & white_kingside != 0, rights & black_kingside != 0, rights & white_queenside != 0, rights & black_queenside != 0)
 
-                else: # not on board
-                    break
 
+    # the position key built from scratch, make_move and undo_move keep self.zobrist_key equal to it
 
+    def compute_zobrist_key(self):
 
-    def get_queen_moves(self, r, c, moves):
-        self.get_rook_moves(r, c, moves)
-        self.get_bishop_moves(r, c, moves)
+        key = 0
 
+        for r in range(8):
 
+            for c in range(8):
 
-    def get_king_moves(self, r, c, moves):
-        
-        king_moves = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
-        ally_color = 'w' if self.white_to_move else 'b'
+                if self.board[r][c] != '--':
+                    key ^= zobrist_pieces[self.board[r][c]][r][c]
 
-        for i in range(8):
+        if not self.white_to_move:
+            key ^= zobrist_black_to_move
 
-            end_row = r + king_moves[i][0]
-            end_col = c + king_moves[i][1]
+        if self.en_passant_capture():
+            key ^= zobrist_en_passant[self.en_passant_possible[1]]
 
-            if 0 <= end_row < 8 and 0 <= end_col < 8: 
+        return key ^ zobrist_castling[self.castle_rights]
 
-                end_piece = self.board[end_row][end_col]
 
-                if end_piece[0] != ally_color: # not an ally piece (enemy piece or empty space)
-                    moves.append(Move((r, c), (end_row, end_col), self.board))
+    # whether a pawn of the side to move stands beside the pawn that just moved two squares. Only then does the en passant
+    # square change what can happen, so only then is it part of the key, and a position reached by a double push repeats
+    # the same position reached otherwise. Pins aren't looked at, as in polyglot keys
 
+    def en_passant_capture(self):
 
-    # generate all castle moves and add them to the list of moves
-    def get_castle_moves(self, r, c, moves):
+        if not self.en_passant_possible:
+            return False
 
-        if self.square_under_attack(r, c):
-            return # can't castle while in check
+        row, col = self.en_passant_possible
+        pawn_row = row + 1 if self.white_to_move else row - 1
+        pawn = 'wp' if self.white_to_move else 'bp'
 
-        if (self.white_to_move and self.current_castling_right.wks) or (not self.white_to_move and self.current_castling_right.bks):
-            self.get_kingside_castle_moves(r, c, moves)
+        return (col > 0 and self.board[pawn_row][col - 1] == pawn) or (col < 7 and self.board[pawn_row][col + 1] == pawn)
 
-        if (self.white_to_move and self.current_castling_right.wqs) or (not self.white_to_move and self.current_castling_right.bqs):
-            self.get_queenside_castle_moves(r, c, moves)
 
-    def get_kingside_castle_moves(self, r, c, moves):
+    def check_zobrist_key(self):
 
-        if self.board[r][c+1] == '--' and self.board[r][c+2] == '--':
+        if self.zobrist_key != self.compute_zobrist_key():
+            raise RuntimeError("incremental zobrist key %x doesn't match the position" % self.zobrist_key)
 
-            if not self.square_under_attack(r, c+1) and not self.square_under_attack(r, c+2):
-                moves.append(Move((r, c), (r, c+2), self.board, is_castle_move = True))
 
+    def check_scores(self):
 
-    def get_queenside_castle_moves(self, r, c, moves):
+        if (self.mg_score, self.eg_score, self.phase) != compute_scores(self.board):
+            raise RuntimeError("incremental evaluation scores %d %d phase %d don't match the position" % (self.mg_score, self.eg_score, self.phase))
 
-        if self.board[r][c-1] == '--' and self.board[r][c-2] == '--' and self.board[r][c-3]:
 
-            if not self.square_under_attack(r, c-1) and not self.square_under_attack(r, c-2):
-                moves.append(Move((r, c), (r, c-2), self.board, is_castle_move = True))
+    def update_castle_rights(self, move):
+        self.castle_rights &= castle_masks[move.start_row][move.start_col] & castle_masks[move.end_row][move.end_col]
 
 
-         
+    # legal moves for the side to move, from move_cache when the position has been seen before
+    # a cached list comes back as a fresh list of the same Move objects, along with the position's checkmate/stalemate flags
+    # the draw flags depend on how the position was reached, so they're worked out every time
 
-class Castle_Rights():
+    def get_valid_moves(self):
 
-    def __init__(self, wks, bks, wqs, bqs):
+        cache = self.move_cache
+        entry = cache.get(self.zobrist_key) if cache is not None else None
 
-        self.wks = wks
-        self.bks = bks
-        self.wqs = wqs
-        self.bqs = bqs
+        if entry is not None:
+            moves, self.checkmate, self.stalemate = entry
+            moves = list(moves)
 
+        else:
 
-class Move():
+            moves = self.generate_valid_moves()
 
-    # maps keys to values, key: value
+            if cache is not None:
+                cache.put(self.zobrist_key, tuple(moves), self.checkmate, self.stalemate)
+
+        self.draw_by_repetition = self.repetitions(2) == 2
+        self.draw_by_fifty_moves = self.halfmove_clock >= 100 and not self.checkmate
+
+        return moves
+
+
+    # how many times the current position came up earlier in the game, counting no further than limit
+    # the keys come from the undo stack, which make_move and undo_move keep one record per ply in. Only the plies since
+    # the last capture or pawn move are looked at, as no earlier position can come back, and only every other one, with the same side to move
+
+    def repetitions(self, limit = 2):
+
+        key = self.zobrist_key
+        stack = self.undo_stack
+        count = 0
+
+        for i in range(len(stack) - 2, len(stack) - min(self.halfmove_clock, len(stack)) - 1, -2):
+
+            if stack[i] >> 24 & 0xFFFFFFFFFFFFFFFF == key:
+
+                count += 1
+
+                if count == limit:
+                    break
+
+        return count
+
+
+    # for the search: the fifty move rule, or a single repetition since the side that could have avoided it chose not to
+    # a mate on the hundredth ply still counts as mate
+
+    def is_draw(self):
+
+        if self.halfmove_clock >= 100:
+            return not (self.in_check() and not self.get_valid_moves())
+
+        return self.repetitions(1) == 1
+
+
+    # Considering checks
     
-    ranks_to_rows = {"1": 7, "2": 6, "3": 5, "4": 4, "5": 3, "6": 2, "7": 1, "8": 0}
-    rows_to_rank = {v: k for k, v in ranks_to_rows.items()}
+    def generate_valid_moves(self):
 
-    files_to_cols = {"a": 0, "b": 1, "c": 2, "d": 3, "e": 4, "f": 5, "g": 6, "h": 7}
-    cols_to_files = {v: k for k, v in files_to_cols.items()}
+        if self.white_to_move:
+            king_row, king_col = self.white_king_location
+
+        else:
+            king_row, king_col = self.black_king_location
 
+        # checkers and pinned pieces are found once, by looking outward from the king
+        king_in_check, self.pins, self.checks = self.check_for_pins_and_checks(king_row, king_col)
 
-    def __init__(self, start_square, end_square, board, is_en_passant_move = False, is_castle_move = False):
+        if king_in_check:
 
-        self.start_row = start_square[0]
-        self.start_col = start_square[1]
-        self.end_row = end_square[0]
-        self.end_col = end_square[1]
-        self.piece_moved = board[self.start_row][self.start_col]
-        self.piece_captured = board[self.end_row][self.end_col]
-        self.is_pawn_promotion = (self.piece_moved == 'wp' and self.end_row == 0) or (self.piece_moved == 'bp' and self.end_row == 7)
-        self.is_en_passant_move = is_en_passant_move
+            if len(self.checks) == 1: # single check, capture the checker, block it or move the king
+
+                moves = self.get_all_possible_moves()
+                self.remove_non_evasions(moves, king_row, king_col)
+
+            else: # double check, king has to move
+                moves = []
+                self.get_king_moves(king_row, king_col, moves)
+
+        else:
+            moves = self.get_all_possible_moves()
+            self.get_castle_moves(king_row, king_col, moves)
+
+        if len(moves) == 0: # either checkmate or stalemate
+
+            if king_in_check:
+                self.checkmate = True
+            
+            else: 
+                self.stalemate = True
         
-        if self.is_en_passant_move:
-            self.piece_captured = 'wp' if self.piece_moved == 'bp' else 'bp'
+        else:
+            self.checkmate = False
+            self.stalemate = False
 
-        self.is_castle_move = is_castle_move
+        return moves
 
-        self.move_id = self.start_row * 1000 + self.start_col * 100 + self.end_row * 10 + self.end_col
-    
-    # * Overriding the equals method
 
-    def __eq__(self, other):
+    # in single check, drops every move from the list that neither moves the king nor captures or blocks the checker
 
-        if isinstance(other, Move):
-            return self.move_id == other.move_id
+    def remove_non_evasions(self, moves, king_row, king_col):
 
-        return False
+        check_row, check_col, d_row, d_col = self.checks[0]
+        valid_squares = [(check_row, check_col)]
 
-    def get_chess_notation(self):
+        if self.board[check_row][check_col][1] != 'N': # sliders can be blocked
+
+            for i in range(1, 8):
+
+                square = (king_row + d_row * i, king_col + d_col * i)
+
+                if square == (check_row, check_col):
+                    break
+
+                valid_squares.append(square)
+
+        for i in range(len(moves)-1, -1, -1): # when removing an element from a list go backwards
+
+            move = moves[i]
+
+            if move.piece_moved[1] == 'K':
+                continue
+
+            if move.is_en_passant_move: # the captured pawn is not on the landing square
+                if (move.end_row, move.end_col) not in valid_squares and (move.start_row, move.end_col) not in valid_squares:
+                    moves.pop(i)
+
+            elif (move.end_row, move.end_col) not in valid_squares:
+                moves.pop(i)
+
+
+    # legal captures and promotions only, for quiescence and the capture stages of a staged search
+    # the checkmate/stalemate flags are left alone, having no captures doesn't mean having no moves
+
+    def get_valid_captures(self):
+
+        if self.white_to_move:
+            ally_color, (king_row, king_col) = 'w', self.white_king_location
+
+        else:
+            ally_color, (king_row, king_col) = 'b', self.black_king_location
+
+        king_in_check, self.pins, self.checks = self.check_for_pins_and_checks(king_row, king_col)
+        moves = []
+
+        if len(self.checks) > 1: # double check, only the king can move
+            self.get_king_captures(king_row, king_col, moves)
+            return moves
+
+        for r in range(8):
+
+            row = self.board[r]
+
+            for c in range(8):
+
+                if row[c][0] == ally_color:
+                    self.capture_functions[row[c][1]](r, c, moves)
+
+        if king_in_check:
+            self.remove_non_evasions(moves, king_row, king_col)
+
+        return moves
+
+
+    # legal moves that neither capture nor promote, everything get_valid_captures leaves out
+
+    def get_valid_quiets(self):
+        return [move for move in self.get_valid_moves() if move.piece_captured == '--' and not move.is_pawn_promotion]
+
+
+    # legal moves of the piece on r, c for the side to move, so a remembered move can be checked without generating every move
+
+    def get_valid_piece_moves(self, r, c):
+
+        if self.white_to_move:
+            ally_color, (king_row, king_col) = 'w', self.white_king_location
+
+        else:
+            ally_color, (king_row, king_col) = 'b', self.black_king_location
+
+        moves = []
+        piece = self.board[r][c]
+
+        if piece[0] != ally_color:
+            return moves
+
+        king_in_check, self.pins, self.checks = self.check_for_pins_and_checks(king_row, king_col)
+
+        if len(self.checks) > 1 and piece[1] != 'K': # double check, only the king can move
+            return moves
+
+        self.move_functions[piece[1]](r, c, moves)
+
+        if king_in_check:
+            self.remove_non_evasions(moves, king_row, king_col)
+
+        elif piece[1] == 'K':
+            self.get_castle_moves(r, c, moves)
+
+        return moves
+
+
+    # looks outward from square r, c for the side to move
+    # returns if the square is attacked, the ally pieces pinned to it {(row, col): direction} and the checking pieces [(row, col, d_row, d_col)]
+
+    def check_for_pins_and_checks(self, r, c):
+
+        pins = {}
+        checks = []
+        in_check = False
+        board = self.board
+
+        if self.white_to_move:
+            enemy_color, ally_color, enemy_knight, pawn_row = 'b', 'w', 'bN', -1
+
+        else:
+            enemy_color, ally_color, enemy_knight, pawn_row = 'w', 'b', 'wN', 1
+
+        rays = ray_table[r][c]
+
+        for j in range(8):
+
+            d = directions[j]
+            possible_pin = ()
+            i = 0
+
+            for end_row, end_col in rays[j]:
+
+                i += 1
+                end_piece = board[end_row][end_col]
+
+                if end_piece[0] == ally_color:
+
+                    if possible_pin == (): # first ally piece could be pinned
+                        possible_pin = (end_row, end_col)
+
+                    else: # second ally piece, no pin or check possible in this direction
+                        break
+
+                elif end_piece[0] == enemy_color:
+
+                    piece_type = end_piece[1]
+
+                    # rook on a line, bishop on a diagonal, queen anywhere, pawn or king one square away
+                    if (j < 4 and piece_type == 'R') or (j >= 4 and piece_type == 'B') or piece_type == 'Q' or \
+                        (i == 1 and piece_type == 'K') or (i == 1 and piece_type == 'p' and d[0] == pawn_row and j >= 4):
+
+                        if possible_pin == (): # no piece blocking, so check
+                            in_check = True
+                            checks.append((end_row, end_col, d[0], d[1]))
+
+                        else: # ally piece blocking, so pin
+                            pins[possible_pin] = d
+
+                    break # enemy piece blocks any further attack
+
+        for end_row, end_col in knight_table[r][c]:
+
+            if board[end_row][end_col] == enemy_knight:
+                in_check = True
+                checks.append((end_row, end_col, end_row - r, end_col - c))
+
+        return in_check, pins, checks
+
+
+    # (result, plies to mate) for the side to move from the tablebases, result 1 win, 0 draw, -1 loss
+    # None when there are no tablebases or the position isn't in them
+
+    def probe_tablebase(self):
+
+        if self.tablebases is None:
+            return None
+
+        return self.tablebases.probe(self)
+
+
+    # determine if current player is in check
+
+    def in_check(self):
+
+        if self.white_to_move:
+            return self.square_under_attack(self.white_king_location[0], self.white_king_location[1])
+
+        else:
+            return self.square_under_attack(self.black_king_location[0], self.black_king_location[1])
+            
+
+    # determine if the enemy can attack the square r, c
+    # looks outward from the square and stops at the first attacker found, nothing is allocated
+
+    def square_under_attack(self, r, c):
+
+        board = self.board
+
+        if self.white_to_move:
+            enemy_color, enemy_pawn, enemy_knight, enemy_king, pawn_row = 'b', 'bp', 'bN', 'bK', r - 1 # black pawns attack downwards
+
+        else:
+            enemy_color, enemy_pawn, enemy_knight, enemy_king, pawn_row = 'w', 'wp', 'wN', 'wK', r + 1
+
+        # pawn diagonals
+        if 0 <= pawn_row < 8:
+
+            if c - 1 >= 0 and board[pawn_row][c-1] == enemy_pawn:
+                return True
+
+            if c + 1 <= 7 and board[pawn_row][c+1] == enemy_pawn:
+                return True
+
+        for end_row, end_col in knight_table[r][c]:
+
+            if board[end_row][end_col] == enemy_knight:
+                return True
+
+        for end_row, end_col in king_table[r][c]:
+
+            if board[end_row][end_col] == enemy_king:
+                return True
+
+        # slider rays, each one stops at the first blocker
+        rays = ray_table[r][c]
+
+        for j in range(8):
+
+            slider = 'R' if j < 4 else 'B'
+
+            for end_row, end_col in rays[j]:
+
+                end_piece = board[end_row][end_col]
+
+                if end_piece != '--':
+
+                    if end_piece[0] == enemy_color and (end_piece[1] == slider or end_piece[1] == 'Q'):
+                        return True
+
+                    break
+
+        return False
+
+
+    # every piece of the given color attacking square (row, col), as a list of (row, col)
+
+    def attackers_of(self, square, color):
+
+        board = self.board
+        r, c = square
+        attackers = []
+
+        pawn_row = r + 1 if color == 'w' else r - 1 # white pawns attack upwards
+
+        if 0 <= pawn_row < 8:
+
+            for end_col in (c - 1, c + 1):
+
+                if 0 <= end_col < 8 and board[pawn_row][end_col] == color + 'p':
+                    attackers.append((pawn_row, end_col))
+
+        for end_row, end_col in knight_table[r][c]:
+
+            if board[end_row][end_col] == color + 'N':
+                attackers.append((end_row, end_col))
+
+        for end_row, end_col in king_table[r][c]:
+
+            if board[end_row][end_col] == color + 'K':
+                attackers.append((end_row, end_col))
+
+        rays = ray_table[r][c]
+
+        for j in range(8):
+
+            slider = 'R' if j < 4 else 'B'
+
+            for end_row, end_col in rays[j]:
+
+                end_piece = board[end_row][end_col]
+
+                if end_piece != '--':
+
+                    if end_piece[0] == color and (end_piece[1] == slider or end_piece[1] == 'Q'):
+                        attackers.append((end_row, end_col))
+
+                    break
+
+        return attackers
+
+
+    # Without considering checks
+
+    def get_all_possible_moves(self):
+        
+        moves = []
+
+        for r in range(len(self.board)): # number of rows
+
+            for c in range(len(self.board[r])): # number of columns in given row
+
+                turn = self.board[r][c][0]
+
+                if (turn == 'w' and self.white_to_move) or (turn == 'b' and not self.white_to_move):
+                    
+                    piece = self.board[r][c][1]
+
+                    self.move_functions[piece](r, c, moves) # calls appropriate move function based on piece type
+        
+        return moves
+                    
+    
+
+    def get_pawn_moves(self, r, c, moves):
+
+        pin_direction = self.pins.get((r, c), ())
+
+        if self.white_to_move: # white pawns
+            move_amount, start_row = -1, 6
+
+        else: # black pawns
+            move_amount, start_row = 1, 1
+
+        if self.board[r+move_amount][c] == '--': # 1 square move
+
+            if pin_direction == () or pin_direction == (move_amount, 0) or pin_direction == (-move_amount, 0):
+
+                self.add_pawn_move((r, c), (r+move_amount, c), moves)
+
+                if r == start_row and self.board[r+2*move_amount][c] == '--': # 2 square move
+                    moves.append(Move((r, c), (r+2*move_amount, c), self.board))
+
+        self.get_pawn_captures(r, c, moves)
+
+
+    # captures to the left and to the right, en passant included
+
+    def get_pawn_captures(self, r, c, moves):
+
+        pin_direction = self.pins.get((r, c), ())
+
+        if self.white_to_move:
+            move_amount, enemy_color = -1, 'b'
+            king_row, king_col = self.white_king_location
+
+        else:
+            move_amount, enemy_color = 1, 'w'
+            king_row, king_col = self.black_king_location
+
+        for d_col in (-1, 1):
+
+            end_col = c + d_col
+
+            if not 0 <= end_col <= 7:
+                continue
+
+            if pin_direction != () and pin_direction != (move_amount, d_col) and pin_direction != (-move_amount, -d_col):
+                continue # pinned along another line
+
+            if self.board[r+move_amount][end_col][0] == enemy_color: # enemy piece to capture
+                self.add_pawn_move((r, c), (r+move_amount, end_col), moves)
+
+            elif (r+move_amount, end_col) == self.en_passant_possible and not self.en_passant_reveals_check(r, c, end_col, king_row, king_col):
+                moves.append(Move((r, c), (r+move_amount, end_col), self.board, is_en_passant_move = True))
+
+
+    # the capture stage also takes pushes onto the last row, a promotion changes the material like a capture
+
+    def get_pawn_captures_and_promotions(self, r, c, moves):
+
+        move_amount = -1 if self.white_to_move else 1
+        end_row = r + move_amount
+
+        if (end_row == 0 or end_row == 7) and self.board[end_row][c] == '--':
+
+            pin_direction = self.pins.get((r, c), ())
+
+            if pin_direction == () or pin_direction == (move_amount, 0) or pin_direction == (-move_amount, 0):
+                self.add_pawn_move((r, c), (end_row, c), moves)
+
+        self.get_pawn_captures(r, c, moves)
+
+
+    # a pawn reaching the last row adds one move per promotion piece
+
+    def add_pawn_move(self, start_square, end_square, moves):
+
+        if end_square[0] == 0 or end_square[0] == 7:
+
+            for piece in ('Q', 'R', 'B', 'N'):
+                moves.append(Move(start_square, end_square, self.board, promotion_choice = piece))
+
+        else:
+            moves.append(Move(start_square, end_square, self.board))
+
+
+    # both pawns leave the row on an en passant capture, which can expose the king along that row
+
+    def en_passant_reveals_check(self, r, c, captured_col, king_row, king_col):
+
+        if king_row != r:
+            return False
+
+        enemy_color = 'b' if self.white_to_move else 'w'
+        step = 1 if king_col < c else -1 # walk from the king past both pawns
+        col = king_col + step
+
+        while 0 <= col < 8:
+
+            if col != c and col != captured_col:
+
+                piece = self.board[r][col]
+
+                if piece != '--': # first piece that isn't one of the two pawns
+                    return piece[0] == enemy_color and piece[1] in 'RQ'
+
+            col += step
+
+        return False
+
+
+    def get_rook_moves(self, r, c, moves):
+        
+        enemy_color = 'b' if self.white_to_move else 'w'
+        pin_direction = self.pins.get((r, c), ())
+        rays = ray_table[r][c]
+
+        for j in (0, 1, 2, 3): # up, left, down, right
+
+            d = directions[j]
+
+            if pin_direction != () and pin_direction != d and pin_direction != (-d[0], -d[1]):
+                continue # can only move along the pin
+
+            for end_row, end_col in rays[j]:
+
+                end_piece = self.board[end_row][end_col]
+
+                if end_piece == '--': # empty space valid
+                    moves.append(Move((r, c), (end_row, end_col), self.board))
+
+                elif end_piece[0] == enemy_color: # enemy piece valid
+                    moves.append(Move((r, c), (end_row, end_col), self.board))
+                    break
+
+                else: # friendly piece invalid
+                    break
+
+
+    def get_knight_moves(self, r, c, moves):
+
+        if (r, c) in self.pins:
+            return # a pinned knight can never move
+        
+        ally_color = 'w' if self.white_to_move else 'b'
+
+        for end_row, end_col in knight_table[r][c]:
+
+            if self.board[end_row][end_col][0] != ally_color: # not an ally piece (enemy piece or empty space)
+                moves.append(Move((r, c), (end_row, end_col), self.board))
+
+
+    def get_bishop_moves(self, r, c, moves):
+        
+        enemy_color = 'b' if self.white_to_move else 'w'
+        pin_direction = self.pins.get((r, c), ())
+        rays = ray_table[r][c]
+
+        for j in (4, 5, 6, 7): # diagonals
+
+            d = directions[j]
+
+            if pin_direction != () and pin_direction != d and pin_direction != (-d[0], -d[1]):
+                continue # can only move along the pin
+
+            for end_row, end_col in rays[j]:
+
+                end_piece = self.board[end_row][end_col]
+
+                if end_piece == '--': # empty space valid
+                    moves.append(Move((r, c), (end_row, end_col), self.board))
+
+                elif end_piece[0] == enemy_color: # enemy piece valid
+                    moves.append(Move((r, c), (end_row, end_col), self.board))
+                    break
+
+                else: # friendly piece invalid
+                    break
+
+
+
+    def get_queen_moves(self, r, c, moves):
+        self.get_rook_moves(r, c, moves)
+        self.get_bishop_moves(r, c, moves)
+
+
+    # captures only: each ray is walked to its first piece, which is taken if it's an enemy
+
+    def get_slider_captures(self, r, c, moves, ray_indices):
+
+        enemy_color = 'b' if self.white_to_move else 'w'
+        pin_direction = self.pins.get((r, c), ())
+        rays = ray_table[r][c]
+
+        for j in ray_indices:
+
+            d = directions[j]
+
+            if pin_direction != () and pin_direction != d and pin_direction != (-d[0], -d[1]):
+                continue # can only move along the pin
+
+            for end_row, end_col in rays[j]:
+
+                end_piece = self.board[end_row][end_col]
+
+                if end_piece != '--':
+
+                    if end_piece[0] == enemy_color:
+                        moves.append(Move((r, c), (end_row, end_col), self.board))
+
+                    break
+
+
+    def get_rook_captures(self, r, c, moves):
+        self.get_slider_captures(r, c, moves, (0, 1, 2, 3))
+
+
+    def get_bishop_captures(self, r, c, moves):
+        self.get_slider_captures(r, c, moves, (4, 5, 6, 7))
+
+
+    def get_queen_captures(self, r, c, moves):
+        self.get_slider_captures(r, c, moves, (0, 1, 2, 3, 4, 5, 6, 7))
+
+
+    def get_knight_captures(self, r, c, moves):
+
+        if (r, c) in self.pins:
+            return # a pinned knight can never move
+
+        enemy_color = 'b' if self.white_to_move else 'w'
+
+        for end_row, end_col in knight_table[r][c]:
+
+            if self.board[end_row][end_col][0] == enemy_color:
+                moves.append(Move((r, c), (end_row, end_col), self.board))
+
+
+    def get_king_captures(self, r, c, moves):
+
+        enemy_color = 'b' if self.white_to_move else 'w'
+
+        king = self.board[r][c]
+        self.board[r][c] = '--' # lift the king so it can't block attacks along its own line
+
+        for end_row, end_col in king_table[r][c]:
+
+            if self.board[end_row][end_col][0] == enemy_color and not self.square_under_attack(end_row, end_col):
+                self.board[r][c] = king
+                moves.append(Move((r, c), (end_row, end_col), self.board))
+                self.board[r][c] = '--'
+
+        self.board[r][c] = king
+
+
+
+    def get_king_moves(self, r, c, moves):
+        
+        ally_color = 'w' if self.white_to_move else 'b'
+
+        king = self.board[r][c]
+        self.board[r][c] = '--' # lift the king so it can't block attacks along its own line
+
+        for end_row, end_col in king_table[r][c]:
+
+            if self.board[end_row][end_col][0] != ally_color: # not an ally piece (enemy piece or empty space)
+
+                if not self.square_under_attack(end_row, end_col): # not moving into check
+                    self.board[r][c] = king
+                    moves.append(Move((r, c), (end_row, end_col), self.board))
+                    self.board[r][c] = '--'
+
+        self.board[r][c] = king
+
+
+    # generate all castle moves and add them to the list of moves, the king is known not to be in check
+    def get_castle_moves(self, r, c, moves):
+
+        if self.castle_rights & (white_kingside if self.white_to_move else black_kingside):
+            self.get_kingside_castle_moves(r, c, moves)
+
+        if self.castle_rights & (white_queenside if self.white_to_move else black_queenside):
+            self.get_queenside_castle_moves(r, c, moves)
+
+    def get_kingside_castle_moves(self, r, c, moves):
+
+        if self.board[r][c+1] == '--' and self.board[r][c+2] == '--':
+
+            if not self.square_under_attack(r, c+1) and not self.square_under_attack(r, c+2):
+                moves.append(Move((r, c), (r, c+2), self.board, is_castle_move = True))
+
+
+    def get_queenside_castle_moves(self, r, c, moves):
+
+        if self.board[r][c-1] == '--' and self.board[r][c-2] == '--' and self.board[r][c-3] == '--':
+
+            if not self.square_under_attack(r, c-1) and not self.square_under_attack(r, c-2):
+                moves.append(Move((r, c), (r, c-2), self.board, is_castle_move = True))
+
+
+         
+
+# legal move lists by position key, with the least recently used position dropped once size positions are held
+# set as GameState.move_cache, setting that back to None turns caching off
+
+class Move_Cache():
+
+    def __init__(self, size = 4096):
+
+        self.size = size
+        self.entries = OrderedDict() # key -> (moves, checkmate, stalemate), most recently used last
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def clear(self):
+
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+    # (moves tuple, checkmate, stalemate) or None
+
+    def get(self, key):
+
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return entry
+
+
+    def put(self, key, moves, checkmate, stalemate):
+
+        self.entries[key] = (moves, checkmate, stalemate)
+        self.entries.move_to_end(key)
+
+        if len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+            self.evictions += 1
+
+
+    def stats(self):
+
+        lookups = self.hits + self.misses
+
+        return {'size': self.size, 'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+class Castle_Rights():
+
+    def __init__(self, wks, bks, wqs, bqs):
+
+        self.wks = wks
+        self.bks = bks
+        self.wqs = wqs
+        self.bqs = bqs
+
+
+class Move():
+
+    # maps keys to values, key: value
+    
+    ranks_to_rows = {"1": 7, "2": 6, "3": 5, "4": 4, "5": 3, "6": 2, "7": 1, "8": 0}
+    rows_to_rank = {v: k for k, v in ranks_to_rows.items()}
+
+    files_to_cols = {"a": 0, "b": 1, "c": 2, "d": 3, "e": 4, "f": 5, "g": 6, "h": 7}
+    cols_to_files = {v: k for k, v in files_to_cols.items()}
+
+
+    promotion_codes = {'Q': 0, 'R': 1, 'B': 2, 'N': 3}
+
+    # no per move __dict__, the generators make thousands of these per position
+    # the pieces are copied out of the board when the move is created, the board changes once the move is played
+    # so they can't be read later. The flags are plain slots since make_move reads them for every move, only move_id is lazy
+    __slots__ = ('start_row', 'start_col', 'end_row', 'end_col', 'piece_moved', 'piece_captured', 'is_pawn_promotion',
+        'is_en_passant_move', 'is_castle_move', 'promotion_choice', 'packed')
+
+
+    def __init__(self, start_square, end_square, board, is_en_passant_move = False, is_castle_move = False, promotion_choice = 'Q'):
+
+        start_row, start_col = start_square
+        end_row, end_col = end_square
+
+        self.start_row = start_row
+        self.start_col = start_col
+        self.end_row = end_row
+        self.end_col = end_col
+        self.piece_moved = board[start_row][start_col]
+        self.piece_captured = board[end_row][end_col]
+        self.is_pawn_promotion = self.piece_moved[1] == 'p' and (end_row == 0 or end_row == 7)
+        self.is_en_passant_move = is_en_passant_move
+        
+        if is_en_passant_move:
+            self.piece_captured = 'wp' if self.piece_moved == 'bp' else 'bp'
+
+        self.is_castle_move = is_castle_move
+        self.promotion_choice = promotion_choice # piece a pawn promotes to
+
+        # start square, end square and promotion piece in 14 bits, the move's identity
+        # en passant and castling aren't part of it, they follow from the board
+        self.packed = (start_row * 8 + start_col) | (end_row * 8 + end_col) << 6
+
+        if self.is_pawn_promotion:
+            self.packed |= self.promotion_codes[promotion_choice] << 12
+
+
+    # rebuilds a move from its packed form, for the position it is played in
+
+    @classmethod
+    def from_packed(cls, packed, board):
+
+        start_row, start_col = divmod(packed & 63, 8)
+        end_row, end_col = divmod(packed >> 6 & 63, 8)
+        piece = board[start_row][start_col]
+
+        is_castle_move = piece[1] == 'K' and abs(end_col - start_col) == 2
+        is_en_passant_move = piece[1] == 'p' and start_col != end_col and board[end_row][end_col] == '--'
+
+        return cls((start_row, start_col), (end_row, end_col), board, is_en_passant_move, is_castle_move, 'QRBN'[packed >> 12 & 3])
+
+
+    # the old decimal id, worked out only when asked for
+
+    @property
+    def move_id(self):
+
+        move_id = self.start_row * 1000 + self.start_col * 100 + self.end_row * 10 + self.end_col
+
+        if self.is_pawn_promotion: # under promotions need their own id, a queen keeps the plain one
+            move_id += self.promotion_codes[self.promotion_choice] * 10000
+
+        return move_id
+    
+    # * Overriding the equals method, equal moves hash the same so they work in sets and dicts
+
+    def __eq__(self, other):
+
+        if isinstance(other, Move):
+            return self.packed == other.packed
+
+        return False
+
+
+    def __hash__(self):
+        return self.packed
+
+
+    # short notation without the position, see GameState.get_san for standard algebraic notation
+
+    def get_chess_notation(self):
         return self.get_move(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
 
 
+    # start and end squares, plus the promotion piece, e.g. e2e4 or a7a8n
+
+    def get_uci_notation(self):
+
+        notation = self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+
+        if self.is_pawn_promotion:
+            notation += self.promotion_choice.lower()
+
+        return notation
+
+
     def get_rank_file(self, r, c):
         return self.cols_to_files[c] + self.rows_to_rank[r]
 
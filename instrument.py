@@ -0,0 +1,264 @@
+"""
+Opt in instrumentation for a GameState and its Searcher: call counts, moves generated by each piece function, cache and table hit rates and latency histograms, exported as a JSON snapshot or a one line summary. Counting works by putting wrappers on the instances it's attached to, so instances it isn't attached to run exactly the code they always did.
+"""
+
+import json, sys, threading, time
+
+import engine
+
+
+# GameState methods counted, and timed when timing is on
+game_state_methods = ('make_move', 'undo_move', 'get_valid_moves', 'get_valid_captures', 'square_under_attack')
+
+# Searcher methods counted, only the whole search is timed since the others call themselves
+searcher_methods = ('negamax', 'quiescence')
+searcher_timed_methods = ('search',)
+
+histogram_buckets = 40 # bucket i counts calls taking under 2 ** i nanoseconds, the last one everything slower
+
+
+class Instrumentation():
+
+    # timing adds two clock reads per counted call, leave it off to count only
+
+    def __init__(self, timing = True):
+
+        self.timing = timing
+        self.attached = [] # (instance, attribute names set on it, {dict attribute: original contents})
+        self.game_states = []
+        self.searchers = []
+        self.logging_stop = None
+        self.logging_thread = None
+        self.reset()
+
+
+    def reset(self):
+
+        self.started = time.perf_counter()
+        self.calls = {}
+        self.generated = {} # generator function name -> moves it added, for mailbox game states only
+        self.latency = {} # method name -> [calls per bucket]
+        self.total_ns = {}
+
+
+    # wraps the counted methods of gs and the piece functions in its move_functions and capture_functions tables
+    # the piece counts cover moves generated through those tables, a queen's rook and bishop calls count as the queen's.
+    # A backend with its own generate_valid_moves, like the bitboard one, never calls the tables and gets no piece counts
+
+    def attach(self, gs):
+
+        names = [name for name in game_state_methods if hasattr(gs, name)]
+        tables = {}
+
+        for name in names:
+            setattr(gs, name, self.wrap(name, getattr(gs, name), self.timing))
+
+        table_names = ('move_functions', 'capture_functions') if type(gs).generate_valid_moves is engine.GameState.generate_valid_moves else ()
+
+        for table_name in table_names:
+
+            table = getattr(gs, table_name)
+            tables[table_name] = dict(table)
+
+            for piece, function in table.items():
+                table[piece] = self.wrap_generator(function.__name__, function)
+
+        self.attached.append((gs, names, tables))
+        self.game_states.append(gs)
+
+
+    def attach_searcher(self, searcher):
+
+        names = list(searcher_methods + searcher_timed_methods)
+
+        for name in names:
+            setattr(searcher, name, self.wrap(name, getattr(searcher, name), self.timing and name in searcher_timed_methods))
+
+        self.attached.append((searcher, names, {}))
+        self.searchers.append(searcher)
+
+
+    # takes every wrapper off again, the counts are kept until reset
+
+    def detach(self):
+
+        for instance, names, tables in self.attached:
+
+            for name in names:
+                delattr(instance, name)
+
+            for table_name, original in tables.items():
+                getattr(instance, table_name).update(original)
+
+        self.attached = []
+        self.game_states = []
+        self.searchers = []
+
+
+    def wrap(self, name, method, timed):
+
+        calls = self.calls
+        calls.setdefault(name, 0)
+
+        if not timed:
+
+            def counted(*args):
+                calls[name] += 1
+                return method(*args)
+
+            return counted
+
+        buckets = self.latency.setdefault(name, [0] * histogram_buckets)
+        total_ns = self.total_ns
+        total_ns.setdefault(name, 0)
+        clock = time.perf_counter_ns
+        last = histogram_buckets - 1
+
+        def timed_call(*args):
+
+            start = clock()
+            result = method(*args)
+            elapsed = clock() - start
+
+            calls[name] += 1
+            total_ns[name] += elapsed
+            buckets[min(elapsed.bit_length(), last)] += 1
+
+            return result
+
+        return timed_call
+
+
+    def wrap_generator(self, name, function):
+
+        generated = self.generated
+        generated.setdefault(name, 0)
+
+        def counted(r, c, moves):
+            before = len(moves)
+            function(r, c, moves)
+            generated[name] += len(moves) - before
+
+        return counted
+
+
+    def snapshot(self):
+
+        elapsed = time.perf_counter() - self.started
+        latency = {}
+
+        for name, buckets in self.latency.items():
+
+            count = sum(buckets)
+
+            if count:
+                latency[name] = {'calls': count, 'mean_ns': self.total_ns[name] / count, 'p50_ns_at_most': percentile_bound(buckets, 0.5),
+                    'p99_ns_at_most': percentile_bound(buckets, 0.99), 'histogram': {str(1 << i): n for i, n in enumerate(buckets) if n}}
+
+        snapshot = {'time': time.time(), 'elapsed': elapsed, 'calls': dict(self.calls),
+            'calls_per_second': {name: count / elapsed if elapsed else 0.0 for name, count in self.calls.items()},
+            'latency': latency}
+
+        generated = {name: count for name, count in self.generated.items() if count}
+
+        caches = [gs.move_cache.stats() for gs in self.game_states if getattr(gs, 'move_cache', None) is not None]
+        tables = [searcher.table.stats() for searcher in self.searchers]
+
+        if generated:
+            snapshot['generated'] = generated
+
+        if caches:
+            snapshot['move_cache'] = caches
+
+        if tables:
+            snapshot['transposition_table'] = tables
+            snapshot['tablebase_hits'] = sum(searcher.tablebase_hits for searcher in self.searchers)
+
+        return snapshot
+
+
+    def to_json(self, indent = None):
+        return json.dumps(self.snapshot(), indent = indent, sort_keys = True)
+
+
+    # one line with the call counts, median latency bounds and hit rates, for a log
+
+    def log_line(self):
+
+        snapshot = self.snapshot()
+        parts = ["%.1fs" % snapshot['elapsed']]
+
+        for name in sorted(snapshot['calls']):
+
+            part = "%s %d" % (name, snapshot['calls'][name])
+
+            if name in snapshot['latency']:
+                part += " (p50 <= %s)" % format_ns(snapshot['latency'][name]['p50_ns_at_most'])
+
+            parts.append(part)
+
+        for stats in snapshot.get('move_cache', []):
+            parts.append("move cache %.1f%%" % (stats['hit_rate'] * 100))
+
+        for stats in snapshot.get('transposition_table', []):
+            parts.append("table %.1f%%" % (stats['hit_rate'] * 100))
+
+        return ', '.join(parts)
+
+
+    # writes log_line to out every interval seconds from a background thread until stop_logging
+
+    def start_logging(self, interval = 10.0, out = sys.stderr):
+
+        self.logging_stop = threading.Event()
+
+        def run():
+
+            while not self.logging_stop.wait(interval):
+                out.write(self.log_line() + '\n')
+                out.flush()
+
+        self.logging_thread = threading.Thread(target = run, daemon = True)
+        self.logging_thread.start()
+
+
+    # does nothing when logging wasn't started
+
+    def stop_logging(self):
+
+        if self.logging_thread is None:
+            return
+
+        self.logging_stop.set()
+        self.logging_thread.join()
+        self.logging_stop = None
+        self.logging_thread = None
+
+
+# upper bound in nanoseconds of the bucket holding the given share of the calls. The buckets are powers of two wide,
+# so the percentile itself can be anywhere down to half of this
+
+def percentile_bound(buckets, share):
+
+    target = share * sum(buckets)
+    seen = 0
+
+    for i, count in enumerate(buckets):
+
+        seen += count
+
+        if seen >= target:
+            return 1 << i
+
+    return 1 << (len(buckets) - 1)
+
+
+def format_ns(ns):
+
+    if ns < 1000:
+        return "%dns" % ns
+
+    if ns < 1000000:
+        return "%.1fus" % (ns / 1000)
+
+    return "%.1fms" % (ns / 1000000)
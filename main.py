@@ -2,14 +2,18 @@
 Main file responsible for handling user input and displaying the current game state object.
 """
 
+import argparse, sys
+
 import pygame, engine
+from opponent import Engine_Opponent
+from search import Search_Limits
 
 
 width = height = 512
 dimension = 8 # dimension of the board
 square_size = height // dimension
-max_fps = 15 # for animation
 images = {}
+engine_event = pygame.USEREVENT # carries a search result from the engine opponent, see opponent.py
 
 # Load images
 
@@ -22,17 +26,39 @@ def load_images():
 
 # Handling user input and displaying graphics
 
-def main():
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Play chess on the board, against another player or the engine.")
+    parser.add_argument("--engine", choices = ["white", "black"], default = None, help = "side the engine plays, both sides are human without it")
+    parser.add_argument("--depth", type = int, default = None)
+    parser.add_argument("--time", type = float, default = None, help = "seconds per engine move")
+    parser.add_argument("--ponder", action = "store_true", help = "let the engine think on the expected reply while it waits")
+    args = parser.parse_args(argv)
 
     pygame.init()
 
     screen = pygame.display.set_mode((width, height))
-    clock = pygame.time.Clock()
     gs = engine.GameState() # GameState object
+    gs.move_cache = engine.Move_Cache() # undoing back to a position reuses its moves
     valid_moves = gs.get_valid_moves()
     move_made = False
     
     load_images()
+    board_surface = render_board()
+
+    # the board as it was last drawn, squares that differ from it are redrawn
+    drawn_board = [row[:] for row in gs.board]
+    draw_game_state(screen, gs, board_surface)
+    pygame.display.flip()
+
+    # the engine searches in its own process and posts its results as engine_event, so this loop never waits on it
+    opponent = None
+    engine_white = args.engine == "white"
+    engine_moved = False
+
+    if args.engine:
+        post_result = lambda message: pygame.event.post(pygame.event.Event(engine_event, message = message))
+        opponent = Engine_Opponent(Search_Limits(args.depth, time = args.time), post_result, args.ponder)
 
     running = True
 
@@ -42,12 +68,15 @@ def main():
 
     while running:
 
-        for e in pygame.event.get():
+        redraw_all = False
+
+        # sleep until something happens, then handle everything that's queued
+        for e in [pygame.event.wait()] + pygame.event.get():
 
             if e.type == pygame.QUIT:
                 running = False
             
-            elif e.type == pygame.MOUSEBUTTONDOWN:
+            elif e.type == pygame.MOUSEBUTTONDOWN and (opponent is None or gs.white_to_move != engine_white):
                 location = pygame.mouse.get_pos() # (x, y) getting the location of the mouse
                 col = location[0] // square_size
                 row = location[1] // square_size
@@ -63,11 +92,10 @@ def main():
                 if len(player_clicks) == 2: # after 2nd click
                     move = engine.Move(player_clicks[0], player_clicks[1], gs.board)
 
-                    print(move.get_chess_notation())
-
                     for i in range(len(valid_moves)):
 
                         if move == valid_moves[i]:
+                            print(gs.get_san(valid_moves[i], valid_moves))
                             gs.make_move(valid_moves[i])
                             move_made = True
                             square_selected = () # reset the user clicks
@@ -79,25 +107,85 @@ def main():
             elif e.type == pygame.KEYDOWN:
 
                 if e.key == pygame.K_z:
+
+                    if opponent is not None: # drop the engine's search, and take back its move too so the user is to move
+                        opponent.cancel()
+
+                        if gs.white_to_move != engine_white:
+                            gs.undo_move()
+
                     gs.undo_move() 
                     move_made = True                   
+
+            elif e.type == engine_event:
+
+                move = opponent.take_result(gs, e.message)
+
+                if move is not None:
+                    print(gs.get_san(move, valid_moves))
+                    gs.make_move(move)
+                    move_made = True
+                    engine_moved = True
+
+            elif e.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED): # the window was covered or restored
+                redraw_all = True
                 
         if move_made:
             valid_moves = gs.get_valid_moves()
             move_made = False
 
-        draw_game_state(screen, gs)
-        clock.tick(max_fps)
-        pygame.display.flip()
+            if engine_moved and valid_moves:
+                opponent.start_pondering(gs)
+
+            engine_moved = False
+
+        # the engine's turn: start its search, or play straight away when it has already searched the position while pondering
+        if opponent is not None and gs.white_to_move == engine_white and valid_moves and not opponent.thinking():
+
+            move = opponent.request_move(gs)
+
+            if move is not None:
+                print(gs.get_san(move, valid_moves))
+                gs.make_move(move)
+                valid_moves = gs.get_valid_moves()
+
+                if valid_moves:
+                    opponent.start_pondering(gs)
+
+        if redraw_all:
+            draw_game_state(screen, gs, board_surface)
+            pygame.display.flip()
+
+        else:
+            pygame.display.update(draw_changed_squares(screen, gs.board, drawn_board, board_surface))
+
+        drawn_board = [row[:] for row in gs.board]
+
+    if opponent is not None:
+        opponent.close()
+
+    pygame.quit()
+
+    return 0
 
 
 # Draw the graphics in the current game state
-def draw_game_state(screen, gs):
+def draw_game_state(screen, gs, board_surface):
     
-    draw_board(screen)
+    screen.blit(board_surface, (0, 0))
     draw_pieces(screen, gs.board)
 
 
+# the empty checkerboard, drawn once and copied to the screen from then on
+
+def render_board():
+
+    surface = pygame.Surface((width, height)).convert()
+    draw_board(surface)
+
+    return surface
+
+
 def draw_board(screen):
     
     colors = [pygame.Color("white"), pygame.Color("gray")]
@@ -111,6 +199,30 @@ def draw_board(screen):
             pygame.draw.rect(screen, color, pygame.Rect(c * square_size, r * square_size, square_size, square_size))
 
 
+# redraws the squares whose piece differs from drawn_board, covering captures, castling, en passant and undos alike
+# returns the rectangles drawn, for pygame.display.update
+
+def draw_changed_squares(screen, board, drawn_board, board_surface):
+
+    rects = []
+
+    for r in range(dimension):
+
+        for c in range(dimension):
+
+            if board[r][c] != drawn_board[r][c]:
+
+                rect = pygame.Rect(c * square_size, r * square_size, square_size, square_size)
+                screen.blit(board_surface, rect, rect)
+
+                if board[r][c] != "--":
+                    screen.blit(images[board[r][c]], rect)
+
+                rects.append(rect)
+
+    return rects
+
+
 def draw_pieces(screen, board):
     
     for r in range(dimension):
@@ -125,4 +237,4 @@ def draw_pieces(screen, board):
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
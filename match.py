@@ -0,0 +1,317 @@
+"""
+Headless engine against engine matches over a process pool. Every opening is played twice with the colours swapped, finished games are written out as PGN as soon as they come in, and the running score is reported as an Elo difference with a 95% error bar.
+"""
+
+import argparse, math, os, random, sys, time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import engine, pgn
+from search import Search_Limits, Searcher
+from tablebase import insufficient
+from transposition import Transposition_Table
+
+
+start_fen = pgn.start_fen
+
+
+# 'depth=4', 'nodes=20000,time=0.5' -> Search_Limits
+
+def parse_limits(text):
+
+    values = {}
+
+    for part in text.split(','):
+
+        name, equals, value = part.partition('=')
+
+        if name not in ('depth', 'nodes', 'time') or not equals:
+            raise ValueError("limits look like depth=4,nodes=20000,time=0.5, not " + text)
+
+        values[name] = float(value) if name == 'time' else int(value)
+
+    return Search_Limits(values.get('depth'), values.get('nodes'), values.get('time'))
+
+
+# start positions from an opening suite: a PGN file, each game's moves played from its start, or one FEN or EPD line per position
+
+def load_openings(path):
+
+    if path.endswith('.pgn'):
+
+        openings = []
+
+        for game in pgn.read_games(path):
+
+            gs = engine.GameState(game.start_fen())
+
+            for san in game.moves:
+                gs.make_move(gs.parse_san(san))
+
+            openings.append(gs.get_fen())
+
+        return openings
+
+    openings = []
+
+    with open(path) as file:
+
+        for line in file:
+
+            fields = line.split()
+
+            if fields and not line.startswith('#'): # EPD lines have operations where a FEN has its move counters
+                openings.append(' '.join(fields[:6] if len(fields) >= 6 and fields[4].isdigit() else fields[:4]))
+
+    return openings
+
+
+# openings made by playing random legal moves from the start position, for when there's no suite
+
+def random_openings(count, plies, rng):
+
+    openings = []
+
+    while len(openings) < count:
+
+        gs = engine.GameState()
+
+        for ply in range(plies):
+
+            moves = gs.get_valid_moves()
+
+            if not moves:
+                break
+
+            gs.make_move(rng.choice(moves))
+
+        if gs.get_valid_moves():
+            openings.append(gs.get_fen())
+
+    return openings
+
+
+# (result, termination) once the game in gs is over, None while it goes on
+# moves are the legal moves in gs, getting them set the checkmate, stalemate and draw flags
+
+def adjudicate(gs, moves, max_plies):
+
+    if not moves:
+
+        if gs.checkmate:
+            return ('0-1' if gs.white_to_move else '1-0'), 'checkmate'
+
+        return '1/2-1/2', 'stalemate'
+
+    if gs.draw_by_repetition:
+        return '1/2-1/2', 'repetition'
+
+    if gs.draw_by_fifty_moves:
+        return '1/2-1/2', 'fifty moves'
+
+    if insufficient([piece for row in gs.board for piece in row if piece != '--']):
+        return '1/2-1/2', 'insufficient material'
+
+    if len(gs.move_log) >= max_plies:
+        return '1/2-1/2', 'move limit'
+
+    return None
+
+
+# runs in a worker process: plays one game from fen, limits are (depth, nodes, time) for white then black
+# each side keeps its own transposition table for the whole game
+# returns (game number, result, termination, [san moves], nodes)
+
+def play_game(number, fen, white_limits, black_limits, max_plies, table_mb):
+
+    gs = engine.GameState(fen)
+    limits = (Search_Limits(*white_limits), Search_Limits(*black_limits))
+    tables = (Transposition_Table(table_mb), Transposition_Table(table_mb))
+
+    sans = []
+    nodes = 0
+
+    while True:
+
+        moves = gs.get_valid_moves()
+        over = adjudicate(gs, moves, max_plies)
+
+        if over is not None:
+            return (number,) + over + (sans, nodes)
+
+        side = 0 if gs.white_to_move else 1
+        result = Searcher(gs, limits[side], tables[side]).search()
+        nodes += result.nodes
+
+        sans.append(gs.get_san(result.move, moves))
+        gs.make_move(result.move)
+
+
+# (elo, lower, upper) from the first player's point of view, the bounds 95% from the spread of the game scores
+# a score of 0 or 1 gives an infinite difference
+
+def elo_difference(wins, draws, losses):
+
+    games = wins + draws + losses
+
+    if games == 0:
+        return 0.0, 0.0, 0.0
+
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    margin = 1.96 * math.sqrt(variance / games)
+
+    return elo(score), elo(score - margin), elo(score + margin)
+
+
+def elo(score):
+
+    if score <= 0:
+        return -math.inf
+
+    if score >= 1:
+        return math.inf
+
+    return 400 * math.log10(score / (1 - score))
+
+
+# plays two games per opening, the first player white in the first one, over workers processes
+# finished games go to pgn_file as they arrive, in whatever order they finish. Returns (wins, draws, losses, seconds) for the first player
+
+def run_match(openings, first, second, workers = 1, max_plies = 400, table_mb = 4, pgn_file = None, report_every = 100, out = sys.stdout):
+
+    first_limits = (first.depth, first.nodes, first.time)
+    second_limits = (second.depth, second.nodes, second.time)
+
+    def games():
+
+        for i, fen in enumerate(openings):
+            yield 2 * i, fen, first_limits, second_limits
+            yield 2 * i + 1, fen, second_limits, first_limits
+
+    wins = draws = losses = 0
+    start = time.perf_counter()
+    fens = {}
+
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+
+        pending = set()
+        queued = games()
+        exhausted = False
+
+        while pending or not exhausted:
+
+            while not exhausted and len(pending) < workers * 2: # a few games in flight per worker keeps memory flat
+
+                game = next(queued, None)
+
+                if game is None:
+                    exhausted = True
+                    break
+
+                number, fen, white_limits, black_limits = game
+                fens[number] = fen
+                pending.add(executor.submit(play_game, number, fen, white_limits, black_limits, max_plies, table_mb))
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+
+            for future in done:
+
+                number, result, termination, sans, nodes = future.result()
+                first_white = number % 2 == 0
+
+                if result == '1/2-1/2':
+                    draws += 1
+
+                elif (result == '1-0') == first_white:
+                    wins += 1
+
+                else:
+                    losses += 1
+
+                fen = fens.pop(number)
+
+                if pgn_file is not None:
+                    pgn_file.write(pgn.format_game(game_record(number, fen, first_white, result, termination, sans)))
+                    pgn_file.flush()
+
+                played = wins + draws + losses
+
+                if played % report_every == 0:
+                    out.write(report(wins, draws, losses, time.perf_counter() - start) + '\n')
+                    out.flush()
+
+    return wins, draws, losses, time.perf_counter() - start
+
+
+def game_record(number, fen, first_white, result, termination, sans):
+
+    names = ('first', 'second') if first_white else ('second', 'first')
+    headers = {'Event': 'match', 'Site': '?', 'Date': '????.??.??', 'Round': str(number + 1), 'White': names[0], 'Black': names[1],
+        'Result': result}
+
+    if fen != start_fen:
+        headers['SetUp'] = '1'
+        headers['FEN'] = fen
+
+    headers['Termination'] = termination
+    headers['PlyCount'] = str(len(sans))
+
+    return pgn.Pgn_Game(headers, sans, result)
+
+
+def report(wins, draws, losses, elapsed):
+
+    games = wins + draws + losses
+    difference, lower, upper = elo_difference(wins, draws, losses)
+
+    return "%d games +%d =%d -%d, %.2f games/s, elo %+.1f (%+.1f to %+.1f)" % (games, wins, draws, losses,
+        games / elapsed if elapsed else 0.0, difference, lower, upper)
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Play engine against engine matches and report the Elo difference.")
+    parser.add_argument("--first", default = "depth=3", help = "search limits of the first player, e.g. depth=4 or nodes=20000,time=0.5")
+    parser.add_argument("--second", default = "depth=2")
+    parser.add_argument("--games", type = int, default = 100, help = "games to play, rounded up to an even number")
+    parser.add_argument("--openings", default = None, help = "opening suite, a PGN file or one FEN/EPD per line")
+    parser.add_argument("--random-plies", type = int, default = 8, help = "random moves per opening when there's no suite")
+    parser.add_argument("--seed", type = int, default = None)
+    parser.add_argument("--workers", type = int, default = os.cpu_count() or 1)
+    parser.add_argument("--max-plies", type = int, default = 400, help = "longer games are drawn")
+    parser.add_argument("--hash", type = int, default = 4, help = "transposition table size in MB for each side")
+    parser.add_argument("--pgn", default = None, help = "write the games here as they finish")
+    parser.add_argument("--report-every", type = int, default = 100)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    pairs = (args.games + 1) // 2
+
+    if args.openings:
+        suite = load_openings(args.openings)
+        openings = [rng.choice(suite) for i in range(pairs)] if pairs > len(suite) else rng.sample(suite, pairs)
+
+    else:
+        openings = random_openings(pairs, args.random_plies, rng)
+
+    pgn_file = open(args.pgn, 'w') if args.pgn else None
+
+    try:
+        wins, draws, losses, elapsed = run_match(openings, parse_limits(args.first), parse_limits(args.second), args.workers,
+            args.max_plies, args.hash, pgn_file, args.report_every)
+
+    finally:
+
+        if pgn_file is not None:
+            pgn_file.close()
+
+    print(report(wins, draws, losses, elapsed))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
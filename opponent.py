@@ -0,0 +1,195 @@
+"""
+Computer opponent for the GUI. Searches run in a worker process and their results come back over a queue, so the pygame loop keeps handling events while the engine thinks. A search can be cancelled, and the worker can ponder on the reply it expects while the user is thinking.
+"""
+
+import multiprocessing, queue, threading
+
+import engine
+from search import Search_Limits, Searcher
+from transposition import Transposition_Table
+
+
+# runs in the worker process. Requests are (search id, fen, [uci moves], depth, nodes, seconds), None shuts the worker down
+# the moves are played from fen first, see GameState.get_history, so the search knows which positions would repeat
+# results go back as (search id, uci move or None, [uci pv], score, depth)
+# the table is kept between searches, so a search after a ponder on the same position starts from what the ponder found
+
+def engine_worker(requests, results, stop, table_mb):
+
+    table = Transposition_Table(table_mb)
+
+    while True:
+
+        request = requests.get()
+
+        while True: # only the newest request matters, older ones have been cancelled
+
+            try:
+                request = requests.get_nowait()
+
+            except queue.Empty:
+                break
+
+        if request is None:
+            return
+
+        stop.clear()
+        search_id, fen, moves, depth, nodes, seconds = request
+
+        gs = engine.GameState()
+        gs.load_history(fen, moves)
+
+        result = Searcher(gs, Search_Limits(depth, nodes, seconds, stop), table).search()
+        results.put((search_id, result.move.get_uci_notation() if result.move else None,
+            [move.get_uci_notation() for move in result.pv], result.score, result.depth))
+
+
+class Engine_Opponent():
+
+    # limits is a Search_Limits for every engine move, its stop is ignored
+    # notify is called on a listener thread with every result tuple the worker sends back (see engine_worker); the GUI posts it as a pygame event
+    # and hands it to take_result from its own loop
+
+    def __init__(self, limits, notify, ponder = False, table_mb = 16):
+
+        self.limits = limits
+        self.ponder = ponder
+
+        self.requests = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.stop = multiprocessing.Event()
+
+        self.process = multiprocessing.Process(target = engine_worker, args = (self.requests, self.results, self.stop, table_mb), daemon = True)
+        self.process.start()
+
+        self.listener = threading.Thread(target = self.listen, args = (notify,), daemon = True)
+        self.listener.start()
+
+        self.next_id = 0
+        self.searching = None # (search id, history) of the search whose move is wanted, history is from GameState.get_history
+        self.pondering = None # (search id, history) of the search on the position the engine expects after the user's reply
+        self.pondered = None # the ponder search's result once it has finished
+        self.last_pv = [] # uci principal variation of the last move handed out
+
+
+    def listen(self, notify):
+
+        while True:
+
+            message = self.results.get()
+
+            if message is None:
+                return
+
+            notify(message)
+
+
+    def send(self, history):
+
+        self.next_id += 1
+        self.requests.put((self.next_id,) + history + (self.limits.depth, self.limits.nodes, self.limits.time))
+
+        return self.next_id
+
+
+    # starts a search for the side to move in gs, its move comes back through take_result
+    # if the worker pondered on this position the ponder search carries on as this one, and when it has already finished
+    # its move is returned here straight away. Otherwise returns None
+
+    def request_move(self, gs):
+
+        history = gs.get_history()
+
+        if self.pondering is not None and self.pondering[1] == history:
+
+            search_id = self.pondering[0]
+            finished = self.pondered
+            self.pondering = None
+            self.pondered = None
+
+            if finished is None:
+                self.searching = (search_id, history)
+                return None
+
+            return self.legal_move(gs, finished)
+
+        self.cancel()
+        self.searching = (self.send(history), history)
+
+        return None
+
+
+    def thinking(self):
+        return self.searching is not None
+
+
+    # the engine's move as a Move legal in gs when message answers the search asked for, otherwise None
+    # the move isn't played here
+
+    def take_result(self, gs, message):
+
+        search_id = message[0]
+
+        if self.pondering is not None and search_id == self.pondering[0]: # kept for request_move
+            self.pondered = message
+            return None
+
+        if self.searching is None or search_id != self.searching[0]:
+            return None
+
+        self.searching = None
+
+        return self.legal_move(gs, message)
+
+
+    def legal_move(self, gs, message):
+
+        search_id, uci, pv, score, depth = message
+        self.last_pv = pv
+
+        return {move.get_uci_notation(): move for move in gs.get_valid_moves()}.get(uci)
+
+
+    # with pondering on, call after the engine's move has been played in gs: searches the position after the reply
+    # the engine's principal variation expects, while the user thinks
+
+    def start_pondering(self, gs):
+
+        pv = self.last_pv
+
+        if not self.ponder or len(pv) < 2:
+            return
+
+        moves = {move.get_uci_notation(): move for move in gs.get_valid_moves()}
+
+        if pv[1] not in moves:
+            return
+
+        gs.make_move(moves[pv[1]])
+        history = gs.get_history()
+        gs.undo_move()
+        gs.get_valid_moves() # restore the checkmate/stalemate flags
+
+        self.pondering = (self.send(history), history)
+        self.pondered = None
+
+
+    # drops the search in progress and any ponder search, their results will be ignored when they arrive
+
+    def cancel(self):
+
+        if self.searching is not None or self.pondering is not None:
+            self.stop.set()
+
+        self.searching = None
+        self.pondering = None
+        self.pondered = None
+
+
+    def close(self):
+
+        self.cancel()
+        self.requests.put(None)
+        self.process.join(5)
+        self.results.put(None)
+        self.listener.join(5)
@@ -0,0 +1,196 @@
+"""
+Parallel search: the root moves are split between worker processes, each one searching its share with its own Searcher. Positions travel to the workers as a FEN string and the moves played from it, so the workers still see repetitions. Moves go as uci notation, never as pickled GameState or Move objects.
+"""
+
+import argparse, sys, time
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+from search import Search_Limits, Search_Result, Searcher, best_move
+from transposition import Transposition_Table
+
+
+# runs in a worker process: iterative deepening over the given root moves of the position history_moves lead to from fen
+# returns (nodes, [(depth, score, [uci pv]) for every completed depth])
+
+def search_root_moves(fen, history_moves, root_moves, depth, nodes, seconds, table_mb):
+
+    gs = engine.GameState()
+    gs.load_history(fen, history_moves)
+
+    completed = []
+
+    def record(result):
+        completed.append((result.depth, result.score, [move.get_uci_notation() for move in result.pv]))
+
+    searcher = Searcher(gs, Search_Limits(depth, nodes, seconds), Transposition_Table(table_mb), set(root_moves))
+    searcher.search(record)
+
+    return searcher.nodes, completed
+
+
+# deal the root moves out round robin, so every worker gets some of the likely good ones
+
+def split_root_moves(moves, workers):
+
+    shares = [[] for i in range(min(workers, len(moves)))]
+
+    for i in range(len(moves)):
+        shares[i % len(shares)].append(moves[i].get_uci_notation())
+
+    return shares
+
+
+# like search.best_move but over a process pool. limits.nodes is split evenly between the workers
+# executor can be a ProcessPoolExecutor kept between calls, otherwise one with workers processes is made for this search
+# book is an Opening_Book, checked here before any worker is started
+
+def parallel_best_move(gs, limits = None, workers = 4, executor = None, table_mb = 16, book = None):
+
+    limits = limits or Search_Limits()
+    start = time.perf_counter()
+
+    if book is not None:
+
+        move = book.choose(gs)
+
+        if move is not None:
+            return Search_Result(move, 0, 0, 0, time.perf_counter() - start, [move])
+
+    root_moves = gs.get_valid_moves()
+
+    if len(root_moves) <= 1 or workers <= 1:
+        return best_move(gs, limits)
+
+    # a quick shallow search puts the likely best move first, in the first worker's share
+    shallow = best_move(gs, Search_Limits(depth = 1))
+    root_moves.sort(key = lambda move: move != shallow.move)
+
+    fen, history_moves = gs.get_history()
+    shares = split_root_moves(root_moves, workers)
+    nodes = limits.nodes // len(shares) if limits.nodes is not None else None
+
+    own_executor = executor is None
+
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers = len(shares))
+
+    try:
+        futures = [executor.submit(search_root_moves, fen, history_moves, share, limits.depth, nodes, limits.time, table_mb)
+            for share in shares]
+        results = [future.result() for future in futures]
+
+    finally:
+
+        if own_executor:
+            executor.shutdown()
+
+    total_nodes = shallow.nodes + sum(result[0] for result in results)
+    elapsed = time.perf_counter() - start
+
+    # compare the workers at the deepest depth every one of them finished
+    common_depth = min(result[1][-1][0] if result[1] else 0 for result in results)
+
+    if common_depth == 0:
+        shallow.nodes = total_nodes
+        shallow.time = elapsed
+        return shallow
+
+    best = None
+
+    for result in results:
+
+        for depth, score, pv in result[1]:
+
+            if depth == common_depth and (best is None or score > best[0]):
+                best = (score, pv)
+
+    moves_by_uci = {move.get_uci_notation(): move for move in root_moves}
+    pv = [moves_by_uci[best[1][0]]] + replay_pv(gs, best[1])
+
+    return Search_Result(pv[0], best[0], common_depth, total_nodes, elapsed, pv)
+
+
+# turns the rest of a uci principal variation back into Move objects for gs
+
+def replay_pv(gs, uci_pv):
+
+    played = 0
+    pv = []
+
+    for uci in uci_pv:
+
+        moves = {move.get_uci_notation(): move for move in gs.get_valid_moves()}
+
+        if uci not in moves:
+            break
+
+        if played:
+            pv.append(moves[uci])
+
+        gs.make_move(moves[uci])
+        played += 1
+
+    for i in range(played):
+        gs.undo_move()
+
+    gs.get_valid_moves() # restore the root checkmate/stalemate flags
+
+    return pv
+
+
+# time one search at each worker count, speedup is measured against a single worker
+
+def scaling_benchmark(fen, limits, worker_counts, out = sys.stdout):
+
+    base_time = None
+    rows = []
+
+    for workers in worker_counts:
+
+        gs = engine.GameState()
+        gs.load_fen(fen)
+
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+
+            executor.submit(int).result() # start the pool outside the timed search
+            start = time.perf_counter()
+            result = parallel_best_move(gs, limits, workers, executor)
+            elapsed = time.perf_counter() - start
+
+        if base_time is None:
+            base_time = elapsed
+
+        rows.append((workers, elapsed, base_time / elapsed, result))
+        out.write("%2d workers: %.2fs speedup %.2fx depth %d nodes %d nps %d best %s\n" % (workers, elapsed, base_time / elapsed,
+            result.depth, result.nodes, int(result.nodes / elapsed), result.move.get_uci_notation() if result.move else "(none)"))
+
+    return rows
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Search a position over a process pool, or measure how the search scales.")
+    parser.add_argument("--fen", default = "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
+    parser.add_argument("--depth", type = int, default = 3)
+    parser.add_argument("--workers", type = int, nargs = "+", default = [1, 2, 4, 8, 16])
+    parser.add_argument("--bench", action = "store_true", help = "report the speedup at every worker count")
+    args = parser.parse_args(argv)
+
+    limits = Search_Limits(depth = args.depth)
+
+    if args.bench:
+        scaling_benchmark(args.fen, limits, args.workers)
+        return 0
+
+    gs = engine.GameState()
+    gs.load_fen(args.fen)
+
+    result = parallel_best_move(gs, limits, args.workers[0])
+    print(result)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""
+Perft: counts the leaf nodes of the legal move tree to a given depth. Used as a correctness gate against known counts and as a move generation benchmark.
+"""
+
+import argparse, sys, time
+
+import bitboard, engine
+
+
+backends = {'mailbox': engine.GameState, 'bitboard': bitboard.BitboardGameState}
+
+# name, FEN, {depth: nodes}
+reference_positions = [
+    ("start", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+        {1: 20, 2: 400, 3: 8902, 4: 197281, 5: 4865609}),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        {1: 48, 2: 2039, 3: 97862, 4: 4085603}),
+    ("rook endgame", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        {1: 14, 2: 191, 3: 2812, 4: 43238, 5: 674624}),
+    ("promotions", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        {1: 6, 2: 264, 3: 9467, 4: 422333}),
+    ("promotion with check", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        {1: 44, 2: 1486, 3: 62379, 4: 2103487}),
+    ("middlegame", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+        {1: 46, 2: 2079, 3: 89890, 4: 3894594}),
+    ("illegal en passant", "3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1",
+        {1: 18, 2: 92, 3: 1670, 4: 10138, 5: 185429, 6: 1134888}),
+    ("illegal en passant 2", "8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1",
+        {1: 13, 2: 102, 3: 1266, 4: 10276, 5: 135655, 6: 1015133}),
+    ("en passant gives check", "8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1",
+        {1: 15, 2: 126, 3: 1928, 4: 13931, 5: 206379, 6: 1440467}),
+    ("short castle gives check", "5k2/8/8/8/8/8/8/4K2R w K - 0 1",
+        {1: 15, 2: 66, 3: 1198, 4: 6399, 5: 120330, 6: 661072}),
+    ("long castle gives check", "3k4/8/8/8/8/8/8/R3K3 w Q - 0 1",
+        {1: 16, 2: 71, 3: 1286, 4: 7418, 5: 141077, 6: 803711}),
+    ("castle rights", "r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1",
+        {1: 26, 2: 1141, 3: 27826, 4: 1274206}),
+    ("castling prevented", "r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1",
+        {1: 44, 2: 1494, 3: 50509, 4: 1720476}),
+    ("promote out of check", "2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1",
+        {1: 11, 2: 133, 3: 1442, 4: 19174, 5: 266199, 6: 3821001}),
+    ("discovered check", "8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1",
+        {1: 29, 2: 165, 3: 5160, 4: 31961, 5: 1004658}),
+    ("promote to give check", "4k3/1P6/8/8/8/8/K7/8 w - - 0 1",
+        {1: 9, 2: 40, 3: 472, 4: 2661, 5: 38983, 6: 217342}),
+    ("under promote to give check", "8/P1k5/K7/8/8/8/8/8 w - - 0 1",
+        {1: 6, 2: 27, 3: 273, 4: 1329, 5: 18135, 6: 92683}),
+    ("self stalemate", "K1k5/8/P7/8/8/8/8/8 w - - 0 1",
+        {1: 2, 2: 6, 3: 13, 4: 63, 5: 382, 6: 2217}),
+    ("stalemate and checkmate", "8/k1P5/8/1K6/8/8/8/8 w - - 0 1",
+        {1: 10, 2: 25, 3: 268, 4: 926, 5: 10857, 6: 43261, 7: 567584}),
+    ("stalemate and checkmate 2", "8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1",
+        {1: 37, 2: 183, 3: 6559, 4: 23527}),
+]
+
+
+def perft(gs, depth):
+
+    moves = gs.get_valid_moves()
+
+    if depth == 1:
+        return len(moves) # bulk count the last ply
+
+    nodes = 0
+
+    for move in moves:
+        gs.make_move(move)
+        nodes += perft(gs, depth - 1)
+        gs.undo_move()
+
+    return nodes
+
+
+# node count below each root move, {uci move: nodes}
+
+def divide(gs, depth):
+
+    counts = {}
+
+    for move in gs.get_valid_moves():
+
+        if depth == 1:
+            counts[move.get_uci_notation()] = 1
+            continue
+
+        gs.make_move(move)
+        counts[move.get_uci_notation()] = perft(gs, depth - 1)
+        gs.undo_move()
+
+    return counts
+
+
+def new_game_state(backend, fen):
+
+    gs = backends[backend]()
+    gs.load_fen(fen)
+
+    return gs
+
+
+# runs every reference count up to max_nodes, returns (failures, nodes, seconds)
+
+def run_suite(backend, max_nodes, out = sys.stdout):
+
+    failures = 0
+    total_nodes = 0
+    total_time = 0.0
+
+    for name, fen, counts in reference_positions:
+
+        for depth, expected in sorted(counts.items()):
+
+            if expected > max_nodes:
+                continue
+
+            gs = new_game_state(backend, fen)
+
+            start = time.perf_counter()
+            nodes = perft(gs, depth)
+            elapsed = time.perf_counter() - start
+
+            total_nodes += nodes
+            total_time += elapsed
+
+            status = "ok" if nodes == expected else "FAIL"
+
+            if nodes != expected:
+                failures += 1
+
+            out.write("%-4s %-28s depth %d  %10d nodes  expected %10d  %9.0f nodes/s\n"
+                % (status, name, depth, nodes, expected, nodes / elapsed if elapsed else 0))
+
+    return failures, total_nodes, total_time
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Count legal move paths to check and benchmark move generation.")
+    parser.add_argument("--fen", default = reference_positions[0][1], help = "position to search, defaults to the start position")
+    parser.add_argument("--depth", type = int, default = 4)
+    parser.add_argument("--divide", action = "store_true", help = "break the count down by root move")
+    parser.add_argument("--backend", choices = sorted(backends), default = "mailbox")
+    parser.add_argument("--suite", action = "store_true", help = "check every reference position instead of --fen")
+    parser.add_argument("--max-nodes", type = int, default = 1000000, help = "skip suite entries larger than this")
+    args = parser.parse_args(argv)
+
+    if args.suite:
+
+        failures, nodes, elapsed = run_suite(args.backend, args.max_nodes)
+        print("%d failures, %d nodes in %.2fs, %.0f nodes/s" % (failures, nodes, elapsed, nodes / elapsed if elapsed else 0))
+
+        return 1 if failures else 0
+
+    gs = new_game_state(args.backend, args.fen)
+    start = time.perf_counter()
+
+    if args.divide:
+
+        counts = divide(gs, args.depth)
+
+        for move in sorted(counts):
+            print("%s: %d" % (move, counts[move]))
+
+        nodes = sum(counts.values())
+
+    else:
+        nodes = perft(gs, args.depth)
+
+    elapsed = time.perf_counter() - start
+    print("depth %d: %d nodes in %.3fs, %.0f nodes/s" % (args.depth, nodes, elapsed, nodes / elapsed if elapsed else 0))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
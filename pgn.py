@@ -0,0 +1,304 @@
+"""
+Streaming PGN reader: games are read one at a time from a file of any size and replayed through GameState, optionally over a process pool. Used to validate and index large game archives.
+"""
+
+import argparse, re, sys, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+
+
+header_pattern = re.compile(r'^\[(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+
+# movetext tokens: comments, variation brackets, NAGs, results, move numbers, then anything else is a move
+token_pattern = re.compile(r'\{[^}]*\}|;[^\n]*|\(|\)|\$\d+|1-0|0-1|1/2-1/2|\*|\d+\.+|[^\s(){};$]+')
+results = ('1-0', '0-1', '1/2-1/2', '*')
+
+start_fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+
+class Pgn_Game():
+
+    # headers {tag: value}, moves the main line in SAN, offset the byte offset of the game in its file when read from a path
+
+    def __init__(self, headers, moves, result, offset = None):
+
+        self.headers = headers
+        self.moves = moves
+        self.result = result
+        self.offset = offset
+
+
+    def start_fen(self):
+        return self.headers.get('FEN', start_fen)
+
+
+# PGN text for a game, headers in their order then the moves numbered from the game's start position
+
+def format_game(game, width = 79):
+
+    lines = ['[%s "%s"]' % (tag, value.replace('\\', '\\\\').replace('"', '\\"')) for tag, value in game.headers.items()]
+
+    fields = game.start_fen().split()
+    ply = (int(fields[5]) - 1 if len(fields) > 5 else 0) * 2 + (fields[1] == 'b')
+    tokens = []
+
+    for i, san in enumerate(game.moves):
+
+        if (ply + i) % 2 == 0:
+            tokens.append('%d.' % ((ply + i) // 2 + 1))
+
+        elif i == 0: # black moves first
+            tokens.append('%d...' % ((ply + i) // 2 + 1))
+
+        tokens.append(san)
+
+    tokens.append(game.result)
+
+    movetext = []
+    line = ''
+
+    for token in tokens:
+
+        if line and len(line) + 1 + len(token) > width:
+            movetext.append(line)
+            line = token
+
+        else:
+            line = line + ' ' + token if line else token
+
+    movetext.append(line)
+
+    return '\n'.join(lines) + '\n\n' + '\n'.join(movetext) + '\n\n'
+
+
+# the lines of a PGN file as (byte offset, text) pairs, read in binary so the offsets are exact
+
+def pgn_lines(path):
+
+    with open(path, 'rb') as file:
+
+        offset = 0
+
+        for line in file:
+            yield offset, line.decode('utf-8', 'replace')
+            offset += len(line)
+
+
+# Pgn_Game objects one at a time, only the game being read is held in memory
+# source is a path, or any iterable of text lines such as an open file
+
+def read_games(source):
+
+    lines = pgn_lines(source) if isinstance(source, str) else ((None, line) for line in source)
+
+    headers = {}
+    movetext = []
+    game_offset = None
+    in_comment = False # inside a brace comment running over several lines, where [ doesn't start a header
+
+    for offset, line in lines:
+
+        stripped = line.strip()
+
+        if not stripped or stripped.startswith('%'): # blank lines and escaped lines
+            continue
+
+        if stripped.startswith('[') and not in_comment:
+
+            if movetext: # a header after movetext starts the next game
+                yield parse_game(headers, movetext, game_offset)
+                headers = {}
+                movetext = []
+                game_offset = None
+
+            match = header_pattern.match(stripped)
+
+            if match:
+                headers[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+
+        else:
+            movetext.append(stripped)
+            in_comment = comment_open(stripped, in_comment)
+
+        if game_offset is None:
+            game_offset = offset
+
+    if headers or movetext:
+        yield parse_game(headers, movetext, game_offset)
+
+
+# whether a brace comment is still open at the end of a movetext line
+
+def comment_open(line, in_comment):
+
+    for char in line:
+
+        if in_comment:
+            in_comment = char != '}'
+
+        elif char == '{':
+            in_comment = True
+
+        elif char == ';': # the rest of the line is a comment
+            break
+
+    return in_comment
+
+
+# main line moves and result from a game's movetext, comments, annotations and variations are skipped
+
+def parse_game(headers, movetext, offset = None):
+
+    moves = []
+    result = headers.get('Result', '*')
+    depth = 0 # variation nesting
+
+    for token in token_pattern.findall('\n'.join(movetext)):
+
+        if token == '(':
+            depth += 1
+
+        elif token == ')':
+            depth = max(depth - 1, 0)
+
+        elif depth or token[0] in '{;$' or token[0].isdigit() and token.endswith('.'):
+            continue
+
+        elif token in results:
+            result = token
+
+        else:
+            moves.append(token)
+
+    return Pgn_Game(headers, moves, result, offset)
+
+
+# plays a game's moves from its start position, returns (plies played, error or None, final FEN)
+
+def replay_game(game):
+
+    try:
+        gs = engine.GameState(game.start_fen())
+
+    except ValueError as error:
+        return 0, str(error), None
+
+    for san in game.moves:
+
+        try:
+            move = gs.parse_san(san)
+
+        except ValueError as error:
+            return len(gs.move_log), str(error), gs.get_fen()
+
+        gs.make_move(move)
+
+    return len(gs.move_log), None, gs.get_fen()
+
+
+# runs in a worker process
+
+def map_chunk(function, games):
+    return [function(game) for game in games]
+
+
+# (game, function(game)) for every game, in order. function has to be picklable, a module level function or a partial of one
+# with workers > 1 games go through function in chunks over a process pool, with at most two chunks per worker in flight so memory stays flat
+
+def map_games(function, games, workers = 1, chunk_size = 200):
+
+    if workers <= 1:
+
+        for game in games:
+            yield game, function(game)
+
+        return
+
+    pending = deque()
+
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+
+        chunk = []
+
+        for game in games:
+
+            chunk.append(game)
+
+            if len(chunk) == chunk_size:
+
+                pending.append((chunk, executor.submit(map_chunk, function, chunk)))
+                chunk = []
+
+                while len(pending) >= workers * 2:
+                    done, future = pending.popleft()
+                    yield from zip(done, future.result())
+
+        if chunk:
+            pending.append((chunk, executor.submit(map_chunk, function, chunk)))
+
+        while pending:
+            done, future = pending.popleft()
+            yield from zip(done, future.result())
+
+
+# (game, (plies, error, final FEN)) for every game, in order, see map_games
+
+def replay_games(games, workers = 1, chunk_size = 200):
+    return map_games(replay_game, games, workers, chunk_size)
+
+
+# replays every game in a file, writing one tab separated index line per game if index is given
+# returns (games, plies, games with errors, seconds)
+
+def validate_file(path, workers = 1, index = None, out = sys.stdout):
+
+    start = time.perf_counter()
+    games = plies = errors = 0
+
+    for game, (played, error, fen) in replay_games(read_games(path), workers):
+
+        games += 1
+        plies += played
+
+        if error:
+            errors += 1
+            out.write("game %d at byte %s: %s\n" % (games, game.offset, error))
+
+        if index is not None:
+            index.write("%s\t%d\t%s\t%s\t%s\t%s\n" % (game.offset, played, game.result, game.headers.get('White', '?'),
+                game.headers.get('Black', '?'), 'ok' if error is None else 'error'))
+
+        if games % 10000 == 0:
+            elapsed = time.perf_counter() - start
+            out.write("%d games, %d plies, %d errors, %.0f games/s\n" % (games, plies, errors, games / elapsed))
+
+    return games, plies, errors, time.perf_counter() - start
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Replay every game in a PGN file to check it, optionally writing an index.")
+    parser.add_argument("path")
+    parser.add_argument("--workers", type = int, default = 1)
+    parser.add_argument("--index", default = None, help = "write offset, plies, result, white, black and status per game here")
+    args = parser.parse_args(argv)
+
+    index = open(args.index, 'w') if args.index else None
+
+    try:
+        games, plies, errors, elapsed = validate_file(args.path, args.workers, index)
+
+    finally:
+
+        if index is not None:
+            index.close()
+
+    print("%d games, %d plies, %d errors in %.2fs, %.0f games/s" % (games, plies, errors, elapsed, games / elapsed if elapsed else 0))
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
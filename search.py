@@ -0,0 +1,527 @@
+"""
+Search responsible for choosing a move: negamax alpha-beta with iterative deepening, quiescence on captures and principal variation, MVV-LVA, killer and history move ordering. Moves are generated in stages, so a cutoff early in a node skips generating the rest.
+"""
+
+import argparse, sys, time
+
+import engine
+from book import open_book
+from tablebase import Tablebases
+from evaluation import evaluate
+from instrument import Instrumentation
+from transposition import Transposition_Table, exact, lower_bound, upper_bound
+
+
+piece_values = {'p': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 0}
+mate_score = 100000
+max_ply = 128
+
+# tablebase wins score below the mate band, less the plies to mate from the probed position. A mate that far away may not fit
+# in the band, and as ordinary scores they mean the same at whatever ply they're found or read back from the table
+tablebase_win_score = mate_score - 2 * max_ply
+
+# victim and attacker order for MVV-LVA, most valuable victim first then least valuable attacker
+capture_rank = {'p': 0, 'N': 1, 'B': 2, 'R': 3, 'Q': 4, 'K': 5}
+
+capture_score = 100000
+killer_scores = (90000, 80000)
+
+
+class Search_Limits():
+
+    # depth in plies, nodes, time in seconds. Any left as None doesn't limit the search, with none set it stops at default_depth
+    # stop is a threading or multiprocessing Event, the search gives up soon after it's set. It doesn't count as a limit
+
+    default_depth = 4
+
+    def __init__(self, depth = None, nodes = None, time = None, stop = None):
+
+        self.depth = depth
+        self.nodes = nodes
+        self.time = time
+        self.stop = stop
+
+
+class Search_Result():
+
+    def __init__(self, move, score, depth, nodes, elapsed, pv):
+
+        self.move = move # None when there is no legal move
+        self.score = score # centipawns for the side to move
+        self.depth = depth # last fully searched depth
+        self.nodes = nodes
+        self.time = elapsed
+        self.nps = int(nodes / elapsed) if elapsed > 0 else 0
+        self.pv = pv
+
+
+    def __repr__(self):
+        return "depth %d score %d nodes %d time %.3f nps %d pv %s" % (self.depth, self.score, self.nodes, self.time, self.nps,
+            ' '.join(move.get_uci_notation() for move in self.pv))
+
+
+class Searcher():
+
+    # table is a Transposition_Table kept between searches, a fresh one is made when it's None
+    # root_moves limits the root to these moves in uci notation, used to split the root between processes
+    # tablebases is a tablebase.Tablebases, positions below the root found in it are scored exactly without searching
+
+    def __init__(self, gs, limits, table = None, root_moves = None, tablebases = None):
+
+        self.gs = gs
+        self.limits = limits
+        self.table = table if table is not None else Transposition_Table()
+        self.root_moves = root_moves
+        self.tablebases = tablebases
+        self.tablebase_hits = 0
+        self.probe_every_node = tablebases is not None and sum(piece != '--' for row in gs.board for piece in row) <= tablebases.max_pieces
+        self.nodes = 0
+        self.stopped = False
+        self.deadline = None
+
+        self.killers = [[None, None] for ply in range(max_ply)]
+        self.history = {} # (piece, end_row, end_col) -> score, raised by quiet moves causing cutoffs
+        self.previous_pv = []
+        self.follow_pv = False
+
+
+    # iterative deepening, each depth orders its moves from the last one's principal variation
+    # info is called with a Search_Result after every completed depth
+
+    def search(self, info = None):
+
+        limits = self.limits
+        start = time.perf_counter()
+
+        if limits.time is not None:
+            self.deadline = start + limits.time
+
+        if limits.depth is not None:
+            max_depth = limits.depth
+
+        elif limits.nodes is None and limits.time is None:
+            max_depth = Search_Limits.default_depth
+
+        else:
+            max_depth = max_ply - 1
+
+        root_moves = self.filter_root(self.gs.get_valid_moves())
+        result = Search_Result(root_moves[0] if root_moves else None, 0, 0, 0, 0.0, root_moves[:1])
+
+        for depth in range(1, max_depth + 1):
+
+            if not root_moves:
+                break
+
+            self.follow_pv = True
+            score, pv = self.negamax(depth, -mate_score - 1, mate_score + 1, 0)
+
+            if self.stopped: # an unfinished depth can't be trusted
+                break
+
+            self.previous_pv = pv
+            result = Search_Result(pv[0], score, depth, self.nodes, time.perf_counter() - start, pv)
+
+            if info:
+                info(result)
+
+            if abs(score) >= mate_score - max_ply: # found a forced mate
+                break
+
+        self.gs.get_valid_moves() # search leaves the checkmate/stalemate flags of deeper positions behind
+
+        result.nodes = self.nodes
+        result.time = time.perf_counter() - start
+        result.nps = int(result.nodes / result.time) if result.time > 0 else 0
+
+        return result
+
+
+    def filter_root(self, moves):
+
+        if self.root_moves is None:
+            return moves
+
+        return [move for move in moves if move.get_uci_notation() in self.root_moves]
+
+
+    def check_limits(self):
+
+        if self.limits.nodes is not None and self.nodes >= self.limits.nodes:
+            self.stopped = True
+
+        elif self.nodes & 1023 == 0:
+
+            if self.deadline is not None and time.perf_counter() >= self.deadline:
+                self.stopped = True
+
+            elif self.limits.stop is not None and self.limits.stop.is_set():
+                self.stopped = True
+
+
+    # returns (score, principal variation) for the side to move
+
+    def negamax(self, depth, alpha, beta, ply):
+
+        if depth <= 0 or ply >= max_ply - 1:
+            return self.quiescence(alpha, beta, ply), []
+
+        self.nodes += 1
+        self.check_limits()
+
+        if self.stopped:
+            return 0, []
+
+        gs = self.gs
+
+        if ply > 0 and gs.is_draw():
+            return 0, []
+
+        # material only changes on captures and promotions, so the tables are only tried after one unless the root is small enough
+        if self.tablebases is not None and ply > 0 and (self.probe_every_node or gs.move_log[-1].piece_captured != '--' or gs.move_log[-1].is_pawn_promotion):
+
+            found = self.tablebases.probe(gs)
+
+            if found is not None:
+
+                self.tablebase_hits += 1
+                result, plies = found
+
+                return result * (tablebase_win_score - plies), []
+
+        key = gs.zobrist_key
+        entry = self.table.probe(key)
+        hash_move = 0
+
+        if entry is not None:
+
+            entry_depth, bound, score, hash_move = entry
+
+            if entry_depth >= depth and ply > 0: # deep enough to answer from the table
+
+                score = score_from_table(score, ply)
+
+                if bound == exact:
+                    return score, []
+
+                if bound == lower_bound and score >= beta:
+                    return beta, []
+
+                if bound == upper_bound and score <= alpha:
+                    return alpha, []
+
+        original_alpha = alpha
+        pv_move = 0
+
+        if self.follow_pv:
+
+            if ply < len(self.previous_pv):
+                pv_move = self.previous_pv[ply].packed
+
+            else:
+                self.follow_pv = False
+
+        best_pv = []
+        moves_searched = 0
+
+        for move in self.staged_moves(ply, (pv_move, hash_move)):
+
+            if ply == 0 and self.root_moves is not None and move.get_uci_notation() not in self.root_moves:
+                continue
+
+            if move.packed != pv_move: # the old variation is only followed through its own move
+                self.follow_pv = False
+
+            moves_searched += 1
+            gs.make_move(move)
+            score, child_pv = self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            score = -score
+            gs.undo_move()
+
+            self.follow_pv = False # only the first move searched can continue the old variation
+
+            if self.stopped:
+                return 0, []
+
+            if score > alpha:
+                alpha = score
+                best_pv = [move] + child_pv
+
+                if score >= beta:
+
+                    if move.piece_captured == '--': # quiet move, remember it for sibling positions
+                        self.store_killer(move, ply)
+                        history_key = (move.piece_moved, move.end_row, move.end_col)
+                        self.history[history_key] = self.history.get(history_key, 0) + depth * depth
+
+                    self.table.store(key, depth, lower_bound, score_to_table(beta, ply), move.packed)
+
+                    return beta, best_pv
+
+        if moves_searched == 0:
+
+            if gs.in_check():
+                return -mate_score + ply, [] # prefer the quickest mate
+
+            return 0, []
+
+        if alpha > original_alpha:
+            self.table.store(key, depth, exact, score_to_table(alpha, ply), best_pv[0].packed)
+
+        else:
+            self.table.store(key, depth, upper_bound, score_to_table(alpha, ply), 0)
+
+        return alpha, best_pv
+
+
+    # only captures and promotions, so the leaf score isn't taken in the middle of an exchange
+    # in check there's no standing pat: every evasion is searched, and having none is mate
+
+    def quiescence(self, alpha, beta, ply):
+
+        self.nodes += 1
+        self.check_limits()
+
+        if self.stopped:
+            return 0
+
+        gs = self.gs
+
+        if gs.in_check():
+
+            if ply >= max_ply - 1:
+                return evaluate(gs)
+
+            moves = gs.get_valid_moves()
+
+            if not moves:
+                return -mate_score + ply
+
+        else:
+
+            stand_pat = evaluate(gs)
+
+            if stand_pat >= beta:
+                return beta
+
+            if stand_pat > alpha:
+                alpha = stand_pat
+
+            if ply >= max_ply - 1:
+                return alpha
+
+            moves = gs.get_valid_captures()
+
+        for move in self.order_moves(moves, ply):
+
+            gs.make_move(move)
+            score = -self.quiescence(-beta, -alpha, ply + 1)
+            gs.undo_move()
+
+            if self.stopped:
+                return 0
+
+            if score >= beta:
+                return beta
+
+            if score > alpha:
+                alpha = score
+
+        return alpha
+
+
+    # moves in stages, each generated only when the ones before it didn't cause a cutoff:
+    # principal variation and hash move, winning captures, killers, quiet moves by history, then losing captures
+    # first_moves holds Move.packed values, 0 for none
+
+    def staged_moves(self, ply, first_moves):
+
+        gs = self.gs
+        tried = set()
+
+        for packed in first_moves:
+
+            if packed and packed not in tried:
+
+                move = self.find_legal(packed)
+
+                if move is not None:
+                    tried.add(packed)
+                    yield move
+
+        winning = []
+        losing = []
+
+        for move in gs.get_valid_captures():
+
+            if move.packed not in tried:
+                (winning if self.capture_wins(move) else losing).append(move)
+
+        for move in self.order_moves(winning, ply):
+            yield move
+
+        for killer in self.killers[ply]:
+
+            if killer is not None and killer.packed not in tried:
+
+                move = self.find_legal(killer.packed)
+
+                if move is not None and move.piece_captured == '--' and not move.is_pawn_promotion:
+                    tried.add(move.packed)
+                    yield move
+
+        quiets = [move for move in gs.get_valid_quiets() if move.packed not in tried]
+
+        for move in self.order_moves(quiets, ply):
+            yield move
+
+        for move in self.order_moves(losing, ply):
+            yield move
+
+
+    # the legal move with this Move.packed in the current position, or None when it can't be played here
+
+    def find_legal(self, packed):
+
+        start_row, start_col = divmod(packed & 63, 8)
+
+        for move in self.gs.get_valid_piece_moves(start_row, start_col):
+
+            if move.packed == packed:
+                return move
+
+        return None
+
+
+    # a capture loses material when it takes a cheaper piece on a defended square, promotions always count as winning
+
+    def capture_wins(self, move):
+
+        if move.piece_captured == '--' or piece_values[move.piece_captured[1]] >= piece_values[move.piece_moved[1]]:
+            return True
+
+        return not self.gs.square_under_attack(move.end_row, move.end_col)
+
+
+    def store_killer(self, move, ply):
+
+        killers = self.killers[ply]
+
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+
+
+    def order_moves(self, moves, ply):
+
+        killers = self.killers[ply]
+        history = self.history
+
+        def move_score(move):
+
+            if move.piece_captured != '--':
+                return capture_score + capture_rank[move.piece_captured[1]] * 10 - capture_rank[move.piece_moved[1]]
+
+            if move.is_pawn_promotion:
+                return capture_score + piece_values[move.promotion_choice] - 1000
+
+            if move == killers[0]:
+                return killer_scores[0]
+
+            if move == killers[1]:
+                return killer_scores[1]
+
+            return history.get((move.piece_moved, move.end_row, move.end_col), 0)
+
+        return sorted(moves, key = move_score, reverse = True)
+
+
+# mate scores are stored relative to the position, not the root, so they stay right when reached at another ply
+
+def score_to_table(score, ply):
+
+    if score >= mate_score - max_ply:
+        return score + ply
+
+    if score <= -mate_score + max_ply:
+        return score - ply
+
+    return score
+
+
+def score_from_table(score, ply):
+
+    if score >= mate_score - max_ply:
+        return score - ply
+
+    if score <= -mate_score + max_ply:
+        return score + ply
+
+    return score
+
+
+# choose a move for the side to move in gs, limits is a Search_Limits or None for the default depth
+# pass the same table to successive calls to keep what earlier searches learned
+# book is an Opening_Book, positions found in it are answered from the book without searching
+# instrumentation is an instrument.Instrumentation to attach to the Searcher
+
+def best_move(gs, limits = None, info = None, table = None, book = None, tablebases = None, instrumentation = None):
+
+    if book is not None:
+
+        start = time.perf_counter()
+        move = book.choose(gs)
+
+        if move is not None:
+            return Search_Result(move, 0, 0, 0, time.perf_counter() - start, [move])
+
+    searcher = Searcher(gs, limits or Search_Limits(), table, tablebases = tablebases)
+
+    if instrumentation is not None:
+        instrumentation.attach_searcher(searcher)
+
+    return searcher.search(info)
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Search a position and report the best move.")
+    parser.add_argument("--fen", default = None, help = "position to search, defaults to the start position")
+    parser.add_argument("--depth", type = int, default = None)
+    parser.add_argument("--nodes", type = int, default = None)
+    parser.add_argument("--time", type = float, default = None, help = "seconds")
+    parser.add_argument("--hash", type = int, default = 16, help = "transposition table size in MB")
+    parser.add_argument("--book", default = None, help = "opening book file, see book.py")
+    parser.add_argument("--tablebases", default = None, help = "directory of endgame tables, see tablebase.py")
+    parser.add_argument("--stats", action = "store_true", help = "instrument the search and print a JSON snapshot of where the time went")
+    args = parser.parse_args(argv)
+
+    gs = engine.GameState()
+
+    if args.fen:
+        gs.load_fen(args.fen)
+
+    table = Transposition_Table(args.hash)
+    book = open_book(args.book) if args.book else None
+    tablebases = Tablebases(args.tablebases) if args.tablebases else None
+    instrumentation = None
+
+    if args.stats:
+        instrumentation = Instrumentation()
+        instrumentation.attach(gs)
+
+    result = best_move(gs, Search_Limits(args.depth, args.nodes, args.time), info = print, table = table, book = book, tablebases = tablebases,
+        instrumentation = instrumentation)
+    print("bestmove %s" % (result.move.get_uci_notation() if result.move else "(none)"))
+    print("%d nodes in %.3fs, %d nodes/s" % (result.nodes, result.time, result.nps))
+    print("table: %(hits)d hits, %(misses)d misses, %(collisions)d collisions, %(hit_rate).1f%% hit rate" % dict(table.stats(), hit_rate = table.stats()['hit_rate'] * 100))
+
+    if instrumentation is not None:
+        print(instrumentation.log_line())
+        print(instrumentation.to_json(indent = 2))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
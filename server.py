@@ -0,0 +1,341 @@
+"""
+Analysis daemon speaking JSON lines over localhost TCP or a Unix socket. Connections are multiplexed with asyncio and the engine work runs on a process pool whose workers keep their transposition tables between requests. Identical requests in flight share one search and recent answers are kept in a bounded cache. Also has a load generator to measure latency against a running server.
+"""
+
+import argparse, asyncio, json, os, random, statistics, subprocess, sys, time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+from evaluation import evaluate
+from search import Search_Limits, Searcher
+from transposition import Transposition_Table
+
+
+# a request is one JSON object per line:
+#   {"id": 1, "fen": "...", "moves": ["e2e4", "e5"], "depth": 3}
+# fen defaults to the start position, moves are played from it in uci notation or SAN, depth defaults to the server's.
+# {"id": 2, "stats": true} asks for the server's counters instead
+# every answer carries the request's id, and either "error" or the fields analyze returns
+
+
+worker_table = None # each worker process's transposition table, kept between requests
+
+
+def start_worker(table_mb):
+
+    global worker_table
+    worker_table = Transposition_Table(table_mb)
+
+
+# runs in a worker process: the position after moves from fen, its legal moves, static evaluation and best move
+# raises ValueError on a bad FEN or a move that isn't legal
+
+def analyze(fen, moves, depth):
+
+    gs = engine.GameState(fen)
+
+    for text in moves:
+
+        legal = {move.get_uci_notation(): move for move in gs.get_valid_moves()}
+        gs.make_move(legal[text] if text in legal else gs.parse_san(text))
+
+    legal_moves = gs.get_valid_moves()
+    answer = {'fen': gs.get_fen(), 'legal_moves': [move.get_uci_notation() for move in legal_moves], 'evaluation': evaluate(gs),
+        'checkmate': gs.checkmate, 'stalemate': gs.stalemate, 'draw': gs.draw_by_repetition or gs.draw_by_fifty_moves}
+
+    if not legal_moves:
+        answer.update(best_move = None, score = 0, depth = 0, pv = [])
+        return answer
+
+    table = worker_table if worker_table is not None else Transposition_Table()
+    result = Searcher(gs, Search_Limits(depth), table).search()
+    answer.update(best_move = result.move.get_uci_notation(), score = result.score, depth = result.depth,
+        pv = [move.get_uci_notation() for move in result.pv])
+
+    return answer
+
+
+class Analysis_Server():
+
+    def __init__(self, workers = None, cache_size = 10000, default_depth = 3, max_depth = 8, table_mb = 16):
+
+        self.executor = ProcessPoolExecutor(max_workers = workers or os.cpu_count() or 1, initializer = start_worker, initargs = (table_mb,))
+        self.cache_size = cache_size
+        self.default_depth = default_depth
+        self.max_depth = max_depth
+
+        self.cache = OrderedDict() # (fen, moves, depth) -> answer, most recently used last
+        self.in_flight = {} # (fen, moves, depth) -> future every request for that key waits on
+
+        self.requests = 0
+        self.cache_hits = 0
+        self.coalesced = 0 # requests that joined a search already running
+        self.searches = 0
+        self.errors = 0
+
+
+    # serves until cancelled, on a Unix socket when unix_path is given
+    # ready is called with the server once it's listening
+
+    async def serve(self, host = '127.0.0.1', port = 8765, unix_path = None, ready = None):
+
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle_client, path = unix_path)
+
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+
+        if ready is not None:
+            ready(server)
+
+        async with server:
+            await server.serve_forever()
+
+
+    # every line is answered from its own task, so a slow search doesn't hold up the requests behind it on the connection
+    # answers go out as they're ready, matched to their requests by id
+
+    async def handle_client(self, reader, writer):
+
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def respond(line):
+
+            answer = await self.answer(line)
+
+            async with lock:
+                writer.write(json.dumps(answer).encode() + b'\n')
+                await writer.drain()
+
+        try:
+
+            while True:
+
+                line = await reader.readline()
+
+                if not line:
+                    break
+
+                if line.strip():
+                    task = asyncio.ensure_future(respond(line))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions = True)
+
+        except ConnectionError:
+            pass
+
+        finally:
+            writer.close()
+
+
+    async def answer(self, line):
+
+        self.requests += 1
+
+        try:
+            request = json.loads(line)
+
+            if not isinstance(request, dict):
+                raise ValueError("a request is a JSON object")
+
+        except ValueError as error:
+            self.errors += 1
+            return {'id': None, 'error': str(error)}
+
+        request_id = request.get('id')
+
+        if request.get('stats'):
+            return dict({'id': request_id}, **self.stats())
+
+        try:
+            key = self.request_key(request)
+
+        except (TypeError, ValueError) as error:
+            self.errors += 1
+            return {'id': request_id, 'error': str(error)}
+
+        if key in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return dict({'id': request_id}, **self.cache[key])
+
+        if key in self.in_flight:
+            self.coalesced += 1
+            future = self.in_flight[key]
+
+        else:
+            self.searches += 1
+            future = asyncio.get_running_loop().run_in_executor(self.executor, analyze, *key)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done: self.finish(key, done))
+
+        try:
+            answer = await asyncio.shield(future) # one client going away doesn't cancel the search the others wait on
+
+        except ValueError as error:
+            self.errors += 1
+            return {'id': request_id, 'error': "illegal move or position: %s" % error}
+
+        except Exception as error: # a worker that died or a bug in the search, the request still gets its answer
+            self.errors += 1
+            return {'id': request_id, 'error': "search failed: %s: %s" % (type(error).__name__, error)}
+
+        return dict({'id': request_id}, **answer)
+
+
+    def finish(self, key, future):
+
+        del self.in_flight[key]
+
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        self.cache[key] = future.result()
+
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+
+
+    # (fen, moves, depth) with the defaults filled in, so requests for the same thing share a key
+
+    def request_key(self, request):
+
+        fen = request.get('fen') or None
+        moves = request.get('moves') or []
+        depth = request.get('depth', self.default_depth)
+
+        if fen is not None and not isinstance(fen, str) or not isinstance(moves, list) or not all(isinstance(move, str) for move in moves):
+            raise ValueError("fen is a string and moves a list of strings")
+
+        if isinstance(depth, bool) or not isinstance(depth, int) or not 1 <= depth <= self.max_depth:
+            raise ValueError("depth goes from 1 to %d" % self.max_depth)
+
+        return ' '.join(fen.split()) if fen else None, tuple(moves), depth
+
+
+    def stats(self):
+
+        return {'requests': self.requests, 'cache_hits': self.cache_hits, 'coalesced': self.coalesced, 'searches': self.searches,
+            'errors': self.errors, 'cached': len(self.cache), 'in_flight': len(self.in_flight)}
+
+
+    def close(self):
+        self.executor.shutdown()
+
+
+# load generator: connections clients each send requests one after another, waiting for every answer
+# positions are picked at random from fens, so fewer distinct positions means more cache hits
+# returns the latencies in seconds and the total time
+
+async def load_test(fens, requests, connections, depth, host = '127.0.0.1', port = 8765, unix_path = None, seed = 1):
+
+    rng = random.Random(seed)
+    latencies = []
+    remaining = [requests]
+
+    async def client():
+
+        if unix_path:
+            reader, writer = await asyncio.open_unix_connection(unix_path)
+
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+
+        while remaining[0] > 0:
+
+            remaining[0] -= 1
+            request = {'id': remaining[0], 'fen': rng.choice(fens), 'depth': depth}
+
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode() + b'\n')
+            await writer.drain()
+            answer = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - start)
+
+            if 'error' in answer:
+                raise RuntimeError("server error: " + answer['error'])
+
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for i in range(connections)])
+
+    return latencies, time.perf_counter() - start
+
+
+# seconds for a fresh interpreter to import the engine and analyze one position, the cost the server saves per request
+
+def cold_start_time(fen, depth):
+
+    code = "import server; server.analyze(%r, [], %d)" % (fen, depth)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+
+    return time.perf_counter() - start
+
+
+def percentile(values, share):
+    return sorted(values)[min(len(values) - 1, int(share * len(values)))]
+
+
+def run_benchmark(args, out = sys.stdout):
+
+    from match import random_openings
+
+    fens = random_openings(args.positions, 10, random.Random(args.seed))
+    latencies, elapsed = asyncio.run(load_test(fens, args.requests, args.connections, args.depth, args.host, args.port, args.unix, args.seed))
+
+    out.write("%d requests over %d connections in %.2fs, %.0f requests/s\n" % (len(latencies), args.connections, elapsed, len(latencies) / elapsed))
+    out.write("latency p50 %.2fms p90 %.2fms p99 %.2fms max %.2fms\n" % (percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+        percentile(latencies, 0.99) * 1000, max(latencies) * 1000))
+
+    if args.cold:
+        cold = [cold_start_time(fens[i % len(fens)], args.depth) for i in range(args.cold)]
+        out.write("cold start per request: median %.2fms over %d runs\n" % (statistics.median(cold) * 1000, len(cold)))
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Serve position analysis as JSON lines, or load test a running server.")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--unix", default = None, help = "Unix socket path, used instead of TCP")
+    parser.add_argument("--workers", type = int, default = None, help = "search processes, defaults to the CPU count")
+    parser.add_argument("--cache", type = int, default = 10000, help = "answers kept for repeated requests")
+    parser.add_argument("--depth", type = int, default = 3, help = "search depth when a request doesn't give one")
+    parser.add_argument("--max-depth", type = int, default = 8)
+    parser.add_argument("--hash", type = int, default = 16, help = "transposition table size in MB per worker")
+    parser.add_argument("--bench", action = "store_true", help = "load test the server at --host/--port or --unix instead of serving")
+    parser.add_argument("--requests", type = int, default = 2000)
+    parser.add_argument("--connections", type = int, default = 8)
+    parser.add_argument("--positions", type = int, default = 200, help = "distinct positions the load test picks from")
+    parser.add_argument("--cold", type = int, default = 0, help = "also time this many cold interpreter starts")
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args(argv)
+
+    if args.bench:
+        run_benchmark(args)
+        return 0
+
+    server = Analysis_Server(args.workers, args.cache, args.depth, args.max_depth, args.hash)
+    where = args.unix or "%s:%d" % (args.host, args.port)
+
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix, lambda listening: print("serving on " + where, flush = True)))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,737 @@
+"""
+Endgame tablebases for small material signatures such as KQK, KRK and KPK. Tables are built by retrograde analysis, written as one byte per position and probed through a read only memory map, so a probe is one indexed read.
+
+A signature lists white's pieces then black's, each starting with its king: KRK is king and rook against a lone king. Positions with the material the other way round are probed with the colours swapped. Castling and en passant are ignored, so positions with either available aren't probed. Ignoring en passant in the generator is only sound while one side has no pawns, as a side without pawns can never capture en passant, so only signatures whose pawns are all one colour are generated or loaded.
+"""
+
+import argparse, mmap, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+
+
+# table bytes, from the side to move's point of view
+draw = 0
+loss_base = 128 # 1-127 win in that many plies, 128 + n lost in n plies, 128 itself is checkmate
+illegal = 255
+unresolved = 254 # only while building
+
+kind_order = 'KQRBNp'
+material = {'K': 0, 'Q': 9, 'R': 5, 'B': 3, 'N': 3, 'P': 1}
+promotion_kinds = 'QRBN'
+
+
+# square tables with squares as row * 8 + col, row 0 being the 8th rank like GameState.board
+
+def build_square_tables():
+
+    knight_targets = [[r * 8 + c for r, c in engine.knight_table[sq // 8][sq % 8]] for sq in range(64)]
+    king_targets = [[r * 8 + c for r, c in engine.king_table[sq // 8][sq % 8]] for sq in range(64)]
+    rays = [[[r * 8 + c for r, c in ray] for ray in engine.ray_table[sq // 8][sq % 8]] for sq in range(64)]
+
+    knight_masks = [sum(1 << target for target in knight_targets[sq]) for sq in range(64)]
+    king_masks = [sum(1 << target for target in king_targets[sq]) for sq in range(64)]
+
+    # white pawns attack towards row 0, black pawns towards row 7
+    pawn_masks = {'w': [0] * 64, 'b': [0] * 64}
+
+    for sq in range(64):
+
+        r, c = divmod(sq, 8)
+
+        for colour, row in (('w', r - 1), ('b', r + 1)):
+
+            for col in (c - 1, c + 1):
+
+                if 0 <= row < 8 and 0 <= col < 8:
+                    pawn_masks[colour][sq] |= 1 << (row * 8 + col)
+
+    # lines[a][b] is 'R' or 'B' when a slider of that kind on a could reach b on an empty board, between[a][b] the squares in the way
+    lines = [[None] * 64 for sq in range(64)]
+    between = [[0] * 64 for sq in range(64)]
+
+    for sq in range(64):
+
+        for j in range(8):
+
+            mask = 0
+
+            for target in rays[sq][j]:
+                lines[sq][target] = 'R' if j < 4 else 'B'
+                between[sq][target] = mask
+                mask |= 1 << target
+
+    return knight_targets, king_targets, rays, knight_masks, king_masks, pawn_masks, lines, between
+
+
+knight_targets, king_targets, rays, knight_masks, king_masks, pawn_masks, lines, between = build_square_tables()
+
+
+# 'KRK' -> ['wK', 'wR', 'bK']
+
+def signature_pieces(signature):
+
+    split = signature.find('K', 1)
+
+    if not signature.startswith('K') or split < 0 or signature.count('K') != 2 or any(char not in 'KQRBNP' for char in signature):
+        raise ValueError("bad material signature " + signature)
+
+    return ['w' + (char if char != 'P' else 'p') for char in signature[:split]] + \
+        ['b' + (char if char != 'P' else 'p') for char in signature[split:]]
+
+
+# whether the retrograde generator gets signature right: it doesn't model en passant, so pawns on both sides could take
+# each other en passant in the real game but not in the table. Captures and promotions only take pawns away, so a
+# signature with pawns of one colour only depends on signatures like it
+
+def one_pawn_colour(signature):
+
+    split = signature.find('K', 1)
+
+    return 'P' not in signature[:split] or 'P' not in signature[split:]
+
+
+# the signature for a list of pieces in any order, and the order of the pieces' indices in it
+
+def signature_of(pieces):
+
+    order = sorted(range(len(pieces)), key = lambda i: (pieces[i][0] == 'b', kind_order.index(pieces[i][1])))
+
+    return ''.join(pieces[i][1].upper() for i in order), order
+
+
+# kings and at most one bishop or knight between them can't mate
+
+def insufficient(pieces):
+
+    others = [piece[1] for piece in pieces if piece[1] != 'K']
+
+    return len(others) == 0 or (len(others) == 1 and others[0] in 'BN')
+
+
+def mirror(sq):
+    return sq ^ 56 # same file, rank seen from the other side
+
+
+def attacks(piece, sq, target, occupied):
+
+    kind = piece[1]
+
+    if kind == 'N':
+        return knight_masks[sq] >> target & 1
+
+    if kind == 'K':
+        return king_masks[sq] >> target & 1
+
+    if kind == 'p':
+        return pawn_masks[piece[0]][sq] >> target & 1
+
+    line = lines[sq][target]
+
+    if line is None or (kind == 'R' and line != 'R') or (kind == 'B' and line != 'B'):
+        return False
+
+    return not between[sq][target] & occupied
+
+
+# whether any piece of colour attacks target, pieces at square None have been captured
+
+def attacked(target, colour, pieces, squares, occupied):
+
+    for i in range(len(pieces)):
+
+        if pieces[i][0] == colour and squares[i] is not None and attacks(pieces[i], squares[i], target, occupied):
+            return True
+
+    return False
+
+
+class Tablebases():
+
+    # every <signature>.tb file in directory, each one mapped read only
+    # a file that can't be used, a stale table with pawns on both sides or one of the wrong size, is skipped with a warning to out
+
+    def __init__(self, directory, out = sys.stderr):
+
+        self.directory = directory
+        self.tables = {}
+        self.files = []
+        self.max_pieces = 0
+
+        if os.path.isdir(directory):
+
+            for name in sorted(os.listdir(directory)):
+
+                if not name.endswith('.tb'):
+                    continue
+
+                try:
+                    self.add_table(name[:-3], os.path.join(directory, name))
+
+                except ValueError as error:
+                    out.write("skipping tablebase file: %s\n" % error)
+
+
+    def add_table(self, signature, path):
+
+        pieces = signature_pieces(signature)
+
+        if not one_pawn_colour(signature):
+            raise ValueError("%s has pawns on both sides, its table would ignore en passant" % path)
+
+        file = open(path, 'rb')
+
+        if os.fstat(file.fileno()).st_size != 2 * 64 ** len(pieces):
+            file.close()
+            raise ValueError("%s has the wrong size for %s" % (path, signature))
+
+        self.files.append(file)
+        self.tables[signature] = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.max_pieces = max(self.max_pieces, len(pieces))
+
+
+    def close(self):
+
+        for data in self.tables.values():
+            data.close()
+
+        for file in self.files:
+            file.close()
+
+
+    # table byte for pieces on squares, or None when no table covers the material
+    # insufficient material is a draw without a table
+
+    def probe_pieces(self, pieces, squares, white_to_move):
+
+        if insufficient(pieces):
+            return draw
+
+        signature, order = signature_of(pieces)
+
+        if signature in self.tables:
+            index = 0 if white_to_move else 1
+
+            for i in order:
+                index = index * 64 + squares[i]
+
+            return self.tables[signature][index]
+
+        # the same material with the colours swapped, seen from the other side of the board
+        swapped = [('b' if piece[0] == 'w' else 'w') + piece[1] for piece in pieces]
+        signature, order = signature_of(swapped)
+
+        if signature in self.tables:
+
+            index = 1 if white_to_move else 0
+
+            for i in order:
+                index = index * 64 + mirror(squares[i])
+
+            return self.tables[signature][index]
+
+        return None
+
+
+    # (result, plies to mate) for the side to move in gs: result 1 win, 0 draw, -1 loss. None when not covered
+
+    def probe(self, gs):
+
+        if gs.castle_rights or gs.en_passant_capture(): # a double push with no pawn beside it doesn't change the position
+            return None
+
+        pieces = []
+        squares = []
+
+        for r in range(8):
+
+            for c in range(8):
+
+                piece = gs.board[r][c]
+
+                if piece != '--':
+
+                    if len(pieces) == self.max_pieces:
+                        return None
+
+                    pieces.append(piece)
+                    squares.append(r * 8 + c)
+
+        value = self.probe_pieces(pieces, squares, gs.white_to_move)
+
+        if value is None or value == illegal:
+            return None
+
+        return decode(value)
+
+
+def decode(value):
+
+    if value == draw:
+        return 0, 0
+
+    if value < loss_base:
+        return 1, value
+
+    return -1, value - loss_base
+
+
+# signatures a table's captures and promotions lead to that need a table of their own
+
+def dependencies(signature):
+
+    pieces = signature_pieces(signature)
+    children = set()
+
+    for i in range(len(pieces)):
+
+        if pieces[i][1] == 'K':
+            continue
+
+        captured = pieces[:i] + pieces[i+1:]
+
+        if not insufficient(captured):
+            children.add(canonical_signature(captured))
+
+        if pieces[i][1] == 'p':
+
+            for kind in promotion_kinds:
+
+                promoted = pieces[:i] + [pieces[i][0] + kind] + pieces[i+1:]
+
+                if not insufficient(promoted):
+                    children.add(canonical_signature(promoted))
+
+    return children
+
+
+# signature with the stronger side as white, as tables are stored: more pieces, then more material
+
+def canonical_signature(pieces):
+
+    signature = signature_of(pieces)[0]
+    swapped = signature_of([('b' if piece[0] == 'w' else 'w') + piece[1] for piece in pieces])[0]
+
+    def strength(text):
+        white = text[:text.index('K', 1)]
+        return len(white), sum(material[char] for char in white), text
+
+    return max(signature, swapped, key = strength)
+
+
+# builds one table by retrograde analysis, the tables for its captures and promotions have to be in tablebases already
+# returns the table as a bytearray indexed by side to move, then each piece's square in signature order
+
+def build_table(signature, tablebases):
+
+    pieces = signature_pieces(signature)
+    n = len(pieces)
+    size = 64 ** n
+    colours = ('w', 'b')
+    king_index = {'w': pieces.index('wK'), 'b': pieces.index('bK')}
+
+    result = bytearray([illegal]) * (2 * size)
+    counts = bytearray(2 * size) # legal moves not yet known to lose
+    longest = bytearray(2 * size) # longest win the opponent has after the moves known to lose
+    win_ply = bytearray([illegal]) * (2 * size) # shortest win found so far
+    loss_ply = bytearray([illegal]) * (2 * size)
+    buckets = [[] for ply in range(loss_base)]
+
+    def index_of(stm, squares):
+
+        index = stm
+
+        for sq in squares:
+            index = index * 64 + sq
+
+        return index
+
+    def squares_of(index):
+
+        squares = [0] * n
+
+        for i in range(n - 1, -1, -1):
+            index, squares[i] = divmod(index, 64)
+
+        return index, squares
+
+    # first pass: find the legal positions, count their moves and score the moves that leave the table
+
+    for index in range(2 * size):
+
+        stm, squares = squares_of(index)
+
+        if len(set(squares)) != n:
+            continue
+
+        if any(pieces[i][1] == 'p' and (squares[i] < 8 or squares[i] >= 56) for i in range(n)):
+            continue
+
+        occupied = 0
+
+        for sq in squares:
+            occupied |= 1 << sq
+
+        colour, enemy = colours[stm], colours[1 - stm]
+
+        if attacked(squares[king_index[enemy]], colour, pieces, squares, occupied):
+            continue # the side that just moved left its king in check
+
+        moves = 0
+        best_win = illegal
+        worst_loss = 0
+        losing = 0
+
+        for i, to, captured, promotion in pseudo_moves(pieces, squares, colour, occupied):
+
+            after = list(squares)
+            after[i] = to
+            after_occupied = occupied & ~(1 << squares[i]) | 1 << to
+            after_pieces = pieces
+
+            if captured is not None:
+                after[captured] = None
+
+            if promotion is not None:
+                after_pieces = list(pieces)
+                after_pieces[i] = colour + promotion
+
+            if attacked(after[king_index[colour]], enemy, after_pieces, after, after_occupied):
+                continue
+
+            moves += 1
+
+            if captured is None and promotion is None:
+                continue
+
+            # leaves the table: look the position up in the smaller one
+            child_pieces = [after_pieces[j] for j in range(n) if after[j] is not None]
+            child_squares = [sq for sq in after if sq is not None]
+            value = tablebases.probe_pieces(child_pieces, child_squares, colour != 'w')
+
+            if value is None:
+                raise ValueError("%s needs the table for %s" % (signature, canonical_signature(child_pieces)))
+
+            if value == draw:
+                continue
+
+            if value >= loss_base: # the opponent is lost, so this move wins
+                best_win = min(best_win, value - loss_base + 1)
+
+            else:
+                losing += 1
+                worst_loss = max(worst_loss, value)
+
+        result[index] = unresolved
+        counts[index] = moves - losing
+        longest[index] = worst_loss
+
+        if moves == 0:
+
+            if attacked(squares[king_index[colour]], enemy, pieces, squares, occupied):
+                loss_ply[index] = 0
+                buckets[0].append(index)
+
+            else:
+                result[index] = draw # stalemate
+
+        elif best_win != illegal:
+            win_ply[index] = best_win
+            buckets[best_win].append(index)
+
+        elif counts[index] == 0 and worst_loss + 1 < loss_base - 1: # every move leaves the table into a lost position
+            loss_ply[index] = worst_loss + 1
+            buckets[worst_loss + 1].append(index)
+
+    # then outward from the decided positions, one ply at a time
+
+    for ply in range(loss_base - 1):
+
+        for index in buckets[ply]:
+
+            if result[index] != unresolved:
+                continue
+
+            if win_ply[index] == ply:
+                result[index] = ply
+                lost = False
+
+            elif loss_ply[index] == ply:
+                result[index] = loss_base + ply
+                lost = True
+
+            else:
+                continue # an entry left behind by a shorter win
+
+            stm, squares = squares_of(index)
+            mover = colours[1 - stm]
+
+            for before in predecessors(pieces, squares, mover, king_index):
+
+                previous = index_of(1 - stm, before)
+
+                if result[previous] != unresolved:
+                    continue
+
+                if lost: # the mover can win by playing into this position
+                    if win_ply[previous] > ply + 1:
+                        win_ply[previous] = ply + 1
+                        buckets[ply + 1].append(previous)
+
+                else:
+
+                    counts[previous] -= 1
+                    longest[previous] = max(longest[previous], ply)
+
+                    if counts[previous] == 0:
+                        loss_ply[previous] = longest[previous] + 1
+
+                        if longest[previous] + 1 < loss_base - 1:
+                            buckets[longest[previous] + 1].append(previous)
+
+        buckets[ply] = None
+
+    for index in range(2 * size):
+
+        if result[index] == unresolved: # never forced either way
+            result[index] = draw
+
+    return result
+
+
+# (piece index, to square, captured piece index or None, promotion kind or None) for every pseudo legal move of colour
+
+def pseudo_moves(pieces, squares, colour, occupied):
+
+    owners = {}
+
+    for i in range(len(pieces)):
+        owners[squares[i]] = i
+
+    for i in range(len(pieces)):
+
+        piece = pieces[i]
+
+        if piece[0] != colour:
+            continue
+
+        sq = squares[i]
+        kind = piece[1]
+
+        if kind == 'p':
+
+            step = -8 if colour == 'w' else 8
+            to = sq + step
+            last_row = to < 8 or to >= 56
+
+            if not occupied >> to & 1:
+
+                if last_row:
+                    for promotion in promotion_kinds:
+                        yield i, to, None, promotion
+
+                else:
+                    yield i, to, None, None
+
+                    if (sq >= 48 if colour == 'w' else sq < 16) and not occupied >> (to + step) & 1:
+                        yield i, to + step, None, None
+
+            mask = pawn_masks[colour][sq] & occupied
+
+            for to in list(owners):
+
+                if mask >> to & 1 and pieces[owners[to]][0] != colour:
+
+                    if last_row:
+                        for promotion in promotion_kinds:
+                            yield i, to, owners[to], promotion
+
+                    else:
+                        yield i, to, owners[to], None
+
+            continue
+
+        if kind == 'N' or kind == 'K':
+            targets = knight_targets[sq] if kind == 'N' else king_targets[sq]
+
+        else:
+
+            targets = []
+            first, last = {'R': (0, 4), 'B': (4, 8), 'Q': (0, 8)}[kind]
+
+            for j in range(first, last):
+
+                for to in rays[sq][j]:
+
+                    targets.append(to)
+
+                    if occupied >> to & 1:
+                        break
+
+        for to in targets:
+
+            if occupied >> to & 1:
+
+                owner = owners[to]
+
+                if pieces[owner][0] != colour and pieces[owner][1] != 'K':
+                    yield i, to, owner, None
+
+            else:
+                yield i, to, None, None
+
+
+# positions, as square lists, from which mover reaches squares with a quiet move: no capture and no promotion
+# only positions where the other side isn't left in check are returned
+
+def predecessors(pieces, squares, mover, king_index):
+
+    occupied = 0
+
+    for sq in squares:
+        occupied |= 1 << sq
+
+    other = 'b' if mover == 'w' else 'w'
+    other_king = king_index[other]
+
+    for i in range(len(pieces)):
+
+        piece = pieces[i]
+
+        if piece[0] != mover:
+            continue
+
+        sq = squares[i]
+        kind = piece[1]
+
+        if kind == 'p':
+
+            step = 8 if mover == 'w' else -8 # backwards
+            origins = []
+            back = sq + step
+
+            if 8 <= back < 56 and not occupied >> back & 1:
+
+                origins.append(back)
+
+                # a double push lands on the 4th rank from a pawn's own side
+                if (sq // 8 == 4 if mover == 'w' else sq // 8 == 3) and not occupied >> (back + step) & 1:
+                    origins.append(back + step)
+
+        elif kind == 'N' or kind == 'K':
+            origins = [to for to in (knight_targets[sq] if kind == 'N' else king_targets[sq]) if not occupied >> to & 1]
+
+        else:
+
+            origins = []
+            first, last = {'R': (0, 4), 'B': (4, 8), 'Q': (0, 8)}[kind]
+
+            for j in range(first, last):
+
+                for to in rays[sq][j]:
+
+                    if occupied >> to & 1:
+                        break
+
+                    origins.append(to)
+
+        for origin in origins:
+
+            before = list(squares)
+            before[i] = origin
+            before_occupied = occupied & ~(1 << sq) | 1 << origin
+
+            if not attacked(before[other_king], mover, pieces, before, before_occupied):
+                yield before
+
+
+# runs in a worker process: builds one table from the ones already in directory and writes it there
+
+def generate_table(signature, directory):
+
+    start = time.perf_counter()
+    tablebases = Tablebases(directory)
+
+    try:
+        table = build_table(signature, tablebases)
+
+    finally:
+        tablebases.close()
+
+    path = os.path.join(directory, signature + '.tb')
+
+    with open(path + '.tmp', 'wb') as file:
+        file.write(table)
+
+    os.replace(path + '.tmp', path)
+
+    wins = sum(1 for value in table if 0 < value < loss_base)
+    losses = sum(1 for value in table if loss_base <= value < illegal)
+
+    return signature, wins, losses, time.perf_counter() - start
+
+
+# builds the tables for signatures and whatever they depend on that isn't in directory yet
+# raises ValueError on a signature with pawns of both colours, see one_pawn_colour
+# tables whose dependencies are all built are generated side by side over the process pool
+
+def generate(signatures, directory, workers = 1, out = sys.stdout):
+
+    waiting = [canonical_signature(signature_pieces(signature)) for signature in signatures]
+
+    for signature in waiting:
+
+        if not one_pawn_colour(signature):
+            raise ValueError("can't generate %s: with pawns on both sides en passant matters and the generator ignores it" % signature)
+
+    os.makedirs(directory, exist_ok = True)
+
+    needed = set()
+
+    while waiting:
+
+        signature = waiting.pop()
+
+        if signature not in needed and not os.path.exists(os.path.join(directory, signature + '.tb')):
+            needed.add(signature)
+            waiting.extend(dependencies(signature))
+
+    with ProcessPoolExecutor(max_workers = max(1, workers)) as executor:
+
+        while needed:
+
+            ready = [signature for signature in needed if not dependencies(signature) & needed]
+
+            for signature, wins, losses, elapsed in executor.map(generate_table, ready, [directory] * len(ready)):
+                out.write("%s: %d wins, %d losses in %.1fs\n" % (signature, wins, losses, elapsed))
+
+            needed -= set(ready)
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Generate endgame tablebases, or probe a position in them.")
+    parser.add_argument("--dir", default = "tablebases")
+    parser.add_argument("--generate", nargs = "+", default = None, help = "material signatures such as KQK KRK KPK, pawns of one colour only")
+    parser.add_argument("--workers", type = int, default = 3)
+    parser.add_argument("--fen", default = None, help = "position to probe")
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        generate(args.generate, args.dir, args.workers)
+
+    if args.fen:
+
+        answer = Tablebases(args.dir).probe(engine.GameState(args.fen))
+
+        if answer is None:
+            print("not in the tablebases")
+
+        else:
+            print({1: "win", 0: "draw", -1: "loss"}[answer[0]] + (" in %d plies" % answer[1] if answer[0] else ""))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""
+Checks of GameState rules that perft counts don't cover, on both backends. Run with pytest.
+"""
+
+import pytest
+
+import bitboard, engine
+
+
+backends = [engine.GameState, bitboard.BitboardGameState]
+
+
+def play(gs, sans):
+
+    for san in sans:
+        gs.make_move(gs.parse_san(san))
+
+
+# the position after 1...e5 comes up again after 3...Nb8 and 5...Nb8, the first time with an en passant square no pawn can use
+
+@pytest.mark.parametrize('backend', backends)
+def test_threefold_repetition_after_double_push(backend):
+
+    gs = backend()
+    play(gs, ['e4', 'e5', 'Nf3', 'Nc6', 'Ng1', 'Nb8'])
+    gs.get_valid_moves()
+
+    assert gs.repetitions() == 1
+    assert not gs.draw_by_repetition
+
+    play(gs, ['Nf3', 'Nc6', 'Ng1', 'Nb8'])
+    gs.get_valid_moves()
+
+    assert gs.repetitions() == 2
+    assert gs.draw_by_repetition
+
+
+# with a pawn beside the one that moved two squares the en passant square is part of the position
+
+@pytest.mark.parametrize('backend', backends)
+def test_usable_en_passant_square_changes_the_key(backend):
+
+    gs = backend("4k3/8/8/8/5p2/8/4P3/4K3 w - - 0 1")
+    play(gs, ['e4'])
+
+    assert gs.en_passant_capture()
+    assert gs.zobrist_key != backend("4k3/8/8/8/4Pp2/8/8/4K3 b - - 0 1").zobrist_key
+    assert gs.zobrist_key == backend("4k3/8/8/8/4Pp2/8/8/4K3 b - e3 0 1").zobrist_key
+
+    gs.undo_move()
+
+    assert gs.zobrist_key == gs.compute_zobrist_key()
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_unusable_en_passant_square_leaves_the_key_alone(backend):
+
+    gs = backend()
+    play(gs, ['e4'])
+
+    assert not gs.en_passant_capture()
+    assert gs.zobrist_key == backend("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1").zobrist_key
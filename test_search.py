@@ -0,0 +1,69 @@
+"""
+Checks of the search's scoring that perft counts don't cover. Run with pytest.
+"""
+
+import io, os
+
+import engine, search, tablebase
+from search import Search_Limits, Searcher, mate_score, max_ply
+
+
+# answers every probe with a loss for the side to move, plies from mate
+
+class Losing_Tablebases():
+
+    max_pieces = 3
+
+    def __init__(self, plies):
+        self.plies = plies
+
+    def probe(self, gs):
+        return -1, self.plies
+
+
+# a long tablebase win found deep in the tree has to score the same as near the root, and stay out of the mate band
+# the transposition table treats specially
+
+def test_tablebase_win_is_not_a_mate_score():
+
+    for plies in (1, 55, 126):
+
+        gs = engine.GameState("8/8/8/4k3/8/8/4P3/4K3 w - - 0 1")
+        result = Searcher(gs, Search_Limits(3), tablebases = Losing_Tablebases(plies)).search()
+
+        assert result.score == search.tablebase_win_score - plies
+        assert 50000 < result.score < mate_score - max_ply
+
+        for ply in (1, 60, 120):
+            assert search.score_from_table(search.score_to_table(result.score, ply), ply + 5) == result.score
+
+
+def test_stale_tablebase_files_are_skipped(tmp_path):
+
+    open(os.path.join(tmp_path, 'KPKP.tb'), 'wb').close()
+    open(os.path.join(tmp_path, 'KQK.tb'), 'wb').close()
+    out = io.StringIO()
+
+    tablebases = tablebase.Tablebases(str(tmp_path), out)
+
+    assert tablebases.tables == {}
+    assert out.getvalue().count("skipping") == 2
+
+
+# the mate comes at the horizon of a one ply search, so quiescence has to see that the side in check has no evasions
+
+def test_quiescence_sees_mate_at_the_horizon():
+
+    result = Searcher(engine.GameState("6k1/5ppp/8/8/8/8/8/R5K1 w - - 0 1"), Search_Limits(1)).search()
+
+    assert result.move.get_uci_notation() == 'a1a8'
+    assert result.score == mate_score - 1
+
+
+# checkmated at a leaf is mate, not the material count a stand pat would give
+
+def test_quiescence_scores_mate_in_check():
+
+    gs = engine.GameState("4k3/8/8/8/8/8/5PPP/r5K1 w - - 0 1")
+
+    assert Searcher(gs, Search_Limits(1)).quiescence(-mate_score - 1, mate_score + 1, 3) == -mate_score + 3
@@ -0,0 +1,118 @@
+"""
+Fixed size transposition table keyed by the GameState zobrist key. Entries live in two preallocated arrays, so memory stays flat however long the search runs.
+"""
+
+from array import array
+
+
+# bound types
+exact = 0
+lower_bound = 1 # score failed high, the real score is at least this
+upper_bound = 2 # score failed low, the real score is at most this
+
+entry_bytes = 16 # 8 byte key + 8 byte packed data
+score_offset = 1 << 31
+
+
+class Transposition_Table():
+
+    # every bucket holds two entries: slot 0 keeps the deepest search, slot 1 is always replaced
+
+    def __init__(self, size_mb = 16):
+
+        entries = max(2, size_mb * 1024 * 1024 // entry_bytes)
+        buckets = 1
+
+        while buckets * 2 * 2 <= entries: # round down to a power of two so the index is a mask
+            buckets *= 2
+
+        self.size_mb = size_mb
+        self.mask = buckets - 1
+        self.keys = array('Q', bytes(8 * buckets * 2))
+        self.data = array('Q', bytes(8 * buckets * 2))
+
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0 # stores that overwrote a different position
+        self.stores = 0
+
+
+    def clear(self):
+
+        self.keys = array('Q', bytes(8 * len(self.keys)))
+        self.data = array('Q', bytes(8 * len(self.data)))
+        self.hits = self.misses = self.collisions = self.stores = 0
+
+
+    # returns (depth, bound, score, move) or None, move is the best move's Move.packed or 0 when none was stored
+
+    def probe(self, key):
+
+        slot = (key & self.mask) * 2
+
+        for i in (slot, slot + 1):
+
+            if self.keys[i] == key:
+                self.hits += 1
+                data = self.data[i]
+
+                return data >> 50, (data >> 48) & 3, ((data >> 16) & 0xFFFFFFFF) - score_offset, data & 0xFFFF
+
+        self.misses += 1
+        return None
+
+
+    def store(self, key, depth, bound, score, move):
+
+        slot = (key & self.mask) * 2
+        keys = self.keys
+        data = self.data
+
+        if keys[slot] == key or keys[slot + 1] == key: # same position is refreshed in place
+
+            i = slot if keys[slot] == key else slot + 1
+
+            if move == 0: # keep the old best move rather than losing it
+                move = data[i] & 0xFFFF
+
+        elif keys[slot] == 0:
+            i = slot
+
+        elif depth >= data[slot] >> 50: # deep enough for the depth preferred slot, its old entry moves down
+
+            i = slot
+
+            if keys[slot + 1] != 0:
+                self.collisions += 1
+
+            keys[slot + 1] = keys[slot]
+            data[slot + 1] = data[slot]
+
+        else: # always replace slot
+
+            i = slot + 1
+
+            if keys[i] != 0:
+                self.collisions += 1
+
+        keys[i] = key
+        data[i] = min(depth, 0x3FFF) << 50 | bound << 48 | (score + score_offset) << 16 | move
+        self.stores += 1
+
+
+    # share of slots in use, from a sample at the start of the table
+
+    def fill(self):
+
+        sample = min(len(self.keys), 2000)
+
+        return sum(1 for i in range(sample) if self.keys[i] != 0) / sample
+
+
+    def stats(self):
+
+        probes = self.hits + self.misses
+
+        return {'size_mb': self.size_mb, 'entries': len(self.keys), 'hits': self.hits, 'misses': self.misses,
+            'collisions': self.collisions, 'stores': self.stores, 'hit_rate': self.hits / probes if probes else 0.0,
+            'fill': self.fill()}